@@ -0,0 +1,130 @@
+# admission.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+
+
+class Overloaded(Exception):
+    """Raised when the queue is full, with an estimate of how many seconds until a retry may succeed."""
+
+    def __init__(self, retry_after):
+        super().__init__(f'Too many requests, retry after {retry_after} seconds')
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Limit how many requests run at once, queueing a bounded number of others.
+
+    Queued requests are admitted highest priority first, and in arrival order within a priority. When the
+    queue is full new requests are rejected straight away, so overload surfaces as fast failures instead of
+    a growing backlog of requests which time out anyway. A concurrency of 0 admits everything.
+    """
+
+    def __init__(self, concurrency, queue_size):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+
+        self.active = 0
+        self.waiting = 0
+        self.waiters = []  # Heap of (-priority, sequence, future)
+        self.sequence = itertools.count()
+
+        self.admitted = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.completed = 0
+        self.service_time = 0.0
+
+    async def acquire(self, priority=0):
+        """Wait for a slot, returning the ticket which must be released when the request is done."""
+        if not self.concurrency or (self.active < self.concurrency and not self.waiting):
+            self.active += 1
+            return self.admit(0.0)
+
+        if self.waiting >= self.queue_size:
+            self.rejected += 1
+            raise Overloaded(self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (-priority, next(self.sequence), future))
+        self.waiting += 1
+        self.max_depth = max(self.max_depth, self.waiting)
+
+        start = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self.waiting -= 1
+            else:
+                # The slot was granted just as the request went away, so pass it on
+                self.release()
+            raise
+
+        return self.admit(time.monotonic() - start)
+
+    def admit(self, wait_time):
+        self.admitted += 1
+        self.wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        return Ticket(self)
+
+    def release(self, service_time=None):
+        self.active -= 1
+        if service_time is not None:
+            self.completed += 1
+            self.service_time += service_time
+
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if future.cancelled():
+                continue
+            self.waiting -= 1
+            self.active += 1
+            future.set_result(None)
+            break
+
+    def retry_after(self):
+        """Seconds until the queue is likely to have room, from the average time a request holds a slot."""
+        average = self.service_time / self.completed if self.completed else 1.0
+        return max(1, math.ceil(average * (self.waiting + 1) / max(self.concurrency, 1)))
+
+    def stats(self):
+        return {
+            'concurrency': self.concurrency,
+            'active': self.active,
+            'queue_depth': self.waiting,
+            'max_queue_depth': self.max_depth,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'average_wait_ms': round(1000 * self.wait_time / self.admitted, 1) if self.admitted else 0.0,
+            'max_wait_ms': round(1000 * self.max_wait_time, 1),
+        }
+
+
+class Ticket:
+    """A slot held by an admitted request. Releasing it more than once has no further effect."""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.start = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(time.monotonic() - self.start)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
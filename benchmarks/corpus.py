@@ -0,0 +1,100 @@
+# corpus.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import math
+import os
+import random
+import zlib
+
+import llama_index.embeddings
+
+SYLLABLES = ('ka', 'lo', 'mi', 'nu', 'pa', 're', 'si', 'to', 'qu', 'ya', 'chi', 'lla', 'wa', 'hu', 'ri', 'ma')
+
+
+class HashEmbedding(llama_index.embeddings.BaseEmbedding):
+    """Embedding from hashing each word into one of embed_dim signed buckets.
+
+    It needs no model, download or GPU and is fast enough not to dominate a benchmark, while texts sharing
+    words still have similar embeddings, so retrieval returns meaningful neighbours.
+    """
+
+    embed_dim: int = 384
+
+    @classmethod
+    def class_name(cls):
+        return 'HashEmbedding'
+
+    def embed(self, text):
+        vector = [0.0] * self.embed_dim
+        for word in text.lower().split():
+            value = zlib.crc32(word.encode('utf-8'))
+            vector[value % self.embed_dim] += 1.0 if value & 0x80000000 else -1.0
+        norm = math.sqrt(sum(component * component for component in vector)) or 1.0
+        return [component / norm for component in vector]
+
+    def _get_query_embedding(self, query):
+        return self.embed(query)
+
+    async def _aget_query_embedding(self, query):
+        return self.embed(query)
+
+    def _get_text_embedding(self, text):
+        return self.embed(text)
+
+
+class Corpus:
+    """Synthetic documents on a number of topics, with queries drawn from the same topics.
+
+    Most words of a document come from the vocabulary of its topic, so a query on a topic has relevant
+    documents to find. The same seed always produces the same corpus.
+    """
+
+    def __init__(self, documents=200, paragraphs=5, words=80, topics=20, vocabulary=2000, seed=0):
+        self.documents = documents
+        self.paragraphs = paragraphs
+        self.words = words
+        self.random = random.Random(seed)
+
+        self.vocabulary = self.get_vocabulary(vocabulary)
+        size = max(len(self.vocabulary) // topics, 1)
+        self.topics = [self.vocabulary[i * size:(i + 1) * size] for i in range(topics)]
+
+    def get_vocabulary(self, size):
+        vocabulary = set()
+        while len(vocabulary) < size:
+            vocabulary.add(''.join(self.random.choice(SYLLABLES) for _ in range(self.random.randint(2, 4))))
+        return sorted(vocabulary)
+
+    def sentence(self, topic, length):
+        words = [self.random.choice(topic if self.random.random() < 0.7 else self.vocabulary)
+                 for _ in range(length)]
+        return ' '.join(words).capitalize() + '.'
+
+    def document(self, topic):
+        paragraphs = []
+        for _ in range(self.paragraphs):
+            sentences = []
+            remaining = self.words
+            while remaining > 0:
+                length = min(remaining, self.random.randint(8, 20))
+                sentences.append(self.sentence(topic, length))
+                remaining -= length
+            paragraphs.append(' '.join(sentences))
+        return '\n\n'.join(paragraphs)
+
+    def write(self, path):
+        """Write the documents as text files under path, returning their paths."""
+        os.makedirs(path, exist_ok=True)
+        paths = []
+        for number in range(self.documents):
+            file_path = os.path.join(path, f'document-{number:05d}.txt')
+            with open(file_path, 'w', encoding='utf-8') as file:
+                file.write(self.document(self.topics[number % len(self.topics)]))
+            paths.append(file_path)
+        return paths
+
+    def queries(self, count, length=6):
+        return [' '.join(self.random.choice(self.topics[number % len(self.topics)]) for _ in range(length))
+                for number in range(count)]
@@ -0,0 +1,269 @@
+# load.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import argparse
+import asyncio
+import itertools
+import json
+import sys
+import time
+
+import config
+import utils
+
+try:
+    import httpx
+except ModuleNotFoundError as e:
+    print('\nError importing Python module(s)')
+    print('If installed using setup.sh it may be necessary to run:\n')
+    print('pyenv activate urcuchillay-env\n')
+    sys.exit(1)
+
+ENDPOINTS = {
+    'completions': '/v1/completions',
+    'chat': '/v1/chat/completions',
+}
+
+PROMPTS = [
+    'What is Urcuchillay AI?',
+    'Summarize the documents in a few sentences.',
+    'Which topics do the documents cover?',
+    'Explain how the gateway answers a question.',
+]
+
+
+def load_prompts(path):
+    """Read prompts from a JSON list of strings, or from a text file with one prompt per line."""
+    if path is None:
+        return list(PROMPTS)
+    with open(path, 'r', encoding='utf-8') as file:
+        if path.endswith('.json'):
+            return [str(prompt) for prompt in json.load(file)]
+        return [line.strip() for line in file if line.strip()]
+
+
+def get_body(endpoint, prompt, stream, args):
+    body = {'model': args.model, 'stream': stream, 'max_tokens': args.max_tokens}
+    if endpoint == 'chat':
+        body['messages'] = [{'role': 'user', 'content': prompt}]
+    else:
+        body['prompt'] = prompt
+    return body
+
+
+def get_text(endpoint, choice):
+    if endpoint == 'chat':
+        return (choice.get('delta') or choice.get('message') or {}).get('content') or ''
+    return choice.get('text') or ''
+
+
+async def send(client, endpoint, prompt, stream, args):
+    """Send one request, returning a sample of its status, latency and token timings."""
+    sample = {'endpoint': endpoint, 'stream': stream, 'status': None, 'error': None,
+              'latency': None, 'ttft': None, 'itl': [], 'tokens': 0}
+    body = get_body(endpoint, prompt, stream, args)
+    start = time.perf_counter()
+    try:
+        if not stream:
+            response = await client.post(ENDPOINTS[endpoint], json=body)
+            sample['status'] = response.status_code
+            if response.status_code == 200:
+                data = response.json()
+                usage = data.get('usage') or {}
+                # The gateway reports no usage, so fall back to counting words
+                sample['tokens'] = usage.get('completion_tokens') or len(get_text(endpoint, data['choices'][0]).split())
+        else:
+            async with client.stream('POST', ENDPOINTS[endpoint], json=body) as response:
+                sample['status'] = response.status_code
+                previous = None
+                async for line in response.aiter_lines():
+                    if not line.startswith('data: ') or line == 'data: [DONE]':
+                        continue
+                    choices = json.loads(line[len('data: '):]).get('choices') or [{}]
+                    if not get_text(endpoint, choices[0]):
+                        continue
+                    now = time.perf_counter()
+                    if previous is None:
+                        sample['ttft'] = now - start
+                    else:
+                        sample['itl'].append(now - previous)
+                    previous = now
+                    sample['tokens'] += 1
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        sample['error'] = f'{type(e).__name__}: {e}'
+
+    sample['latency'] = time.perf_counter() - start
+    if sample['status'] != 200 and sample['error'] is None:
+        sample['error'] = f'HTTP {sample["status"]}'
+    return sample
+
+
+def get_requests(prompts, endpoints, modes, count, unique):
+    """Cycle through every combination of prompt, endpoint and streaming mode, interleaving the endpoints."""
+    combinations = itertools.cycle(itertools.product(prompts, endpoints, modes))
+    for number, (prompt, endpoint, stream) in enumerate(itertools.islice(combinations, count)):
+        # A unique suffix defeats the response cache and request coalescing in the gateway
+        yield endpoint, (f'{prompt} ({number})' if unique else prompt), stream
+
+
+async def run(client, requests, concurrency=1, rate=None, args=None):
+    """Send the requests, either from a fixed number of concurrent clients or at a fixed rate.
+
+    At a fixed rate requests are sent on schedule however many are still waiting for a response, so a
+    slow service shows up as growing latency rather than a slower request rate.
+    """
+    samples = []
+
+    async def request(endpoint, prompt, stream):
+        samples.append(await send(client, endpoint, prompt, stream, args))
+
+    start = time.perf_counter()
+    if rate:
+        tasks = []
+        for number, item in enumerate(requests):
+            await asyncio.sleep(max(0.0, start + number / rate - time.perf_counter()))
+            tasks.append(asyncio.ensure_future(request(*item)))
+        await asyncio.gather(*tasks)
+    else:
+        queue = iter(requests)
+
+        async def worker():
+            for item in queue:
+                await request(*item)
+
+        await asyncio.gather(*(worker() for _ in range(max(concurrency, 1))))
+
+    return samples, time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    """Linearly interpolated percentile of the values, or None if there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def distribution(values, scale=1000.0):
+    """Summary of the values, in milliseconds by default."""
+    if not values:
+        return None
+    summary = {'mean': sum(values) / len(values)}
+    for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        summary[name] = percentile(values, fraction)
+    summary['max'] = max(values)
+    return {name: round(value * scale, 3) for name, value in summary.items()}
+
+
+def summarize(samples, duration):
+    """Aggregate samples into latency, time to first token, inter-token latency, throughput and errors."""
+    succeeded = [sample for sample in samples if sample['error'] is None]
+    errors = {}
+    for sample in samples:
+        if sample['error'] is not None:
+            errors[sample['error']] = errors.get(sample['error'], 0) + 1
+
+    tokens = sum(sample['tokens'] for sample in succeeded)
+    rates = [(sample['tokens'] - 1) / (sample['latency'] - sample['ttft']) for sample in succeeded
+             if sample['stream'] and sample['tokens'] > 1 and sample['latency'] > sample['ttft']]
+    return {
+        'requests': len(samples),
+        'errors': len(samples) - len(succeeded),
+        'error_rate': round((len(samples) - len(succeeded)) / len(samples), 4) if samples else 0.0,
+        'error_types': errors,
+        'duration_s': round(duration, 3),
+        'requests_per_second': round(len(succeeded) / duration, 3) if duration else None,
+        'tokens': tokens,
+        'tokens_per_second': round(tokens / duration, 3) if duration else None,
+        'latency_ms': distribution([sample['latency'] for sample in succeeded]),
+        'ttft_ms': distribution([sample['ttft'] for sample in succeeded if sample['ttft'] is not None]),
+        'itl_ms': distribution([gap for sample in succeeded for gap in sample['itl']]),
+        'stream_tokens_per_second': distribution(rates, scale=1.0),
+    }
+
+
+def report(samples, duration, settings=None):
+    """Summary of the whole run, followed by one for each endpoint and streaming mode."""
+    result = {'settings': settings or {}, 'overall': summarize(samples, duration), 'by_endpoint': {}}
+    for endpoint, stream in sorted({(sample['endpoint'], sample['stream']) for sample in samples}):
+        group = [sample for sample in samples if (sample['endpoint'], sample['stream']) == (endpoint, stream)]
+        result['by_endpoint'][f'{endpoint}{"-stream" if stream else ""}'] = summarize(group, duration)
+    return result
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Measure gateway latency and throughput under load')
+    parser.add_argument('--url', type=str,
+                        default=f'http://{config.Config.GATEWAY_HOST}:{config.Config.GATEWAY_PORT}',
+                        help='Base URL of the service under test (default: %(default)s)')
+    parser.add_argument('--endpoints', type=str, nargs='+', choices=list(ENDPOINTS), default=list(ENDPOINTS),
+                        help='Endpoints to send requests to (default: %(default)s)')
+    parser.add_argument('--stream', type=str, choices=['true', 'false', 'both'], default='both',
+                        help='Whether to request streaming responses (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='Number of requests to send (default: %(default)s)')
+    parser.add_argument('--warmup', type=int, default=0,
+                        help='Number of requests to send before measuring (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Number of requests in flight at once, when not sending at a fixed rate '
+                             '(default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Requests sent per second regardless of responses (default: closed loop)')
+    parser.add_argument('--prompts', type=str, default=None,
+                        help='JSON list or text file of prompts, one per line (default: built-in prompts)')
+    parser.add_argument('--unique', type=utils.str2bool, nargs='?', const=True, default=False,
+                        help='Make every prompt unique, so none are cached or coalesced (default: %(default)s)')
+    parser.add_argument('--model', type=str, default=config.Config.MODEL_DEFAULT,
+                        help='Model named in each request (default: %(default)s)')
+    parser.add_argument('--max_tokens', type=int, default=256,
+                        help='Maximum number of tokens requested per response (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=config.APIConfig.TIMEOUT,
+                        help='Seconds before a request is counted as an error (default: %(default)s)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='File to write the JSON report to, as well as printing it (default: %(default)s)')
+    parser.add_argument('--max_error_rate', type=float, default=None,
+                        help='Exit with an error if a larger fraction of requests fail, for use in CI '
+                             '(default: %(default)s)')
+    return parser.parse_args()
+
+
+async def benchmark(args, transport=None):
+    """Run the benchmark described by the arguments, over transport if given (such as an in-process app)."""
+    prompts = load_prompts(args.prompts)
+    modes = {'true': [True], 'false': [False], 'both': [False, True]}[args.stream]
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits,
+                                 transport=transport) as client:
+        if args.warmup:
+            await run(client, get_requests(prompts, args.endpoints, modes, args.warmup, True),
+                      args.concurrency, args=args)
+        requests = get_requests(prompts, args.endpoints, modes, args.requests, args.unique)
+        samples, duration = await run(client, requests, args.concurrency, args.rate, args=args)
+
+    settings = {name: getattr(args, name) for name in
+                ('url', 'endpoints', 'stream', 'requests', 'concurrency', 'rate', 'unique', 'max_tokens')}
+    return report(samples, duration, settings)
+
+
+def main():
+    args = parse_arguments()
+    result = asyncio.run(benchmark(args))
+
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(output + '\n')
+
+    if args.max_error_rate is not None and result['overall']['error_rate'] > args.max_error_rate:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+# retrieval.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import argparse
+import copy
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import client
+import config
+import utils
+
+try:
+    import llama_index
+    import llama_index.llms
+    from benchmarks import corpus
+    from benchmarks import load
+except ModuleNotFoundError as e:
+    print('\nError importing Python module(s)')
+    print('If installed using setup.sh it may be necessary to run:\n')
+    print('pyenv activate urcuchillay-env\n')
+    sys.exit(1)
+
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+class Benchmark(client.Client):
+    """Index a synthetic corpus into each storage type the way index.py does, then query it.
+
+    The LLM is never called and embeddings come from HashEmbedding, so the benchmark runs on a CPU-only
+    machine without a network connection.
+    """
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.args = args
+        self.embed_model = corpus.HashEmbedding(embed_dim=args.embed_dim, embed_batch_size=args.embed_batch_size)
+        self.llm = self.get_llm(args)
+        self.service_context = self.get_service_context(self.llm, args)
+
+    def get_llm(self, args):
+        return llama_index.llms.MockLLM()
+
+    def get_service_context(self, llm, args):
+        return llama_index.ServiceContext.from_defaults(
+            llm=llm, embed_model=self.embed_model, callback_manager=self.callback_manager)
+
+    def run(self, path):
+        documents = corpus.Corpus(documents=self.args.documents, paragraphs=self.args.paragraphs,
+                                  words=self.args.words, seed=self.args.seed)
+        data_path = os.path.join(path, 'data')
+        documents.write(data_path)
+        queries = documents.queries(self.args.queries)
+
+        result = {'embedding': self.measure_embedding(data_path), 'storage': {}}
+        for storage_type in self.args.storage_types:
+            result['storage'][storage_type] = self.measure_storage(storage_type, data_path, path, queries)
+        return result
+
+    def measure_embedding(self, data_path):
+        """Embedding throughput over the nodes of the corpus, without any storage."""
+        documents = llama_index.SimpleDirectoryReader(data_path).load_data()
+        texts = [node.get_content(metadata_mode='embed') for node in
+                 self.service_context.node_parser.get_nodes_from_documents(documents)]
+
+        start = time.perf_counter()
+        self.embed_model.get_text_embedding_batch(texts)
+        elapsed = time.perf_counter() - start
+        return {
+            'texts': len(texts),
+            'seconds': round(elapsed, 4),
+            'texts_per_second': round(len(texts) / elapsed, 1),
+            'words_per_second': round(sum(len(text.split()) for text in texts) / elapsed, 1),
+        }
+
+    def measure_storage(self, storage_type, data_path, path, queries):
+        args = copy.copy(self.args)
+        args.data = data_path
+        args.storage = os.path.join(path, storage_type)
+        args.load = False
+        args.incremental = False
+
+        # Ingest and save, as index.py does
+        start = time.perf_counter()
+        self.index = self.get_index(self.service_context, args, storage_type=storage_type)
+        ingest = time.perf_counter() - start
+        start = time.perf_counter()
+        self.save_index(args, storage_type=storage_type)
+        persist = time.perf_counter() - start
+        nodes = self.count_nodes(self.index)
+
+        # Load from disk, as the gateway does at startup
+        self.index = None
+        self.reopen_db()
+        args.load = True
+        rss = get_rss()
+        tracemalloc.start()
+        start = time.perf_counter()
+        self.index = self.get_index(self.service_context, args, storage_type=storage_type)
+        loading = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rss_growth = get_rss() - rss if rss is not None else None
+
+        # Some stores only read their vectors on first use, so the first query is reported separately
+        retriever = self.index.as_retriever(similarity_top_k=min(self.args.top_k))
+        start = time.perf_counter()
+        retriever.retrieve(queries[0])
+        first_query = time.perf_counter() - start
+
+        # The BM25 index of hybrid retrieval is built from the loaded store as index.py builds it
+        start = time.perf_counter()
+        lexical_index = self.update_lexical_index(self.index, args, storage_type=storage_type)
+        lexical_build = time.perf_counter() - start
+
+        return {
+            'nodes': nodes,
+            'ingest_seconds': round(ingest, 4),
+            'ingest_nodes_per_second': round(nodes / ingest, 1),
+            'ingest_documents_per_second': round(self.args.documents / ingest, 1),
+            'persist_seconds': round(persist, 4),
+            'storage_bytes': get_size(args.storage),
+            'load_seconds': round(loading, 4),
+            'load_peak_python_bytes': peak,
+            'load_rss_growth_bytes': rss_growth,
+            'first_query_ms': round(1000 * first_query, 3),
+            'query_ms': {f'top_k={top_k}': self.measure_queries(top_k, queries) for top_k in self.args.top_k},
+            'lexical_build_seconds': round(lexical_build, 4),
+            'lexical_bytes': os.path.getsize(os.path.join(args.storage, config.Config.LEXICAL_FILE)),
+            'lexical_query_ms': self.measure_lexical(lexical_index, queries),
+        }
+
+    def measure_queries(self, top_k, queries):
+        retriever = self.index.as_retriever(similarity_top_k=top_k)
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            retriever.retrieve(query)
+            latencies.append(time.perf_counter() - start)
+        return load.distribution(latencies)
+
+    @staticmethod
+    def measure_lexical(lexical_index, queries):
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            lexical_index.search(query, config.Config.HYBRID_CANDIDATES)
+            latencies.append(time.perf_counter() - start)
+        return load.distribution(latencies)
+
+    @staticmethod
+    def count_nodes(index):
+        collection = index.vector_store.client
+        return collection.count() if collection is not None else len(index.index_struct.nodes_dict)
+
+
+def get_rss():
+    """Resident memory of this process in bytes, where /proc is available."""
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def get_size(path):
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, names in os.walk(path) for name in names)
+
+
+def get_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               text=True, check=True).stdout.strip()
+        return f'{commit}-dirty' if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def flatten(result, prefix=''):
+    """Numeric results keyed by their path, such as storage.json.load_seconds."""
+    values = {}
+    for key, value in result.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            values.update(flatten(value, f'{name}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+
+def compare(baseline, result):
+    """Print each measurement next to the baseline, with the relative change."""
+    before = flatten(baseline['results'])
+    after = flatten(result['results'])
+    print(f'{"measurement":<60} {baseline["commit"]:>14} {result["commit"]:>14} {"change":>9}')
+    for name, value in after.items():
+        previous = before.get(name)
+        if previous is None:
+            print(f'{name:<60} {"":>14} {value:>14} {"":>9}')
+        else:
+            change = f'{(value - previous) / previous:+.1%}' if previous else ''
+            print(f'{name:<60} {previous:>14} {value:>14} {change:>9}')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Measure ingestion, embedding, storage and retrieval performance')
+    parser = utils.parse_arguments_common(parser)
+
+    parser.add_argument('--documents', type=int, default=200,
+                        help='Number of documents in the synthetic corpus (default: %(default)s)')
+    parser.add_argument('--paragraphs', type=int, default=5,
+                        help='Number of paragraphs per document (default: %(default)s)')
+    parser.add_argument('--words', type=int, default=80,
+                        help='Number of words per paragraph (default: %(default)s)')
+    parser.add_argument('--queries', type=int, default=100,
+                        help='Number of queries timed for each similarity_top_k (default: %(default)s)')
+    parser.add_argument('--top_k', type=int, nargs='+', default=[1, 2, 5, 10],
+                        help='Values of similarity_top_k to time queries with (default: %(default)s)')
+    parser.add_argument('--storage_types', type=str, nargs='+', choices=config.Config.STORAGE_TYPES,
+                        default=config.Config.STORAGE_TYPES,
+                        help='Vector stores to measure (default: %(default)s)')
+    parser.add_argument('--embed_dim', type=int, default=384,
+                        help='Number of dimensions of the hashed embeddings (default: %(default)s)')
+    parser.add_argument('--workers', dest='ingest_workers', type=int, default=config.Config.INGEST_WORKERS,
+                        help='Number of processes used to parse and split files, 0 to disable (default: %(default)s)')
+    parser.add_argument('--batch_size', type=int, default=config.Config.INGEST_BATCH_SIZE,
+                        help='Number of nodes embedded and inserted per batch (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for generating the corpus and queries (default: %(default)s)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='File to write the results to (default: results/retrieval-<commit>.json)')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Results of an earlier run to compare against (default: %(default)s)')
+
+    args = parser.parse_args()
+    args = utils.update_arguments_common(args)
+    return args
+
+
+def main():
+    args = parse_arguments()
+
+    with tempfile.TemporaryDirectory(prefix='urcuchillay-benchmark-') as path:
+        results = Benchmark(args).run(path)
+
+    result = {
+        'commit': get_commit(),
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {name: getattr(args, name) for name in
+                     ('documents', 'paragraphs', 'words', 'queries', 'top_k', 'embed_dim', 'ingest_workers',
+                      'batch_size', 'seed')},
+        'results': results,
+    }
+
+    output = args.output or os.path.join(RESULTS_PATH, f'retrieval-{result["commit"]}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(result, file, indent=2)
+        file.write('\n')
+
+    print(json.dumps(result, indent=2))
+    print(f'Results written to {output}')
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            compare(json.load(file), result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+# stub.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import struct
+import sys
+import time
+
+import config
+
+try:
+    import fastapi
+    import uvicorn
+except ModuleNotFoundError as e:
+    print('\nError importing Python module(s)')
+    print('If installed using setup.sh it may be necessary to run:\n')
+    print('pyenv activate urcuchillay-env\n')
+    sys.exit(1)
+
+WORDS = ('the', 'llama', 'answers', 'from', 'local', 'documents', 'with', 'context', 'and', 'care')
+
+
+def get_tokens(count):
+    return [f'{WORDS[i % len(WORDS)]} ' for i in range(count)]
+
+
+def get_embedding(text, dimensions):
+    """Deterministic unit vector for the text, so identical texts retrieve identical nodes."""
+    values = []
+    counter = 0
+    while len(values) < dimensions:
+        digest = hashlib.sha256(f'{counter}:{text}'.encode('utf-8')).digest()
+        values.extend(byte / 127.5 - 1.0 for byte in digest)
+        counter += 1
+    values = values[:dimensions]
+    norm = sum(value * value for value in values) ** 0.5 or 1.0
+    return [value / norm for value in values]
+
+
+def create_app(tokens=64, first_token_delay=0.05, token_delay=0.01, embed_dim=384):
+    """OpenAI compatible stand-in for server.py, answering without a model so the gateway can be benchmarked.
+
+    Responses are a fixed number of tokens produced at a fixed rate, and embeddings are derived from a hash
+    of the text, so runs are repeatable and only the overhead of the gateway itself varies.
+    """
+    app = fastapi.FastAPI()
+    state = {'requests': 0}
+
+    def usage(completion_tokens):
+        return {'prompt_tokens': 0, 'completion_tokens': completion_tokens, 'total_tokens': completion_tokens}
+
+    async def generate(chunk):
+        """Yield server-sent events for each token, pausing as a model would."""
+        created = int(time.time())
+        await asyncio.sleep(first_token_delay)
+        for index, token in enumerate(get_tokens(tokens)):
+            if index:
+                await asyncio.sleep(token_delay)
+            finish_reason = 'stop' if index == tokens - 1 else None
+            data = {'id': 'cmpl-stub', 'created': created, 'model': 'stub', **chunk(token, finish_reason)}
+            yield f'data: {json.dumps(data)}\n\n'
+        yield 'data: [DONE]\n\n'
+
+    async def complete():
+        await asyncio.sleep(first_token_delay + token_delay * max(tokens - 1, 0))
+        return ''.join(get_tokens(tokens))
+
+    @app.get('/v1/models')
+    async def models():
+        return {'object': 'list', 'data': [{'id': 'stub', 'object': 'model', 'owned_by': 'urcuchillay'}]}
+
+    @app.get('/stats')
+    async def stats():
+        return state
+
+    @app.post('/v1/completions')
+    async def completions(request: fastapi.Request):
+        body = await request.json()
+        state['requests'] += 1
+        if body.get('stream'):
+            return fastapi.responses.StreamingResponse(generate(lambda token, finish_reason: {
+                'object': 'text_completion',
+                'choices': [{'text': token, 'index': 0, 'logprobs': None, 'finish_reason': finish_reason}],
+            }), media_type='text/event-stream')
+
+        return {
+            'id': 'cmpl-stub', 'object': 'text_completion', 'created': int(time.time()), 'model': 'stub',
+            'choices': [{'text': await complete(), 'index': 0, 'logprobs': None, 'finish_reason': 'length'}],
+            'usage': usage(tokens),
+        }
+
+    @app.post('/v1/chat/completions')
+    async def chat_completions(request: fastapi.Request):
+        body = await request.json()
+        state['requests'] += 1
+        if body.get('stream'):
+            return fastapi.responses.StreamingResponse(generate(lambda token, finish_reason: {
+                'object': 'chat.completion.chunk',
+                'choices': [{'delta': {'role': 'assistant', 'content': token}, 'index': 0,
+                             'finish_reason': finish_reason}],
+            }), media_type='text/event-stream')
+
+        return {
+            'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': int(time.time()), 'model': 'stub',
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': await complete()},
+                         'finish_reason': 'stop'}],
+            'usage': usage(tokens),
+        }
+
+    @app.post('/v1/embeddings')
+    async def embeddings(request: fastapi.Request):
+        body = await request.json()
+        inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+        data = []
+        for index, text in enumerate(inputs):
+            embedding = get_embedding(json.dumps(text), embed_dim)
+            if body.get('encoding_format') == 'base64':
+                embedding = base64.b64encode(struct.pack(f'<{len(embedding)}f', *embedding)).decode('ascii')
+            data.append({'object': 'embedding', 'index': index, 'embedding': embedding})
+        return {'object': 'list', 'data': data, 'model': body.get('model', 'stub'), 'usage': usage(0)}
+
+    return app
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Serve a stub OpenAI compatible API for benchmarking the gateway')
+    parser.add_argument('--api_host', '--openai_host', type=str, default=config.APIConfig.API_HOST,
+                        help='Hostname or IP address to listen on (default: %(default)s)')
+    parser.add_argument('--api_port', '--openai_port', type=int, default=config.APIConfig.API_PORT,
+                        help='Port to listen on (default: %(default)s)')
+    parser.add_argument('--tokens', type=int, default=64,
+                        help='Number of tokens in every response (default: %(default)s)')
+    parser.add_argument('--first_token_delay', type=float, default=0.05,
+                        help='Seconds before the first token, as if processing the prompt (default: %(default)s)')
+    parser.add_argument('--token_delay', type=float, default=0.01,
+                        help='Seconds between tokens (default: %(default)s)')
+    parser.add_argument('--embed_dim', type=int, default=384,
+                        help='Number of dimensions of the embeddings (default: %(default)s)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    app = create_app(tokens=args.tokens, first_token_delay=args.first_token_delay, token_delay=args.token_delay,
+                     embed_dim=args.embed_dim)
+    uvicorn.run(app, host=args.api_host, port=args.api_port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+# cache.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import collections
+import threading
+import time
+
+import numpy
+
+
+class LRUCache:
+    """Thread-safe least recently used cache whose entries expire after a time to live (in seconds)."""
+
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or self.is_expired(entry):
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def values(self):
+        """Snapshot of the values which have not expired, least recently used first."""
+        with self.lock:
+            return [entry[1] for entry in self.entries.values() if not self.is_expired(entry)]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def is_expired(self, entry):
+        return self.ttl is not None and time.monotonic() - entry[0] > self.ttl
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'entries': len(self.entries),
+        }
+
+
+class SimilarityCache:
+    """Thread-safe least recently used cache of values found by the cosine similarity of their embeddings.
+
+    Unit embeddings are kept as the rows of a matrix allocated once, when the first embedding gives its dimension,
+    so a lookup is a single product with that matrix. Each entry belongs to a scope and only matches lookups
+    within the same scope.
+    """
+
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.reset()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def reset(self):
+        self.slots = collections.OrderedDict()  # Row of each key, least recently used first
+        self.free = list(range(self.max_entries - 1, -1, -1))
+        self.matrix = None
+        self.keys = [None] * self.max_entries
+        self.values = [None] * self.max_entries  # Scope and value of each row
+        self.scopes = numpy.full(self.max_entries, -1, dtype=numpy.int64)  # Scope id of each row, -1 when free
+        self.times = numpy.zeros(self.max_entries)
+        self.scope_ids = {}  # Scope -> (id, number of rows)
+        self.next_scope_id = 0
+
+    def get(self, scope, embedding, similarity):
+        """Value of the entry most similar to the unit embedding within the scope, if at least the similarity."""
+        with self.lock:
+            if scope not in self.scope_ids or self.matrix is None or len(embedding) != self.matrix.shape[1]:
+                return None
+
+            similarities = self.matrix @ embedding
+            similarities[self.scopes != self.scope_ids[scope][0]] = -numpy.inf
+            if self.ttl is not None:
+                similarities[self.times < time.monotonic() - self.ttl] = -numpy.inf
+            row = int(numpy.argmax(similarities))
+            if similarities[row] < similarity:
+                return None
+
+            self.slots.move_to_end(self.keys[row])
+            return self.values[row][1]
+
+    def put(self, key, scope, embedding, value):
+        with self.lock:
+            if self.matrix is None or len(embedding) != self.matrix.shape[1]:
+                # Embeddings of another dimension come from another model, and never match those cached
+                self.reset()
+                self.matrix = numpy.zeros((self.max_entries, len(embedding)), dtype=numpy.float32)
+
+            row = self.slots.pop(key, None)
+            if row is None:
+                row = self.free.pop() if self.free else self.slots.popitem(last=False)[1]
+            if self.keys[row] is not None:
+                self.release(row)
+
+            scope_id, rows = self.scope_ids.get(scope, (self.next_scope_id, 0))
+            if rows == 0:
+                self.next_scope_id += 1
+            self.scope_ids[scope] = (scope_id, rows + 1)
+
+            self.slots[key] = row
+            self.keys[row] = key
+            self.values[row] = (scope, value)
+            self.matrix[row] = embedding
+            self.scopes[row] = scope_id
+            self.times[row] = time.monotonic()
+
+    def release(self, row):
+        # Scopes are forgotten with their last row, so ever changing scopes do not accumulate
+        scope = self.values[row][0]
+        scope_id, rows = self.scope_ids[scope]
+        if rows == 1:
+            del self.scope_ids[scope]
+        else:
+            self.scope_ids[scope] = (scope_id, rows - 1)
+        self.keys[row] = None
+        self.values[row] = None
+        self.scopes[row] = -1
+
+    def clear(self):
+        with self.lock:
+            self.reset()
+
+
+class SemanticCache:
+    """Two tier cache of results keyed by prompt, such as generated responses or retrieved nodes.
+
+    The exact tier matches a normalized prompt within a scope (such as the model, temperature and index
+    generation). The optional semantic tier matches a query embedding within the same scope whose cosine
+    similarity to a cached query is at least the similarity threshold.
+    """
+
+    def __init__(self, max_entries, ttl=None, similarity=None):
+        self.exact = LRUCache(max_entries, ttl)
+        self.semantic = SimilarityCache(max_entries, ttl) if similarity is not None else None
+        self.similarity = similarity
+
+        self.semantic_hits = 0
+
+    @staticmethod
+    def normalize(prompt):
+        return ' '.join(str(prompt).lower().split())
+
+    def get(self, scope, prompt):
+        return self.exact.get((scope, self.normalize(prompt)))
+
+    def get_similar(self, scope, embedding):
+        if self.semantic is None or embedding is None:
+            return None
+
+        response = self.semantic.get(scope, self.unit(embedding), self.similarity)
+        if response is not None:
+            self.semantic_hits += 1
+        return response
+
+    def put(self, scope, prompt, response, embedding=None):
+        key = (scope, self.normalize(prompt))
+        self.exact.put(key, response)
+        if self.semantic is not None and embedding is not None:
+            self.semantic.put(key, scope, self.unit(embedding), response)
+
+    def clear(self):
+        self.exact.clear()
+        if self.semantic is not None:
+            self.semantic.clear()
+
+    @staticmethod
+    def unit(embedding):
+        vector = numpy.asarray(embedding, dtype=numpy.float32)
+        norm = numpy.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def stats(self):
+        stats = self.exact.stats()
+        lookups = stats['hits'] + stats['misses']
+        stats['semantic_hits'] = self.semantic_hits
+        stats['hit_ratio'] = (stats['hits'] + self.semantic_hits) / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,66 @@
+# callbacks.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import collections
+import threading
+import time
+
+import llama_index.callbacks
+
+import timings
+
+
+class TimingHandler(llama_index.callbacks.base_handler.BaseCallbackHandler):
+    """Callback handler recording how long each LlamaIndex stage (retrieve, embedding, llm, ...) takes.
+
+    Durations are observed in a histogram across all requests, and added to the timings of the request
+    current when the stage started. Only start times of events in progress are kept, unlike
+    LlamaDebugHandler which keeps every event, so it is cheap enough to leave on. Events nested inside one
+    of the same type, such as a cached retriever calling the retriever it wraps, are counted once.
+    """
+
+    MAX_EVENTS = 10000  # Streams abandoned part way never end their events, so forget the oldest
+
+    def __init__(self, histogram):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self.histogram = histogram
+        self.events = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def on_event_start(self, event_type, payload=None, event_id='', parent_id='', **kwargs):
+        # LLM streams end on whichever thread consumes them, so the request is remembered from the start
+        request_timings = timings.current.get()
+        stage = timings.STAGES.get(event_type.value)
+        with self.lock:
+            parent = self.events.get(parent_id)
+            if parent is not None and parent[0] == event_type:
+                # Kept without a start time, so events nested any deeper are recognized as well
+                self.events[event_id] = (event_type, None, None)
+            else:
+                self.events[event_id] = (event_type, time.perf_counter(), request_timings)
+                if request_timings is not None and stage is not None:
+                    request_timings.begin(stage)
+            while len(self.events) > self.MAX_EVENTS:
+                self.events.popitem(last=False)
+        return event_id
+
+    def on_event_end(self, event_type, payload=None, event_id='', **kwargs):
+        with self.lock:
+            event = self.events.pop(event_id, None)
+        if event is None or event[1] is None:
+            return
+
+        _, start, request_timings = event
+        elapsed = time.perf_counter() - start
+        self.histogram.observe(elapsed, event_type.value)
+        stage = timings.STAGES.get(event_type.value)
+        if request_timings is not None and stage is not None:
+            request_timings.add(stage, elapsed)
+
+    def start_trace(self, trace_id=None):
+        pass
+
+    def end_trace(self, trace_id=None, trace_map=None):
+        pass
@@ -0,0 +1,63 @@
+# cancellation.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import contextlib
+import contextvars
+import threading
+
+# Cancellation of the request which the generation started in this context is serving
+current = contextvars.ContextVar('cancellation', default=None)
+
+
+class Cancellation(threading.Event):
+    """Event set once nobody is waiting for a response any more.
+
+    It also records the responses streaming from the API server on behalf of the request, so they can be
+    closed. Closing the connection is what makes the API server stop generating.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.responses = []
+
+    def close(self):
+        while self.responses:
+            self.responses.pop().close()
+
+
+@contextlib.contextmanager
+def scope(cancelled):
+    """Make generation started within this block stop once cancelled."""
+    token = current.set(cancelled)
+    try:
+        yield cancelled
+    finally:
+        current.reset(token)
+
+
+def track(response):
+    """httpx response hook recording the response with the current cancellation, if any."""
+    cancelled = current.get()
+    if cancelled is not None:
+        cancelled.responses.append(response)
+
+
+def guard(generator, cancelled):
+    """Relay a generator until cancelled, then close it along with its responses from the API server.
+
+    Cancellation is checked between items, so a stream stops at its next token. The generator may run on
+    a thread of its own, so the cancellation is made current while it advances for track() to find.
+    """
+    sentinel = object()
+    try:
+        while not cancelled.is_set():
+            with scope(cancelled):
+                item = next(generator, sentinel)
+            if item is sentinel:
+                break
+            yield item
+    finally:
+        generator.close()
+        cancelled.close()
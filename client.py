@@ -2,32 +2,26 @@
 # Copyright (c) 2023-2024 Steve Castellotti
 # This file is part of Urcuchillay and is released under the MIT License.
 # See LICENSE file in the project root for full license information.
+import functools
 import logging
 import os
-import sys
 
 import config
+import ingest
+import utils
 
-try:
-    import chromadb
-    import llama_index
-    import llama_index.vector_stores
-    import transformers
-    import utils
-except ModuleNotFoundError as e:
-    print('\nError importing Python module(s)')
-    print('If installed using setup.sh it may be necessary to run:\n')
-    print('pyenv activate urcuchillay-env\n')
-    sys.exit(1)
+# LlamaIndex, ChromaDB and Transformers take seconds to import, so they are imported where they are used
+# and options such as --help and --reset which never need them return straight away
+utils.require_modules('chromadb', 'llama_index', 'transformers')
 
 
 class Client:
     def __init__(self, args):
 
         self.debug = args.debug
-
-        llama_debug = llama_index.callbacks.LlamaDebugHandler(print_trace_on_end=self.debug)
-        self.callback_manager = llama_index.callbacks.CallbackManager([llama_debug])
+        self.profile = utils.StartupProfile(getattr(args, 'profile_startup', False))
+        self.profile.mark('imports and arguments')
+        self._callback_manager = None
 
         # Fallback settings for api_base, api_key, and api_version
         os.environ['OPENAI_API_BASE'] = config.APIConfig.get_openai_api_base(host=args.api_host, port=args.api_port)
@@ -35,21 +29,48 @@ class Client:
         os.environ['OPENAI_API_VERSION'] = config.APIConfig.OPENAI_API_VERSION
 
         # Set Parallel Iterator
-        os.environ['TOKENIZERS_PARALLELISM'] = 'true' if config.Config.TOKENIZERS_PARALLELISM else 'false'
+        tokenizers_parallelism = getattr(args, 'tokenizers_parallelism', config.Config.TOKENIZERS_PARALLELISM)
+        os.environ['TOKENIZERS_PARALLELISM'] = 'true' if tokenizers_parallelism else 'false'
 
-        # ChromaDB Settings
         self.db = None
-        self.chromadb_settings = chromadb.config.Settings(
-            anonymized_telemetry=config.Config.ANONYMIZED_TELEMETRY,
-            allow_reset=config.Config.ALLOW_RESET,
-        )
 
         self.llm = None
         self.service_context = None
         self.index = None
 
+    @property
+    def callback_manager(self):
+        if self._callback_manager is None:
+            import llama_index.callbacks
+
+            # LlamaDebugHandler keeps every event for tracing, so it is only worth its memory when debugging
+            handlers = [llama_index.callbacks.LlamaDebugHandler(print_trace_on_end=True)] if self.debug else []
+            self._callback_manager = llama_index.callbacks.CallbackManager(handlers)
+        return self._callback_manager
+
+    def import_modules(self):
+        """Import LlamaIndex ahead of building anything with it, so the profile reports the time separately."""
+        import llama_index
+        self.profile.mark('import llama_index')
+
+    def get_db(self, path):
+        if not self.db:
+            import chromadb
+            import chromadb.config
+
+            self.db = chromadb.PersistentClient(
+                settings=chromadb.config.Settings(
+                    anonymized_telemetry=config.Config.ANONYMIZED_TELEMETRY,
+                    allow_reset=config.Config.ALLOW_RESET,
+                ),
+                path=path
+            )
+        return self.db
+
     def get_llm(self, args):
-        return llama_index.llms.OpenAI(
+        import llms
+
+        return llms.CancellableOpenAI(
             model='text-davinci-003',
             temperature=args.temperature,
             max_tokens=args.context,
@@ -62,6 +83,9 @@ class Client:
         )
 
     def get_service_context(self, llm, args):
+        import embedding
+        import llama_index
+
         embed_model = config.Config.EMBED_MODEL_NAME
         if hasattr(args, 'embed_model_name'):
             if args.embed_model_name == 'default' or args.embed_model_name == 'local':
@@ -69,8 +93,12 @@ class Client:
             else:
                 if hasattr(args, 'embed_model_provider'):
                     # use Huggingface embeddings
-                    embed_model = llama_index.embeddings.HuggingFaceEmbedding(
-                        model_name=args.embed_model_provider + '/' + args.embed_model_name)
+                    embed_model = embedding.BatchedHuggingFaceEmbedding.from_args(
+                        args.embed_model_provider + '/' + args.embed_model_name, args)
+
+        if getattr(args, 'embed_cache', False):
+            # Reuse embeddings of unchanged text across runs, shared by index.py, prompt.py and gateway.py
+            embed_model = embedding.CachedEmbedding.from_args(embed_model, args)
 
         return llama_index.ServiceContext.from_defaults(
             llm=llm,
@@ -81,43 +109,150 @@ class Client:
         )
 
     def get_index(self, service_context, args, storage_type=config.Config.STORAGE_TYPE):
-        if storage_type == 'json' and self.index:
-            return self.get_index(service_context, args)
+        if storage_type == 'json':
+            return self.get_index_json(service_context, args)
         elif storage_type == 'chromadb':
             return self.get_index_chroma(service_context, args)
+        elif storage_type == 'numpy':
+            return self.get_index_numpy(service_context, args)
         else:
             return None
 
     def save_index(self, args, storage_type=config.Config.STORAGE_TYPE):
         if storage_type == 'json' and self.index:
-            self.index.storage_context.persist(persist_dir=args.storage)
+            import snapshot
+
+            snapshot.save(self.index.storage_context, args.storage)
+            # The snapshot supersedes any JSON files persisted by earlier versions
+            utils.storage_reset(storage_path=args.storage)
         elif storage_type == 'chromadb':
             # For ChromaDB, storage is already written to disk
             # as part of the loading data process
             pass
+        elif storage_type == 'numpy' and self.index:
+            self.index.vector_store.persist(args.storage)
 
     def reset_index(self, args):
         logging.warning('resetting index')
+        ingest.Manifest.remove(args.storage)
+        utils.storage_reset(storage_path=args.storage, files=[config.Config.LEXICAL_FILE])
+        self.reset_embed_cache(args)
         if config.Config.STORAGE_TYPE == 'json':
-            utils.storage_reset(storage_path=args.storage)
+            utils.storage_reset(storage_path=args.storage,
+                                files=config.Config.STORAGE_FILES + [config.Config.SNAPSHOT_FILE])
         elif config.Config.STORAGE_TYPE == 'chromadb':
-            if not self.db:
-                self.db = chromadb.PersistentClient(
-                    settings=self.chromadb_settings,
-                    path=args.storage
-                )
-            self.db.reset()
+            self.get_db(args.storage).reset()
             self.reset_chroma_collection()
-            self.service_context = self.get_service_context(self.llm, args)
-            self.index = self.get_index(self.service_context, args)
+            if self.index is not None:
+                # Replace the index being served with the new empty one
+                self.service_context = self.get_service_context(self.llm, args)
+                self.index = self.get_index(self.service_context, args)
+        elif config.Config.STORAGE_TYPE == 'numpy':
+            utils.storage_reset(storage_path=args.storage, files=config.Config.NUMPY_STORAGE_FILES)
+            if self.index is not None:
+                self.index = self.get_index(self.service_context, args)
+
+    def reset_embed_cache(self, args):
+        """Forget cached embeddings, which may come from a different model served under the same name."""
+        if self.service_context is not None:
+            # LlamaIndex is already loaded along with the service context
+            import embedding
+
+            if isinstance(self.service_context.embed_model, embedding.CachedEmbedding):
+                # Already open in this process, so its rows are deleted rather than the file beneath it
+                self.service_context.embed_model.cache.clear()
+                return
+        utils.storage_reset(storage_path=args.storage, files=config.Config.EMBED_CACHE_FILES)
+
+    def reopen_db(self):
+        """Discard the cached ChromaDB client so the next access reads the latest state from disk."""
+        import chromadb.api.client
+
+        chromadb.api.client.SharedSystemClient.clear_system_cache()
+        self.db = None
 
     @staticmethod
-    def get_index_json(service_context, args):
-        if args.load and all(os.path.exists(os.path.join(args.storage, filename))
-                             for filename in config.Config.STORAGE_FILES):
-            # load vector index from storage
-            storage_context = llama_index.StorageContext.from_defaults(persist_dir=args.storage)
-            return llama_index.load_index_from_storage(storage_context, service_context=service_context)
+    def get_data_files(args):
+        """List the files under the data path which would be indexed."""
+        import llama_index
+
+        if not os.path.exists(args.data) or not os.listdir(args.data):
+            return []
+        return [str(path) for path in llama_index.SimpleDirectoryReader(args.data).input_files]
+
+    def update_index(self, index, args):
+        """Bring an existing index up to date with the data path, embedding only new or changed files."""
+        manifest = ingest.Manifest.load(args.storage)
+        added, changed, removed = manifest.scan(self.get_data_files(args))
+        logging.info(f'incremental index: {len(added)} added, {len(changed)} changed, {len(removed)} removed')
+
+        # Remove the vectors of files which were changed or deleted
+        for path in changed + removed:
+            for doc_id in manifest.discard(path):
+                index.delete_ref_doc(doc_id, delete_from_docstore=True)
+
+        self.ingest_files(index, added + changed, manifest, args)
+
+        manifest.save()
+        return index
+
+    @staticmethod
+    def ingest_files(index, paths, manifest, args):
+        """Read, split, embed and insert files into an index, across a process pool when workers are set."""
+        import llama_index
+
+        workers = getattr(args, 'ingest_workers', None)
+        if workers:
+            pipeline = ingest.Pipeline.from_service_context(index.service_context, workers, args.batch_size)
+            pipeline.run(index, paths, manifest)
+            pipeline.report()
+        else:
+            for path in paths:
+                documents = llama_index.SimpleDirectoryReader(input_files=[path]).load_data()
+                for document in documents:
+                    index.insert(document)
+                manifest.update(path, [document.doc_id for document in documents])
+
+    def build_index(self, service_context, args, storage_context=None):
+        """Create a new index from every file under the data path using the parallel pipeline."""
+        import llama_index
+
+        index = llama_index.VectorStoreIndex(
+            [], storage_context=storage_context, service_context=service_context)
+        manifest = ingest.Manifest(args.storage)
+        self.ingest_files(index, self.get_data_files(args), manifest, args)
+        manifest.save()
+        return index
+
+    @staticmethod
+    def save_manifest(documents, args):
+        """Record every file of a full build so a later incremental run only processes the differences."""
+        manifest = ingest.Manifest(args.storage)
+        doc_ids = {}
+        for document in documents:
+            doc_ids.setdefault(document.metadata.get('file_path'), []).append(document.doc_id)
+        for path, ids in doc_ids.items():
+            if path is not None and os.path.exists(path):
+                manifest.update(path, ids)
+        manifest.save()
+
+    def get_index_json(self, service_context, args):
+        import llama_index
+        import snapshot
+
+        storage_exists = snapshot.exists(args.storage) or all(os.path.exists(os.path.join(args.storage, filename))
+                                                              for filename in config.Config.STORAGE_FILES)
+        if (args.load or getattr(args, 'incremental', False)) and storage_exists:
+            if snapshot.exists(args.storage):
+                # Only the header is read, nodes and embeddings are read from the mapped snapshot as queries need them
+                storage_context = snapshot.load(args.storage)
+            else:
+                # JSON files persisted by earlier versions, replaced by a snapshot the next time the index is saved
+                storage_context = llama_index.StorageContext.from_defaults(persist_dir=args.storage)
+            index = llama_index.load_index_from_storage(storage_context, service_context=service_context)
+            if not args.load:
+                index = self.update_index(index, args)
+            return index
         else:
             if not os.path.exists(args.data) or not os.listdir(args.data):
                 # Create a temporary empty file for the index if a missing or empty data directory was supplied
@@ -126,44 +261,183 @@ class Client:
                 index = llama_index.VectorStoreIndex.from_documents(documents, service_context=service_context)
                 os.remove(temp_file)
                 return index
+            elif getattr(args, 'ingest_workers', None):
+                return self.build_index(service_context, args)
             else:
                 documents = llama_index.SimpleDirectoryReader(args.data).load_data()
-                return llama_index.VectorStoreIndex.from_documents(
+                index = llama_index.VectorStoreIndex.from_documents(
                     documents, service_context=service_context
                 )
+                self.save_manifest(documents, args)
+                return index
 
-    def get_index_chroma(self, service_context, args):
+    def get_chroma_collection(self, path):
+        """The collection holding the vectors, its HNSW graph built and searched as configured when created.
 
-        if not self.db:
-            self.db = chromadb.PersistentClient(
-                settings=self.chromadb_settings,
-                path=args.storage
-            )
+        ChromaDB keeps the HNSW parameters a collection was created with, so changing them takes a --reset.
+        """
+        hnsw = {
+            'hnsw:M': config.Config.HNSW_M,
+            'hnsw:construction_ef': config.Config.HNSW_CONSTRUCTION_EF,
+            'hnsw:search_ef': config.Config.HNSW_SEARCH_EF,
+        }
+        db = self.get_db(path)
+        try:
+            collection = db.get_collection('quickstart')
+        except ValueError:
+            # Passing metadata for an existing collection would overwrite it without changing its graph
+            return db.get_or_create_collection('quickstart', metadata=hnsw)
 
-        chroma_collection = self.db.get_or_create_collection('quickstart')
+        params = self.get_hnsw_params(collection)
+        changed = [key for key, value in hnsw.items() if params.get(key) != value]
+        if changed:
+            logging.warning(f'{", ".join(changed)} of the existing collection differ from the configuration, '
+                            f'reset the vector store to rebuild it: {params}')
+        return collection
+
+    @staticmethod
+    def get_hnsw_params(collection):
+        """The HNSW parameters the graph of a collection was created with and is searched with.
+
+        These are held by its vector segment, which the public API does not expose, rather than by the
+        metadata of the collection itself.
+        """
+        import chromadb.types
+
+        segments = collection._client._sysdb.get_segments(
+            collection=collection.id, scope=chromadb.types.SegmentScope.VECTOR)
+        metadata = segments[0]['metadata'] if segments else collection.metadata
+        params = {'hnsw:space': 'l2', 'hnsw:M': 16, 'hnsw:construction_ef': 100, 'hnsw:search_ef': 10}
+        params.update((key, value) for key, value in (metadata or {}).items() if key.startswith('hnsw:'))
+        return params
+
+    def get_index_chroma(self, service_context, args):
+        import llama_index
+        import llama_index.vector_stores
+
+        chroma_collection = self.get_chroma_collection(args.storage)
 
         # set up ChromaVectorStore and load in data
         vector_store = llama_index.vector_stores.ChromaVectorStore(chroma_collection=chroma_collection)
 
-        if args.load:
+        if args.load or getattr(args, 'incremental', False):
             # noinspection PyTypeChecker
             index = llama_index.VectorStoreIndex.from_vector_store(
                 vector_store,
                 service_context=service_context,
             )
+            if not args.load:
+                index = self.update_index(index, args)
         else:
             storage_context = llama_index.storage.storage_context.StorageContext.from_defaults(
                 vector_store=vector_store)
 
+            if getattr(args, 'ingest_workers', None):
+                return self.build_index(service_context, args, storage_context=storage_context)
+
             documents = llama_index.SimpleDirectoryReader(args.data).load_data()
             index = llama_index.VectorStoreIndex.from_documents(
                 documents, storage_context=storage_context, service_context=service_context
             )
+            self.save_manifest(documents, args)
 
         return index
 
+    @staticmethod
+    def get_numpy_settings(args):
+        return {
+            'dtype': config.Config.NUMPY_DTYPE,
+            'ann_index': config.Config.ANN_INDEX,
+            'ivf_lists': config.Config.IVF_LISTS,
+            'ivf_nprobe': config.Config.IVF_NPROBE,
+            'ivf_min_nodes': config.Config.IVF_MIN_NODES,
+            'quantization': getattr(args, 'quantization', config.Config.QUANTIZATION),
+            'rescore': config.Config.QUANTIZATION_RESCORE,
+        }
+
+    def get_index_numpy(self, service_context, args):
+        import llama_index
+        import vectors
+
+        if args.load or getattr(args, 'incremental', False):
+            # Only maps the stored files, the vectors and nodes are read as queries need them
+            vector_store = vectors.NumpyVectorStore.from_persist_dir(args.storage, **self.get_numpy_settings(args))
+            index = llama_index.VectorStoreIndex.from_vector_store(vector_store, service_context=service_context)
+            if not args.load:
+                index = self.update_index(index, args)
+            return index
+
+        storage_context = llama_index.StorageContext.from_defaults(
+            vector_store=vectors.NumpyVectorStore(**self.get_numpy_settings(args)))
+        if getattr(args, 'ingest_workers', None):
+            return self.build_index(service_context, args, storage_context=storage_context)
+
+        documents = llama_index.SimpleDirectoryReader(args.data).load_data()
+        index = llama_index.VectorStoreIndex.from_documents(
+            documents, storage_context=storage_context, service_context=service_context)
+        self.save_manifest(documents, args)
+        return index
+
+    def get_node_ids(self, index, storage_type=config.Config.STORAGE_TYPE):
+        """Ids of every node in the vector store of the index."""
+        if storage_type == 'json':
+            return list(index.index_struct.nodes_dict.values())
+        elif storage_type == 'chromadb':
+            return index.vector_store.client.get(include=[])['ids']
+        elif storage_type == 'numpy':
+            return index.vector_store.get_node_ids()
+        return []
+
+    def get_nodes(self, index, node_ids, storage_type=config.Config.STORAGE_TYPE):
+        """Nodes of the index with the given ids, in the same order, leaving out ids which are not stored."""
+        if not node_ids:
+            return []
+        if storage_type == 'json':
+            return [node for node in index.docstore.get_nodes(node_ids, raise_error=False) if node is not None]
+        elif storage_type == 'chromadb':
+            import llama_index.vector_stores.utils
+
+            result = index.vector_store.client.get(ids=list(node_ids), include=['documents', 'metadatas'])
+            nodes = {}
+            for node_id, text, metadata in zip(result['ids'], result['documents'], result['metadatas']):
+                nodes[node_id] = llama_index.vector_stores.utils.metadata_dict_to_node(metadata)
+                nodes[node_id].set_content(text)
+            return [nodes[node_id] for node_id in node_ids if node_id in nodes]
+        elif storage_type == 'numpy':
+            return index.vector_store.get_nodes(node_ids)
+        return []
+
+    def get_node_texts(self, index, storage_type, node_ids):
+        return [(node.node_id, node.get_content()) for node in self.get_nodes(index, node_ids, storage_type)]
+
+    def update_lexical_index(self, index, args, storage_type=config.Config.STORAGE_TYPE):
+        """Bring the BM25 index beside the vector store up to date with its nodes, tokenizing only new ones."""
+        import lexical
+
+        lexical_index, added, removed = lexical.LexicalIndex.update(
+            args.storage, self.get_node_ids(index, storage_type),
+            functools.partial(self.get_node_texts, index, storage_type),
+            k1=config.Config.BM25_K1, b=config.Config.BM25_B)
+        logging.info(f'lexical index: {added} added, {removed} removed, {lexical_index.count} nodes')
+        return lexical_index
+
+    @staticmethod
+    def load_lexical_index(args):
+        """The BM25 index saved beside the vector store when hybrid retrieval is enabled, otherwise None."""
+        if not getattr(args, 'hybrid', False):
+            return None
+
+        import lexical
+
+        lexical_index = lexical.LexicalIndex.load(args.storage, k1=config.Config.BM25_K1, b=config.Config.BM25_B)
+        if lexical_index is None:
+            logging.warning(f'no lexical index found at {args.storage}, run index.py to build one for hybrid retrieval')
+        return lexical_index
+
     @staticmethod
     def reset_chroma_collection():
+        import chromadb
+
         chroma_client = chromadb.EphemeralClient()
         for collection in chroma_client.list_collections():
             chroma_client.delete_collection(name=collection.name)
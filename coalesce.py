@@ -0,0 +1,121 @@
+# coalesce.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import asyncio
+
+
+class SingleFlight:
+    """De-duplicate identical concurrent work, so callers arriving while it runs share a single computation.
+
+    Keys are forgotten as soon as their computation finishes, so this never serves stale results; that is
+    left to the caches.
+    """
+
+    def __init__(self):
+        self.flights = {}
+
+        self.started = 0
+        self.joined = 0
+
+    def __len__(self):
+        return len(self.flights)
+
+    async def do(self, key, func):
+        """Await the result of func(), or of the identical call already in flight."""
+        future = self.flights.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func())
+            self.start(key, future, future)
+        else:
+            self.joined += 1
+
+        # One caller giving up must not cancel the computation for everyone else
+        return await asyncio.shield(future)
+
+    def stream(self, key, func):
+        """Iterate over the items of the async iterator func(), or subscribe to the identical one in flight."""
+        broadcast = self.flights.get(key)
+        if broadcast is None or broadcast.abandoned:
+            broadcast = Broadcast(func())
+            self.start(key, broadcast, broadcast.task)
+        else:
+            self.joined += 1
+        return broadcast.subscribe()
+
+    def start(self, key, flight, future):
+        self.flights[key] = flight
+        self.started += 1
+
+        def finish(_future):
+            self.flights.pop(key, None)
+
+        future.add_done_callback(finish)
+
+    def stats(self):
+        return {
+            'started': self.started,
+            'joined': self.joined,
+            'in_flight': len(self.flights),
+        }
+
+
+class Broadcast:
+    """Fan out the items of an async iterator to any number of subscribers.
+
+    Every item is kept until the source is exhausted, so a subscriber joining late still receives the
+    whole stream from the beginning, at its own pace. Once every subscriber has gone away before the end,
+    the source is cancelled.
+    """
+
+    def __init__(self, source):
+        self.items = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.abandoned = False
+        self.changed = asyncio.Condition()
+        self.task = asyncio.ensure_future(self.pump(source))
+
+    async def pump(self, source):
+        try:
+            async for item in source:
+                async with self.changed:
+                    self.items.append(item)
+                    self.changed.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            async with self.changed:
+                self.done = True
+                self.changed.notify_all()
+
+    def subscribe(self):
+        # Counted straight away, so the source is not cancelled before a new subscriber starts iterating
+        self.subscribers += 1
+        return self.iterate()
+
+    async def iterate(self):
+        position = 0
+        try:
+            while True:
+                async with self.changed:
+                    await self.changed.wait_for(lambda: position < len(self.items) or self.done)
+                    items = self.items[position:]
+                    done = self.done
+
+                for item in items:
+                    yield item
+                position += len(items)
+
+                if done and position == len(self.items):
+                    break
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done:
+                self.abandoned = True
+                self.task.cancel()
+
+        if self.error is not None:
+            raise self.error
@@ -92,6 +92,9 @@ class Config:
 
     GATEWAY_HOST = 'localhost'
     GATEWAY_PORT = 8080
+    GATEWAY_WORKERS = 4  # Worker threads for blocking retrieval and generation calls
+    GATEWAY_CONCURRENCY = 2  # Requests answered at once, the API server only progresses a few (0 for no limit)
+    GATEWAY_QUEUE_SIZE = 32  # Requests waiting for an answer before others are rejected with 429 Too Many Requests
 
     UI_HOST = 'localhost'
     UI_PORT = 3000
@@ -107,13 +110,23 @@ class Config:
     MODEL_DEFAULT = Models.MODEL_ALIASES['mistral-7b-instruct']
     MODEL_URL_DEFAULT = Models.MODELS[MODEL_DEFAULT]['url']
     EMBED_MODEL_NAME = 'default'
+    EMBED_BATCH_SIZE = 10  # llama_index.constants.DEFAULT_EMBED_BATCH_SIZE
+    EMBED_THREADS = 0  # torch intra-op threads for embedding (0 for the torch default)
+    EMBED_MAX_LENGTH = None  # Maximum tokens per embedded text (None for the model maximum)
+    EMBED_SORT_BY_LENGTH = True  # Batch texts of similar length together to reduce padding
+    EMBED_PIPELINE = False  # Tokenize the next batch while the model embeds the current one
+    EMBED_CACHE = True  # Persist embeddings keyed by model and chunk hash in the storage path
+    EMBED_CACHE_SIZE = 250000  # Least recently used embeddings are evicted beyond this many entries
+
+    INGEST_WORKERS = 0  # Processes used by index.py to parse and split files (0 to disable)
+    INGEST_BATCH_SIZE = 256  # Nodes embedded and inserted per batch by the parallel ingestion pipeline
 
     TOKENIZERS_PARALLELISM = False
 
     ANONYMIZED_TELEMETRY = False
     ALLOW_RESET = True
 
-    STORAGE_TYPES = ['json', 'chromadb']
+    STORAGE_TYPES = ['json', 'chromadb', 'numpy']
 
     STORAGE_TYPE = 'chromadb'
 
@@ -121,6 +134,33 @@ class Config:
         STORAGE_PATH = 'storage'
     elif STORAGE_TYPE == 'chromadb':
         STORAGE_PATH = 'chroma_db'
+    elif STORAGE_TYPE == 'numpy':
+        STORAGE_PATH = 'numpy_db'
+
+    NUMPY_DTYPE = 'float32'  # Precision of embeddings in the numpy vector store, float16 halves its size
+
+    # Approximate nearest neighbour search. ChromaDB always searches an HNSW graph, whose HNSW_ settings are
+    # fixed when its collection is created (index.py --reset to change them), while the numpy vector store
+    # searches exactly unless ANN_INDEX is set. Each can be set in config.json, and index.py --ann_report
+    # measures the recall
+    HNSW_M = 16  # chromadb hnsw:M, links per vector in the graph
+    HNSW_CONSTRUCTION_EF = 100  # chromadb hnsw:construction_ef, candidates considered while building the graph
+    HNSW_SEARCH_EF = 10  # chromadb hnsw:search_ef, candidates considered per query, more improves recall
+    ANN_INDEX = None  # Index persisted with the numpy vector store, None to search exactly or 'ivf'
+    IVF_MIN_NODES = 50000  # Smaller numpy vector stores are searched exactly, which is fast enough
+    IVF_LISTS = None  # Clusters the vectors are grouped into, None for the square root of their number
+    IVF_NPROBE = 16  # Clusters searched per query, more improves recall at the cost of latency
+    QUANTIZATION = None  # Compact codes the numpy vector store searches before re-scoring: None, 'int8' or 'binary'
+    QUANTIZATION_RESCORE = 4  # Multiple of top_k found with the codes and re-scored at full precision
+
+    # Hybrid retrieval. index.py keeps a BM25 index of the words of every node beside the vector store, and the
+    # gateway fuses its results with those of the vector search by reciprocal rank fusion, so exact identifiers
+    # such as part numbers are found even when their embeddings are not similar to the query
+    HYBRID_RETRIEVAL = True  # Build the lexical index with index.py and search it from the gateway
+    HYBRID_CANDIDATES = 20  # Nodes ranked by each of the vector and lexical searches before they are fused
+    RRF_K = 60  # Reciprocal rank fusion constant, larger values weigh lower ranks closer to the top ones
+    BM25_K1 = 1.2  # Saturation of the score of a term repeated within a node
+    BM25_B = 0.75  # Normalization of the score of a term by the length of the node, 0 to disable
 
     STORAGE_FILES = ['default__vector_store.json',
                      'docstore.json',
@@ -128,6 +168,22 @@ class Config:
                      'image__vector_store.json',
                      'index_store.json']
 
+    SNAPSHOT_FILE = 'index.snapshot'  # Written by snapshot.save for the json storage type, replacing STORAGE_FILES
+    LEXICAL_FILE = 'lexical.snapshot'  # Written by lexical.LexicalIndex beside every storage type
+    EMBED_CACHE_FILES = ['embeddings.sqlite',  # Written by embedding.EmbeddingCache, removed with the vector store
+                         'embeddings.sqlite-wal',
+                         'embeddings.sqlite-shm']
+
+    NUMPY_STORAGE_FILES = ['vector_store.json',  # Written by vectors.NumpyVectorStore
+                           'vectors.npy',
+                           'offsets.npy',
+                           'nodes.jsonl',
+                           'ids.json',
+                           'ivf_centroids.npy',
+                           'ivf_offsets.npy',
+                           'codes.npy',
+                           'codes_scale.npy']
+
     # https://docs.llamaindex.ai/en/stable/module_guides/deploying/chat_engines/usage_pattern.html#available-chat-modes
 
     # First generate a standalone question from conversation context and last message,
@@ -143,6 +199,22 @@ class Config:
     # Then pass the context along with prompt and user message to LLM to generate a response.
     # CHAT_MODE = "condense_plus_context"  # llama_index.chat_engine.types.ChatMode.CONDENSE_PLUS_CONTEXT
 
+    SIMILARITY_TOP_K = 2  # llama_index.constants.DEFAULT_SIMILARITY_TOP_K
+
+    COALESCE = True  # Answer identical concurrent gateway requests with a single retrieval and generation
+
+    RETRIEVAL_CACHE = True  # Reuse the nodes retrieved for repeated gateway queries
+    RETRIEVAL_CACHE_SIZE = 4096  # Least recently used retrievals are evicted beyond this many entries
+    RETRIEVAL_CACHE_TTL = None  # Seconds before a cached retrieval expires (None to never expire)
+    RETRIEVAL_CACHE_SIMILARITY = None  # Minimum cosine similarity for a semantic match (None for exact only)
+
+    RESPONSE_CACHE = False  # Serve repeated gateway prompts from a cache of earlier responses
+    RESPONSE_CACHE_SIZE = 1024  # Least recently used responses are evicted beyond this many entries
+    RESPONSE_CACHE_TTL = 3600  # Seconds before a cached response expires (None to never expire)
+    RESPONSE_CACHE_SIMILARITY = 0.95  # Minimum cosine similarity for a semantic match (None for exact only)
+
+    RESPONSE_TIMINGS = False  # Include a breakdown of gateway processing time in response bodies
+
 
 class APIConfig:
     API_HOST = 'localhost'  # llama_cpp.server.app.Settings.host
@@ -151,6 +223,10 @@ class APIConfig:
     OPENAI_API_KEY = 'xxxxxxxx'
     TIMEOUT = 60.0  # llama_index.llms.openai
     MAX_RETRIES = 3  # llama_index.llms.openai
+    CONNECT_TIMEOUT = 5.0  # Gateway proxy connection pool
+    MAX_CONNECTIONS = 100  # Gateway proxy connection pool
+    MAX_KEEPALIVE_CONNECTIONS = 20  # Gateway proxy connection pool
+    KEEPALIVE_EXPIRY = 30.0  # Gateway proxy connection pool
 
     @staticmethod
     def get_docker_openai_api_host(port=API_PORT):
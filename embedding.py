@@ -0,0 +1,363 @@
+# embedding.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import array
+import concurrent.futures
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import config
+import llama_index.embeddings
+import llama_index.embeddings.huggingface_utils
+import llama_index.embeddings.utils
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.callbacks import CBEventType, EventPayload
+from llama_index.embeddings.pooling import Pooling
+
+
+class EmbeddingCache:
+    """Persistent store of embeddings keyed by embedding model name and a hash of the embedded text.
+
+    Entries are kept in a SQLite database with their last access time, and the least recently used
+    entries are evicted once the number of entries exceeds the configured maximum.
+    """
+
+    FILENAME = 'embeddings.sqlite'
+    MAX_VARIABLES = 500  # Stay well below the SQLite limit on host parameters per statement
+
+    _caches = {}
+    _caches_lock = threading.Lock()
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS embeddings ('
+                'model TEXT NOT NULL, '
+                'hash TEXT NOT NULL, '
+                'embedding BLOB NOT NULL, '
+                'accessed REAL NOT NULL, '
+                'PRIMARY KEY (model, hash))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)')
+            self.entries = self.connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+    @classmethod
+    def open(cls, storage_path, max_entries):
+        """Return the cache for a storage path, shared by every embedding model in the process."""
+        path = os.path.abspath(os.path.join(storage_path, cls.FILENAME))
+        with cls._caches_lock:
+            cache = cls._caches.get(path)
+            if cache is None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                cache = cls(path, max_entries)
+                cls._caches[path] = cache
+            return cache
+
+    @staticmethod
+    def get_hash(kind, text):
+        # Queries and documents are embedded differently by some models (e.g. bge instructions)
+        return hashlib.sha256(f'{kind}\0{text}'.encode('utf-8')).hexdigest()
+
+    def get(self, model, hashes):
+        """Look up embeddings, returning a dictionary of the hashes which were found."""
+        hashes = list(set(hashes))
+        found = {}
+        with self.lock, self.connection:
+            for start in range(0, len(hashes), self.MAX_VARIABLES):
+                batch = hashes[start:start + self.MAX_VARIABLES]
+                rows = self.connection.execute(
+                    f'SELECT hash, embedding FROM embeddings WHERE model = ? '
+                    f'AND hash IN ({",".join("?" * len(batch))})', [model] + batch)
+                for key, blob in rows:
+                    found[key] = array.array('f', blob).tolist()
+
+            if found:
+                now = time.time()
+                self.connection.executemany('UPDATE embeddings SET accessed = ? WHERE model = ? AND hash = ?',
+                                            [(now, model, key) for key in found])
+
+            self.hits += len(found)
+            self.misses += len(hashes) - len(found)
+        return found
+
+    def put(self, model, embeddings):
+        """Store a dictionary of hashes to embeddings, evicting the least recently used entries if full."""
+        now = time.time()
+        with self.lock, self.connection:
+            for key, embedding in embeddings.items():
+                cursor = self.connection.execute(
+                    'INSERT OR IGNORE INTO embeddings (model, hash, embedding, accessed) VALUES (?, ?, ?, ?)',
+                    (model, key, array.array('f', embedding).tobytes(), now))
+                self.entries += cursor.rowcount
+
+            excess = self.entries - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    'DELETE FROM embeddings WHERE rowid IN '
+                    '(SELECT rowid FROM embeddings ORDER BY accessed LIMIT ?)', (excess,))
+                self.entries -= excess
+                self.evictions += excess
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM embeddings')
+            self.entries = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'entries': self.entries,
+            'evictions': self.evictions,
+        }
+
+    def report(self):
+        stats = self.stats()
+        print(f'Embedding cache: {stats["hits"]} hits, {stats["misses"]} misses '
+              f'({stats["hit_ratio"]:.1%} hit ratio), {stats["entries"]} entries, {stats["evictions"]} evicted')
+
+
+class CachedEmbedding(llama_index.embeddings.BaseEmbedding):
+    """Embedding model wrapper which only computes embeddings missing from an EmbeddingCache."""
+
+    _embed_model = PrivateAttr()
+    _cache = PrivateAttr()
+    _key = PrivateAttr()
+
+    def __init__(self, embed_model, cache, key=None, **kwargs):
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            callback_manager=embed_model.callback_manager,
+            **kwargs,
+        )
+        self._embed_model = embed_model
+        self._cache = cache
+        self._key = key or embed_model.model_name
+
+    @classmethod
+    def from_args(cls, embed_model, args):
+        """Wrap an embedding model (or a name such as 'default' or 'local') with the cache under --storage."""
+        embed_model = llama_index.embeddings.utils.resolve_embed_model(embed_model)
+        return cls(embed_model, EmbeddingCache.open(args.storage, args.embed_cache_size),
+                   key=cls.get_key(embed_model, args))
+
+    @staticmethod
+    def get_key(embed_model, args):
+        """Name the embeddings of a model are cached under.
+
+        An OpenAI compatible server, such as server.py, reports the same embedding model name whatever model
+        it serves, so its address and the model served (--model) are part of the name.
+        """
+        if isinstance(embed_model, llama_index.embeddings.OpenAIEmbedding):
+            api_base = embed_model.api_base or os.environ.get('OPENAI_API_BASE')
+            return f'{embed_model.model_name}@{api_base}/{getattr(args, "model", None)}'
+        return embed_model.model_name
+
+    @classmethod
+    def class_name(cls):
+        return 'CachedEmbedding'
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def embed_model(self):
+        return self._embed_model
+
+    @property
+    def key(self):
+        return self._key
+
+    def lookup(self, kind, texts):
+        """Return the cached embeddings (None when missing) and the hashes of the texts."""
+        hashes = [EmbeddingCache.get_hash(kind, text) for text in texts]
+        found = self._cache.get(self._key, hashes)
+        return [found.get(key) for key in hashes], hashes
+
+    @staticmethod
+    def get_missing(texts, embeddings):
+        """Unique texts without an embedding, in order of appearance."""
+        return list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+
+    def store(self, embeddings, hashes, texts, computed):
+        """Fill in missing embeddings from those computed for the unique missing texts."""
+        by_text = dict(zip(self.get_missing(texts, embeddings), computed))
+        new = {}
+        for i, text in enumerate(texts):
+            if embeddings[i] is None:
+                embeddings[i] = by_text[text]
+                new[hashes[i]] = embeddings[i]
+        self._cache.put(self._key, new)
+        return embeddings
+
+    def get_text_embedding_batch(self, texts, show_progress=False, **kwargs):
+        # Look up the whole batch at once and let the wrapped model batch only the missing texts
+        embeddings, hashes = self.lookup('text', texts)
+        missing = self.get_missing(texts, embeddings)
+        if missing:
+            computed = self._embed_model.get_text_embedding_batch(missing, show_progress=show_progress, **kwargs)
+            embeddings = self.store(embeddings, hashes, texts, computed)
+        return embeddings
+
+    def _get_query_embedding(self, query):
+        embeddings, hashes = self.lookup('query', [query])
+        if embeddings[0] is None:
+            embeddings = self.store(embeddings, hashes, [query], [self._embed_model._get_query_embedding(query)])
+        return embeddings[0]
+
+    async def _aget_query_embedding(self, query):
+        embeddings, hashes = self.lookup('query', [query])
+        if embeddings[0] is None:
+            computed = await self._embed_model._aget_query_embedding(query)
+            embeddings = self.store(embeddings, hashes, [query], [computed])
+        return embeddings[0]
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        embeddings, hashes = self.lookup('text', texts)
+        missing = self.get_missing(texts, embeddings)
+        if missing:
+            embeddings = self.store(embeddings, hashes, texts, self._embed_model._get_text_embeddings(missing))
+        return embeddings
+
+    async def _aget_text_embeddings(self, texts):
+        embeddings, hashes = self.lookup('text', texts)
+        missing = self.get_missing(texts, embeddings)
+        if missing:
+            computed = await self._embed_model._aget_text_embeddings(missing)
+            embeddings = self.store(embeddings, hashes, texts, computed)
+        return embeddings
+
+
+class BatchedHuggingFaceEmbedding(llama_index.embeddings.HuggingFaceEmbedding):
+    """HuggingFace embeddings computed in length-sorted batches without autograd bookkeeping.
+
+    Sorting texts by length before batching keeps similarly sized texts together, which reduces the
+    padding computed for each batch. When pipelining is enabled the next batch is tokenized on a
+    separate thread while the model runs the current one.
+    """
+
+    sort_by_length: bool = Field(default=True, description='Group texts of similar length into batches.')
+    pipeline: bool = Field(default=False, description='Tokenize the next batch during the forward pass.')
+
+    def __init__(self, sort_by_length=True, pipeline=False, **kwargs):
+        super().__init__(**kwargs)
+        self.sort_by_length = sort_by_length
+        self.pipeline = pipeline
+
+    @classmethod
+    def class_name(cls):
+        return 'BatchedHuggingFaceEmbedding'
+
+    @classmethod
+    def from_args(cls, model_name, args):
+        set_threads(getattr(args, 'embed_threads', None))
+        kwargs = {}
+        if getattr(args, 'embed_max_length', None):
+            kwargs['max_length'] = args.embed_max_length
+        return cls(
+            model_name=model_name,
+            embed_batch_size=getattr(args, 'embed_batch_size', None) or config.Config.EMBED_BATCH_SIZE,
+            sort_by_length=getattr(args, 'embed_sort_by_length', config.Config.EMBED_SORT_BY_LENGTH),
+            pipeline=getattr(args, 'embed_pipeline', config.Config.EMBED_PIPELINE),
+            **kwargs,
+        )
+
+    def tokenize(self, sentences):
+        encoded_input = self._tokenizer(
+            sentences,
+            padding=True,
+            max_length=self.max_length,
+            truncation=True,
+            return_tensors='pt',
+        )
+        encoded_input.pop('token_type_ids', None)
+        return {key: value.to(self._device) for key, value in encoded_input.items()}
+
+    def forward(self, encoded_input):
+        import torch
+
+        with torch.inference_mode():
+            model_output = self._model(**encoded_input)
+
+            if self.pooling == Pooling.CLS:
+                embeddings = self.pooling.cls_pooling(model_output[0])
+            else:
+                embeddings = self._mean_pooling(
+                    token_embeddings=model_output[0], attention_mask=encoded_input['attention_mask'])
+
+            if self.normalize:
+                embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+
+        return embeddings.tolist()
+
+    def _embed(self, sentences):
+        return self.forward(self.tokenize(sentences))
+
+    def get_text_embedding_batch(self, texts, show_progress=False, **kwargs):
+        texts = [llama_index.embeddings.huggingface_utils.format_text(text, self.model_name, self.text_instruction)
+                 for text in texts]
+
+        order = list(range(len(texts)))
+        if self.sort_by_length:
+            order.sort(key=lambda i: len(texts[i]), reverse=True)
+        batches = [[texts[i] for i in order[start:start + self.embed_batch_size]]
+                   for start in range(0, len(order), self.embed_batch_size)]
+
+        if self.pipeline and len(batches) > 1:
+            embeddings = self.embed_pipelined(batches)
+        else:
+            embeddings = []
+            for batch in batches:
+                embeddings.extend(self.embed_batch(batch, self.tokenize(batch)))
+
+        # Restore the original order of the texts
+        result = [None] * len(texts)
+        for position, i in enumerate(order):
+            result[i] = embeddings[position]
+        return result
+
+    def embed_pipelined(self, batches):
+        embeddings = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='tokenizer') as tokenizer:
+            future = tokenizer.submit(self.tokenize, batches[0])
+            for i, batch in enumerate(batches):
+                encoded_input = future.result()
+                if i + 1 < len(batches):
+                    future = tokenizer.submit(self.tokenize, batches[i + 1])
+                embeddings.extend(self.embed_batch(batch, encoded_input))
+        return embeddings
+
+    def embed_batch(self, batch, encoded_input):
+        with self.callback_manager.event(
+                CBEventType.EMBEDDING, payload={EventPayload.SERIALIZED: self.to_dict()}) as event:
+            embeddings = self.forward(encoded_input)
+            event.on_end(payload={EventPayload.CHUNKS: batch, EventPayload.EMBEDDINGS: embeddings})
+        return embeddings
+
+
+def set_threads(threads):
+    """Set the number of threads used by torch for intra-op parallelism (0 or None keeps the default)."""
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
@@ -3,19 +3,35 @@
 # This file is part of Urcuchillay and is released under the MIT License.
 # See LICENSE file in the project root for full license information.
 
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import copy
+import functools
+import hashlib
 import json
 import logging
 import sys
+import threading
 import time
 
+import admission
+import cache
+import cancellation
 import client
+import coalesce
 import config
+import metrics
 import schemas.openai
+import timings
+import utils
 
 try:
     import fastapi
     import httpx
-    import utils
+    import starlette.background
     import uvicorn
 except ModuleNotFoundError as e:
     print('\nError importing Python module(s)')
@@ -25,7 +41,9 @@ except ModuleNotFoundError as e:
 
 
 class Gateway(client.Client):
-    def __init__(self, args):
+    MAX_JOBS = 100  # Number of finished background jobs kept for status queries
+
+    def __init__(self, args, registry):
         super().__init__(args)
 
         self.debug = args.debug
@@ -38,37 +56,551 @@ class Gateway(client.Client):
         logging.basicConfig(stream=sys.stdout, level=level)
         logging.getLogger().name = __name__
 
+        self.registry = registry
+        self.stage_latency = self.registry.histogram(
+            'stage_duration_seconds', 'Time spent in each LlamaIndex stage, such as retrieve or embedding',
+            ('stage',))
+        self.time_to_first_token = self.registry.histogram(
+            'time_to_first_token_seconds', 'Time from starting retrieval to the first generated token',
+            ('endpoint',))
+        self.generated_tokens = self.registry.counter(
+            'generated_tokens_total', 'Tokens streamed from the LLM', ('endpoint',))
+        self.generation_throughput = self.registry.histogram(
+            'generation_tokens_per_second', 'Rate at which each streamed response was generated',
+            ('endpoint',), buckets=metrics.THROUGHPUT_BUCKETS)
+        self.import_modules()
+
+        import callbacks
+
+        self.callback_manager.add_handler(callbacks.TimingHandler(self.stage_latency))
+
         self.llm = self.get_llm(args)
+        self.profile.mark('llm')
 
-        if config.Config.STORAGE_TYPE == 'chromadb':
-            args.embed_model_provider = 'BAAI'
-            args.embed_model_name = 'bge-base-en-v1.5'
+        if getattr(args, 'embed_model_name', None) is None:
+            if config.Config.STORAGE_TYPE == 'chromadb':
+                args.embed_model_provider = 'BAAI'
+                args.embed_model_name = 'bge-base-en-v1.5'
+            else:
+                args.embed_model_name = config.Config.EMBED_MODEL_NAME
 
         self.service_context = self.get_service_context(self.llm, args)
+        self.profile.mark('service context')
         self.index = self.get_index(self.service_context, args)
-        self.engine = None
+        self.lexical_index = self.load_lexical_index(args)
+        self.profile.mark('index')
 
         self.chat_mode = config.Config.CHAT_MODE
+        self.similarity_top_k = config.Config.SIMILARITY_TOP_K
+
+        # Retrievers and query engines are shared read-only between requests, built once per
+        # index generation and configuration, and discarded whenever the index is swapped
+        self.generation = 0
+        self.engines = {}
+        self.engines_lock = threading.Lock()
+
+        # Bounded pool of worker threads for blocking retrieval and generation calls
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.workers, thread_name_prefix='gateway-worker')
+
+        # Index reloads are built one at a time in the background and then swapped in atomically
+        self.loader = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='gateway-loader')
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.load_job = None
+
+        # Long-lived connection pool to the API server, opened and closed with the application
+        self.http_client = None
+
+        # Nodes retrieved for earlier queries, scoped to the index generation they were found in
+        self.retrieval_cache = None
+        if args.retrieval_cache:
+            self.retrieval_cache = cache.SemanticCache(
+                args.retrieval_cache_size, ttl=config.Config.RETRIEVAL_CACHE_TTL,
+                similarity=args.retrieval_cache_similarity)
+
+        # Requests beyond the concurrency limit wait in a bounded queue and are turned away once it is full
+        self.admission = admission.AdmissionController(args.concurrency, args.queue_size)
+
+        # Identical requests arriving while one is still being answered share its computation
+        self.flights = coalesce.SingleFlight() if args.coalesce else None
+
+        self.response_cache = None
+        if args.response_cache:
+            self.response_cache = cache.SemanticCache(
+                args.response_cache_size, ttl=config.Config.RESPONSE_CACHE_TTL,
+                similarity=args.response_cache_similarity)
+
+        # Gauges read from the components above whenever the metrics are collected
+        self.registry.gauge('queue_depth', 'Requests waiting for admission',
+                            function=lambda: self.admission.waiting)
+        self.registry.gauge('active_requests', 'Requests admitted and being answered',
+                            function=lambda: self.admission.active)
+        self.registry.counter('rejected_requests_total', 'Requests turned away as the queue was full',
+                              function=lambda: self.admission.rejected)
+        self.registry.gauge('cache_hit_ratio', 'Fraction of lookups answered from each cache', ('cache',),
+                            function=lambda: self.get_cache_stats('hit_ratio'))
+        self.registry.gauge('cache_entries', 'Number of entries held by each cache', ('cache',),
+                            function=lambda: self.get_cache_stats('entries'))
+        self.registry.gauge('index_size', 'Number of nodes in the index', function=self.get_index_size)
+        self.registry.gauge('index_generation', 'Number of times the index has been swapped',
+                            function=lambda: self.generation)
+
+    @staticmethod
+    def get_http_client(args):
+        return httpx.AsyncClient(
+            base_url=config.APIConfig.get_openai_api_host(host=args.api_host, port=args.api_port),
+            limits=httpx.Limits(
+                max_connections=config.APIConfig.MAX_CONNECTIONS,
+                max_keepalive_connections=config.APIConfig.MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=config.APIConfig.KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(args.timeout, connect=config.APIConfig.CONNECT_TIMEOUT),
+        )
 
+    def set_index(self, index, lexical_index=None):
+        """Swap in a new index, and the lexical index saved with it, invalidating every component built before."""
+        with self.engines_lock:
+            self.index = index
+            self.lexical_index = lexical_index
+            self.generation += 1
+            self.engines.clear()
+            for semantic_cache in (self.retrieval_cache, self.response_cache):
+                if semantic_cache is not None:
+                    semantic_cache.clear()
+            return self.generation
+
+    def load_index(self):
+        """Start reloading the index from storage in the background, returning the job tracking it."""
+        with self.jobs_lock:
+            # Coalesce with a reload which has not finished yet
+            if self.load_job is not None and self.load_job['status'] in ('pending', 'running'):
+                return self.load_job
+
+            job = {
+                'id': utils.generate_job_id(),
+                'object': 'gateway.load',
+                'status': 'pending',
+                'created': int(time.time()),
+                'generation': None,
+                'duration': None,
+                'error': None,
+            }
+            self.jobs[job['id']] = job
+            self.load_job = job
+
+            # Forget the oldest jobs once the history is full
+            while len(self.jobs) > self.MAX_JOBS:
+                del self.jobs[next(iter(self.jobs))]
+
+        self.loader.submit(self.build_index, job)
+        return job
+
+    def build_index(self, job):
+        job['status'] = 'running'
+        start = time.time()
+        try:
+            args = copy.copy(self.args)
+            args.load = True
+            if config.Config.STORAGE_TYPE == 'chromadb':
+                # Pick up vectors written by index.py since the current index was opened
+                self.reopen_db()
+
+            # Requests already in flight keep using the engines of the previous generation
+            job['generation'] = self.set_index(self.get_index(self.service_context, args),
+                                               self.load_lexical_index(args))
+            job['status'] = 'succeeded'
+        except Exception as e:
+            logging.exception('Failed to reload index')
+            job['status'] = 'failed'
+            job['error'] = str(e)
+        job['duration'] = round(time.time() - start, 3)
+
+    def reset_index(self, args):
+        super().reset_index(args)
+        self.set_index(self.index, self.load_lexical_index(args))
+
+    def get_engine(self, name, factory, streaming=False):
+        with self.engines_lock:
+            key = (self.generation, name, self.chat_mode, streaming, self.similarity_top_k)
+            engine = self.engines.get(key)
+            if engine is None:
+                engine = factory(self.index)
+                self.engines[key] = engine
+            return engine
+
+    def get_retriever(self):
+        return self.get_engine('retriever', self.build_retriever)
+
+    def build_retriever(self, index):
+        import retriever
+
+        if self.lexical_index is not None:
+            # Each search ranks more candidates than are returned, so nodes ranked well by both come first
+            candidates = max(self.similarity_top_k, config.Config.HYBRID_CANDIDATES)
+            index_retriever = retriever.HybridRetriever(
+                index.as_retriever(similarity_top_k=candidates), self.lexical_index,
+                functools.partial(self.get_nodes, index), self.similarity_top_k,
+                candidates=candidates, rrf_k=config.Config.RRF_K)
+        else:
+            index_retriever = index.as_retriever(similarity_top_k=self.similarity_top_k)
+        if self.retrieval_cache is None:
+            return index_retriever
+        return retriever.CachedRetriever(index_retriever, self.retrieval_cache,
+                                         scope=(self.generation, self.similarity_top_k),
+                                         get_nodes=functools.partial(self.get_nodes, index),
+                                         embed_model=self.service_context.embed_model)
+
+    def get_query_engine(self, streaming=False):
+        import llama_index.query_engine
+
+        return self.get_engine('query_engine', lambda index: llama_index.query_engine.RetrieverQueryEngine.from_args(
+            self.build_retriever(index), service_context=self.service_context, streaming=streaming),
+            streaming=streaming)
+
+    def get_stats(self):
+        components = {'admission': self.admission, 'retrieval_cache': self.retrieval_cache,
+                      'response_cache': self.response_cache, 'coalescing': self.flights}
+        return {name: component.stats() for name, component in components.items() if component is not None}
+
+    def get_cache_stats(self, field):
+        caches = {'retrieval': self.retrieval_cache, 'response': self.response_cache}
+        return {name: semantic_cache.stats()[field] for name, semantic_cache in caches.items()
+                if semantic_cache is not None}
+
+    def get_index_size(self):
+        index = self.index
+        if index is None:
+            return None
+        # Chroma keeps the nodes in its collection, the in-memory store in the index itself
+        collection = index.vector_store.client
+        return collection.count() if collection is not None else len(index.index_struct.nodes_dict)
+
+    def get_chat_engine(self, chat_history):
+        """Build a chat engine with its own memory around the shared retriever."""
+        import llama_index.chat_engine
+        import llama_index.memory
+        import llama_index.query_engine
+
+        memory = llama_index.memory.ChatMemoryBuffer.from_defaults(chat_history=chat_history, llm=self.llm)
+
+        if self.chat_mode == 'condense_question':
+            # The chat engine turns streaming on and off in its query engine, so it must not share the one used
+            # by the completions endpoints
+            query_engine = llama_index.query_engine.RetrieverQueryEngine.from_args(
+                self.get_retriever(), service_context=self.service_context)
+            return llama_index.chat_engine.CondenseQuestionChatEngine.from_defaults(
+                query_engine=query_engine, service_context=self.service_context, memory=memory)
+        elif self.chat_mode == 'context':
+            return llama_index.chat_engine.ContextChatEngine.from_defaults(
+                retriever=self.get_retriever(), service_context=self.service_context, memory=memory)
+        elif self.chat_mode == 'condense_plus_context':
+            return llama_index.chat_engine.CondensePlusContextChatEngine.from_defaults(
+                retriever=self.get_retriever(), service_context=self.service_context, memory=memory)
+        else:
+            return self.index.as_chat_engine(
+                chat_mode=self.chat_mode, memory=memory, similarity_top_k=self.similarity_top_k)
+
+    @staticmethod
+    def get_chat_history(messages):
+        """Convert OpenAI API messages into LlamaIndex chat messages."""
+        import llama_index.llms
+
+        return [llama_index.llms.ChatMessage(role=message.role.value, content=message.content,
+                                             additional_kwargs=message.additional_kwargs)
+                for message in messages]
+
+    def get_response_scope(self, kind, request_data, history=None):
+        """Everything besides the prompt which determines a response, so cached entries are only reused alike."""
+        temperature = request_data.temperature
+        if temperature is None:
+            temperature = config.Config.TEMPERATURE
+
+        history_hash = None
+        if history:
+            history_json = json.dumps([[message.role.value, message.content] for message in history])
+            history_hash = hashlib.sha256(history_json.encode('utf-8')).hexdigest()
+
+        sampling = (temperature, request_data.top_p, request_data.max_tokens, json.dumps(request_data.stop),
+                    request_data.presence_penalty, request_data.frequency_penalty)
+
+        return kind, request_data.model, sampling, self.chat_mode, self.generation, history_hash
+
+    async def admit(self, request):
+        """Wait for a slot to answer a request, which may set its priority with an X-Priority header."""
+        try:
+            priority = int(request.headers.get('X-Priority', 0))
+        except ValueError:
+            raise fastapi.HTTPException(status_code=400, detail='Invalid X-Priority. Expected an integer.')
 
-arguments = utils.parse_arguments()
-gateway = Gateway(arguments)
-app = fastapi.FastAPI()
+        try:
+            return await self.admission.acquire(priority)
+        except admission.Overloaded as e:
+            raise fastapi.HTTPException(status_code=429, detail=str(e), headers={'Retry-After': str(e.retry_after)})
+
+    async def lookup_response(self, scope, prompt):
+        """Look up a cached response, returning it along with the prompt embedding used for a semantic match."""
+        if self.response_cache is None:
+            return None, None
+
+        response = self.response_cache.get(scope, prompt)
+        if response is not None or self.response_cache.semantic is None:
+            return response, None
+
+        embedding = await self.run(self.service_context.embed_model.get_query_embedding, prompt)
+        # Compared with every cached prompt embedding, so not on the event loop either
+        return await self.run(self.response_cache.get_similar, scope, embedding), embedding
+
+    async def coalesce(self, scope, prompt, func):
+        """Await func(), sharing the result with identical requests which arrive while it runs."""
+        if self.flights is None:
+            return await func()
+        return await self.flights.do((False, scope, json.dumps(prompt)), func)
+
+    def coalesce_stream(self, scope, prompt, func):
+        """Iterate over func(), fanning its items out to identical requests which arrive while it runs."""
+        if self.flights is None:
+            return func()
+        return self.flights.stream((True, scope, json.dumps(prompt)), func)
+
+    def store_response(self, scope, prompt, response, embedding=None):
+        # A response finished after the index was swapped is keyed to the old generation and never matched
+        if self.response_cache is not None:
+            self.response_cache.put(scope, prompt, response, embedding)
+
+    async def answer(self, request, scope, prompt, generate):
+        """Answer a prompt with the text awaited from generate(), returning it with the timings it was made in.
+
+        A cached response, or an identical request already being answered, is used first. Only the request
+        which generates waits for admission, so requests it answers are neither queued behind nor turned
+        away by other generations.
+        """
+        stages = timings.Timings()
+        with timings.scope(stages):
+            text, embedding = await self.lookup_response(scope, prompt)
+        if text is not None:
+            return text, stages
+
+        async def lead():
+            with await self.admit(request):
+                with timings.scope(stages):
+                    text = await generate()
+            self.store_response(scope, prompt, text, embedding)
+            return text, stages
+
+        return await self.coalesce(scope, prompt, lead)
+
+    async def answer_stream(self, request, scope, prompt, generate):
+        """Stream a prompt's answer from the tokens of generate(stages), as answer() does for whole texts.
+
+        Returns an async iterator of (token, is_last, stages) once the request has been admitted, so a full
+        queue is still reported with an error status rather than in the middle of a stream.
+        """
+        stages = timings.Timings()
+        with timings.scope(stages):
+            cached, embedding = await self.lookup_response(scope, prompt)
+        if cached is not None:
+            async def replay():
+                yield cached, True, stages
+            return replay()
+
+        async def lead():
+            with await self.admit(request):
+                # Tells every request sharing this stream that it was admitted
+                yield None
+
+                # Send each token as soon as it is produced, looking one token ahead to detect the last
+                tokens = []
+                async with contextlib.aclosing(generate(stages)) as stream:
+                    async for token, is_last in utils.alookahead(stream):
+                        tokens.append(f'{token}')
+                        if is_last:
+                            self.store_response(scope, prompt, ''.join(tokens), embedding)
+                        yield token, is_last, stages
+
+        tokens = self.coalesce_stream(scope, prompt, lead)
+        try:
+            await anext(tokens)
+        except BaseException:
+            await tokens.aclose()
+            raise
+        return tokens
+
+    def add_timings(self, body, stages, start):
+        """Add the timings to a response body if requested, returning the processing time so far."""
+        total = time.perf_counter() - start
+        if self.args.timings:
+            body['timings'] = stages.to_dict(total)
+        return total
+
+    async def run(self, func, *args, **kwargs):
+        """Run a blocking call on the worker pool without stalling the event loop."""
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, functools.partial(context.run, func, *args, **kwargs))
+
+    async def iterate(self, iterator):
+        """Consume a blocking iterator on the worker pool, one item at a time.
+
+        The iterator is closed when iteration stops early, such as when the client disconnects. Closing
+        waits on the pool for any item still being fetched, as a generator cannot be closed while it runs.
+        """
+        sentinel = object()
+        lock = threading.Lock()
+
+        def advance():
+            with lock:
+                return next(iterator, sentinel)
+
+        def close():
+            with lock:
+                if hasattr(iterator, 'close'):
+                    iterator.close()
+
+        try:
+            while True:
+                item = await self.run(advance)
+                if item is sentinel:
+                    break
+                yield item
+        finally:
+            self.executor.submit(close)
+
+    async def generate(self, endpoint, stages, func, *args):
+        """Start a streaming query or chat, yielding its tokens until done or until iteration stops early.
+
+        Stopping early also stops retrieval and generation which have not finished yet, closing the
+        connection to the API server so it stops producing tokens nobody will read. The time spent in
+        each stage is recorded in stages.
+        """
+        cancelled = cancellation.Cancellation()
+        start = time.perf_counter()
+        first_token = None
+        count = 0
+        try:
+            with cancellation.scope(cancelled), timings.scope(stages):
+                streaming_response = await self.run(func, *args)
+
+            async with contextlib.aclosing(self.iterate(streaming_response.response_gen)) as tokens:
+                async for token in tokens:
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                        self.time_to_first_token.observe(first_token - start, endpoint)
+                        stages.first_token()
+                    count += 1
+                    yield token
+        finally:
+            cancelled.set()
+            if count:
+                self.generated_tokens.inc(endpoint, amount=count)
+                elapsed = time.perf_counter() - first_token
+                if count > 1 and elapsed > 0:
+                    # Measured from the first token, so retrieval and prompt processing are left out
+                    self.generation_throughput.observe((count - 1) / elapsed, endpoint)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Process command parameters')
+    parser = utils.parse_arguments_common(parser)
+
+    parser.add_argument('--workers', type=int, default=config.Config.GATEWAY_WORKERS,
+                        help='Number of worker threads for retrieval and generation (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=config.Config.GATEWAY_CONCURRENCY,
+                        help='Number of requests answered at once, 0 for no limit (default: %(default)s)')
+    parser.add_argument('--queue_size', type=int, default=config.Config.GATEWAY_QUEUE_SIZE,
+                        help='Number of requests waiting for an answer before others are rejected '
+                             '(default: %(default)s)')
+    parser.add_argument('--coalesce', type=utils.str2bool, nargs='?', const=True, default=config.Config.COALESCE,
+                        help='Answer identical concurrent requests with a single computation (default: %(default)s)')
+    parser.add_argument('--retrieval_cache', type=utils.str2bool, nargs='?', const=True,
+                        default=config.Config.RETRIEVAL_CACHE,
+                        help='Reuse the nodes retrieved for repeated queries (default: %(default)s)')
+    parser.add_argument('--retrieval_cache_size', type=int, default=config.Config.RETRIEVAL_CACHE_SIZE,
+                        help='Maximum number of cached retrievals (default: %(default)s)')
+    parser.add_argument('--retrieval_cache_similarity', type=float,
+                        default=config.Config.RETRIEVAL_CACHE_SIMILARITY,
+                        help='Minimum cosine similarity for a semantically matching query, unset for exact matches only '
+                             '(default: %(default)s)')
+    parser.add_argument('--response_cache', type=utils.str2bool, nargs='?', const=True,
+                        default=config.Config.RESPONSE_CACHE,
+                        help='Serve repeated prompts from a cache of earlier responses (default: %(default)s)')
+    parser.add_argument('--response_cache_size', type=int, default=config.Config.RESPONSE_CACHE_SIZE,
+                        help='Maximum number of cached responses (default: %(default)s)')
+    parser.add_argument('--response_cache_similarity', type=float, default=config.Config.RESPONSE_CACHE_SIMILARITY,
+                        help='Minimum cosine similarity for a semantically matching prompt (default: %(default)s)')
+    parser.add_argument('--embed_model_name', type=str, default=None,
+                        help='Embedding model: "default" for the API server, "local", or a HuggingFace model name '
+                             '(default: bge-base-en-v1.5 with chromadb storage, otherwise EMBED_MODEL_NAME)')
+    parser.add_argument('--embed_model_provider', type=str, default='BAAI',
+                        help='HuggingFace organization of --embed_model_name (default: %(default)s)')
+    parser.add_argument('--hybrid', type=utils.str2bool, nargs='?', const=True,
+                        default=config.Config.HYBRID_RETRIEVAL,
+                        help='Fuse vector search with the lexical index saved by index.py (default: %(default)s)')
+    parser.add_argument('--timings', type=utils.str2bool, nargs='?', const=True,
+                        default=config.Config.RESPONSE_TIMINGS,
+                        help='Include a breakdown of processing time in response bodies (default: %(default)s)')
+
+    args = parser.parse_args()
+    args = utils.update_arguments_common(args)
+    return args
+
+
+# The registry and its HTTP middleware exist from import, while the gateway itself is only built once the
+# application starts with the arguments main() parsed into app.state, so loading the models and index never
+# delays --help or importing this module
+registry = metrics.Registry()
+http_metrics = metrics.HTTPMetrics(registry)
+gateway = None
+
+
+@contextlib.asynccontextmanager
+async def lifespan(application: fastapi.FastAPI):
+    global gateway
+    gateway = Gateway(application.state.args, registry)
+    gateway.http_client = gateway.get_http_client(application.state.args)
+    gateway.profile.report()
+    yield
+    await gateway.http_client.aclose()
+    gateway.executor.shutdown(wait=False)
+    gateway.loader.shutdown(wait=False)
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
+app.add_middleware(http_metrics.middleware)
 
 
 @app.get('/v0/gateway/load')
 async def load_index():
     """When the vector store is updated this service needs to reload it into memory"""
-    args = gateway.args
-    args.load = True
-    gateway.get_index(gateway.service_context, args)
-    return {'message': 'Index loaded successfully'}
+    job = gateway.load_index()
+    return {'message': 'Index load started', 'job': job}
+
+
+@app.get('/v0/gateway/jobs/{job_id}')
+async def job_status(job_id: str):
+    """Report the progress of a background job such as an index load."""
+    job = gateway.jobs.get(job_id)
+    if job is None:
+        raise fastapi.HTTPException(status_code=404, detail=f'Job not found: {job_id}')
+    return job
+
+
+@app.get('/v0/gateway/stats')
+async def stats():
+    """Report cache hit rates, used to size the caches."""
+    return gateway.get_stats()
+
+
+@app.get('/metrics')
+async def metrics_endpoint():
+    """Expose metrics in the Prometheus text format for scraping."""
+    return fastapi.Response(content=registry.expose(), media_type=metrics.CONTENT_TYPE)
 
 
 @app.get('/v0/gateway/reset')
 async def reset_index():
     """Resets the database. This will delete all collections and entries."""
-    gateway.reset_index(gateway.args)
+    await gateway.run(gateway.reset_index, gateway.args)
     return {'message': 'Index reset successfully'}
 
 
@@ -81,11 +613,16 @@ async def completions_endpoint(request_data: schemas.openai.CompletionsRequest,
     # Log the request data for debugging
     logging.debug('Request Data:', request_data)
 
+    start = time.perf_counter()
     created = int(time.time())
+    scope = gateway.get_response_scope('completions', request_data)
 
     if not request_data.stream:
-        gateway.engine = gateway.index.as_query_engine()
-        result = gateway.engine.query(request_data.prompt)
+        async def generate_response():
+            engine = gateway.get_query_engine()
+            return f'{await gateway.run(engine.query, request_data.prompt)}'
+
+        result, stages = await gateway.answer(request, scope, request_data.prompt, generate_response)
 
         response = {
             'id': utils.generate_message_id(),
@@ -100,38 +637,47 @@ async def completions_endpoint(request_data: schemas.openai.CompletionsRequest,
                 },
             ],
         }
-        return response
+        total = gateway.add_timings(response, stages, start)
+        return fastapi.responses.JSONResponse(response, headers=stages.headers(total))
 
     else:
-        gateway.engine = gateway.index.as_query_engine(streaming=True)
+        engine = gateway.get_query_engine(streaming=True)
         message_id = utils.generate_message_id()
+        tokens = await gateway.answer_stream(
+            request, scope, request_data.prompt,
+            lambda stages: gateway.generate('completions', stages, engine.query, request_data.prompt))
 
         # Use generator to handle streaming response
-        def generate_responses():
-            streaming_response = gateway.engine.query(request_data.prompt)
-            tokens = list(streaming_response.response_gen)  # Convert generator to list
+        async def generate_responses():
+            async with contextlib.aclosing(tokens):
+                async for token, is_last, stages in tokens:
+                    finish_reason = 'stop' if is_last else None
 
-            for i, token in enumerate(tokens):
-                finish_reason = None if i < len(tokens) - 1 else 'stop'
+                    choice = {
+                        'text': f'{token}',
+                        'index': 0,
+                        'finish_reason': finish_reason,
+                    }
 
-                choice = {
-                    'text': f'{token}',
-                    'index': 0,
-                    'finish_reason': finish_reason,
-                }
+                    # Format the chunk as in the OpenAI API response
+                    chunk_data = {
+                        'id': message_id,
+                        'object': 'text_completion',
+                        'created': created,
+                        'model': request_data.model,
+                        'choices': [choice],
+                    }
+                    if is_last:
+                        gateway.add_timings(chunk_data, stages, start)
+                    chunk = f'data: {json.dumps(chunk_data)}\n\n'
+                    yield chunk
 
-                # Format the chunk as in the OpenAI API response
-                chunk_data = {
-                    'id': message_id,
-                    'object': 'text_completion',
-                    'created': created,
-                    'model': request_data.model,
-                    'choices': [choice],
-                }
-                chunk = f'data: {json.dumps(chunk_data)}\n\n'
-                yield chunk
+            yield 'data: [DONE]\n\n'
 
-        return fastapi.responses.StreamingResponse(generate_responses(), media_type='text/event-stream')
+        # Headers go out before generation starts, so only the time spent waiting for admission is known
+        return fastapi.responses.StreamingResponse(
+            relay(request, generate_responses()), media_type='text/event-stream',
+            headers={'OpenAI-Processing-ms': str(round(1000 * (time.perf_counter() - start)))})
 
 
 @app.api_route('/v1/chat/completions', methods=['POST'])
@@ -141,7 +687,7 @@ async def create_chat_completions(request_data: schemas.openai.ChatCompletionsRe
 
     logging.debug('Request Data:', request_data)
 
-    gateway.engine = gateway.index.as_chat_engine(chat_mode=gateway.chat_mode)
+    start = time.perf_counter()
 
     # Assuming request_data_messages is a list of ChatMessage objects
     chat_history = [msg for msg in request_data.messages
@@ -152,16 +698,19 @@ async def create_chat_completions(request_data: schemas.openai.ChatCompletionsRe
     last_user_message = next((msg for msg in reversed(request_data.messages) if
                               msg.role == schemas.openai.MessageRole.USER), None)
 
-    # TODO: Access to a protected member _memory of a class
-    gateway.engine._memory.reset()  # To clear existing history if needed
-    for message in chat_history:
-        gateway.engine._memory.put(message)
+    # Each request gets its own engine and memory so concurrent conversations never share history
+    engine = gateway.get_chat_engine(gateway.get_chat_history(chat_history))
+    scope = gateway.get_response_scope('chat', request_data, history=chat_history)
 
     message_id = utils.generate_message_id()
     created = int(time.time())
 
     if not request_data.stream:
-        content = gateway.engine.chat(last_user_message.content)
+        async def generate_response():
+            return (await gateway.run(engine.chat, last_user_message.content)).response
+
+        content, stages = await gateway.answer(request, scope, last_user_message.content, generate_response)
+
         response = {
             'id': message_id,
             'object': 'chat.completion',
@@ -172,120 +721,142 @@ async def create_chat_completions(request_data: schemas.openai.ChatCompletionsRe
                     'index': 0,
                     'message': {
                         'role': 'assistant',
-                        'content': content.response,
+                        'content': content,
                     },
                     'finish_reason': 'stop'
                 }
             ]
         }
-        return response
+        total = gateway.add_timings(response, stages, start)
+        return fastapi.responses.JSONResponse(response, headers=stages.headers(total))
 
     else:
-        # Use generator to handle streaming response
-        def generate_responses():
-            if last_user_message.role == schemas.openai.MessageRole.USER:
-                logging.info(f'User prompt: {last_user_message.content}')
-                streaming_response = gateway.engine.stream_chat(last_user_message.content)
-                tokens = list(streaming_response.response_gen)  # Convert generator to list
-
-                for i, token in enumerate(tokens):
-                    finish_reason = None if i < len(tokens) - 1 else 'stop'
-
-                    choice = {
-                        'delta': {
-                            'content': f'{token}',
-                        },
-                        'index': 0,
-                        'finish_reason': finish_reason,
-                    }
-
-                    # Format the chunk as in the OpenAI API response
-                    chunk_data = {
-                        'id': message_id,
-                        'model': request_data.model,
-                        'created': created,
-                        'object': 'chat.completion.chunk',
-                        'choices': [choice],
-                    }
-                    chunk = f'data: {json.dumps(chunk_data)}\n\n'
-                    yield chunk
-
-        return schemas.openai.CustomStreamingResponse(generate_responses())
-
-
-async def get_request_body(request: fastapi.Request):
-    body = None
-    if request.method in ['POST', 'PUT', 'PATCH'] and request.headers.get('Content-Type') == 'application/json':
-        try:
-            body = await request.json()
-        except json.JSONDecodeError:
-            pass
-
-    if body is None:
-        body = await request.body()
+        tokens = await gateway.answer_stream(
+            request, scope, last_user_message.content,
+            lambda stages: gateway.generate('chat', stages, engine.stream_chat, last_user_message.content))
 
-    return body
+        # Use generator to handle streaming response
+        async def generate_responses():
+            async with contextlib.aclosing(tokens):
+                if last_user_message.role == schemas.openai.MessageRole.USER:
+                    logging.info(f'User prompt: {last_user_message.content}')
+
+                    async for token, is_last, stages in tokens:
+                        finish_reason = 'stop' if is_last else None
+
+                        choice = {
+                            'delta': {
+                                'content': f'{token}',
+                            },
+                            'index': 0,
+                            'finish_reason': finish_reason,
+                        }
+
+                        # Format the chunk as in the OpenAI API response
+                        chunk_data = {
+                            'id': message_id,
+                            'model': request_data.model,
+                            'created': created,
+                            'object': 'chat.completion.chunk',
+                            'choices': [choice],
+                        }
+                        if is_last:
+                            gateway.add_timings(chunk_data, stages, start)
+                        chunk = f'data: {json.dumps(chunk_data)}\n\n'
+                        yield chunk
+
+            yield 'data: [DONE]\n\n'
+
+        return schemas.openai.CustomStreamingResponse(
+            relay(request, generate_responses()),
+            headers={'OpenAI-Processing-ms': str(round(1000 * (time.perf_counter() - start)))})
+
+
+async def relay(request, chunks):
+    """Relay a streaming response until it ends or the client disconnects, then close it."""
+    async with contextlib.aclosing(chunks):
+        async for chunk in chunks:
+            if await request.is_disconnected():
+                logging.info('Client disconnected, cancelling response')
+                break
+            yield chunk
+
+
+def add_headers(response, headers):
+    """Add (key, value) pairs of headers to a response, keeping repeated headers such as Set-Cookie apart."""
+    for key, value in headers:
+        response.headers.append(key, value)
+    return response
+
+
+def get_upstream_headers(headers):
+    """Headers to pass along to the API server, without hop-by-hop or connection specific entries."""
+    return utils.remove_hop_by_hop_headers(headers, excluded=['host', 'content-length'])
 
 
 @app.api_route('/v1/models', methods=['GET'])
 async def models_endpoint(request: fastapi.Request):
-    # Forward the request to the API server
-    url = f'http://{arguments.api_host}:{arguments.api_port}/v1/models'
-
-    body = await get_request_body(request)
-
-    async with httpx.AsyncClient() as async_client:
-        # Forward the original request method, headers, and body
-        response = await async_client.request(
-            method=request.method,
-            url=url,
-            headers=request.headers,
-            data=body if isinstance(body, dict) else None,
-            content=body if not isinstance(body, dict) else None
-        )
-
-        # Process the response to modify the model id
-        response_data = response.json()  # Parse JSON response
-        if 'data' in response_data:
-            for item in response_data['data']:
-                # If the complete local path (or URL) to a model was provided
-                # then only supply the filename instead
-                last_slash = max(item['id'].rfind('/'), item['id'].rfind('\\'))
-                if last_slash != -1:
-                    item['id'] = item['id'][last_slash+1:]
-
-        content = json.dumps(response_data)
-        headers = dict(response.headers)
-        headers['content-length'] = str(len(content.encode('utf-8')))
-
-        # Return the response from the llama app
-        return fastapi.Response(content=content, status_code=response.status_code, headers=headers)
+    # Forward the original request method, headers, and body to the API server
+    response = await gateway.http_client.request(
+        method=request.method,
+        url='/v1/models',
+        params=request.query_params,
+        headers=get_upstream_headers(request.headers),
+        content=await request.body(),
+    )
+
+    # Process the response to modify the model id
+    response_data = response.json()  # Parse JSON response
+    if 'data' in response_data:
+        for item in response_data['data']:
+            # If the complete local path (or URL) to a model was provided
+            # then only supply the filename instead
+            last_slash = max(item['id'].rfind('/'), item['id'].rfind('\\'))
+            if last_slash != -1:
+                item['id'] = item['id'][last_slash+1:]
+
+    content = json.dumps(response_data)
+
+    # The body has been decoded and rewritten, so drop the upstream encoding and length
+    headers = utils.remove_hop_by_hop_headers(response.headers, excluded=['content-encoding', 'content-length'])
+
+    # Return the response from the llama app
+    return add_headers(fastapi.Response(content=content, status_code=response.status_code), headers)
 
 
 @app.api_route('/{path:path}', methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'HEAD', 'PATCH'])
 async def forward(request: fastapi.Request, path: str):
-    # Forward the request to the API server
-    url = f'http://{arguments.api_host}:{arguments.api_port}/{path}'
-
-    body = await get_request_body(request)
-
-    async with httpx.AsyncClient() as async_client:
-        # Forward the original request method, headers, and body
-        response = await async_client.request(
-            method=request.method,
-            url=url,
-            headers=request.headers,
-            data=body if isinstance(body, dict) else None,
-            content=body if not isinstance(body, dict) else None
-        )
+    # Forward the original request method, headers, and body to the API server
+    upstream_request = gateway.http_client.build_request(
+        method=request.method,
+        url=f'/{path}',
+        params=request.query_params,
+        headers=get_upstream_headers(request.headers),
+        content=request.stream(),
+    )
+    response = await gateway.http_client.send(upstream_request, stream=True)
+
+    async def relay_upstream():
+        try:
+            async for chunk in relay(request, response.aiter_raw()):
+                yield chunk
+        finally:
+            # Closing the upstream response as soon as the client is gone stops the API server generating.
+            # Shielded, as the task relaying the response may itself be being cancelled
+            await asyncio.shield(response.aclose())
 
-        # Return the response from the llama app
-        return fastapi.Response(content=response.content, status_code=response.status_code,
-                                headers=dict(response.headers))
+    # Relay the response from the llama app as it arrives, releasing the pooled connection when done
+    return add_headers(fastapi.responses.StreamingResponse(
+        relay_upstream(),
+        status_code=response.status_code,
+        background=starlette.background.BackgroundTask(response.aclose),
+    ), utils.remove_hop_by_hop_headers(response.headers))
 
 
 def main():
-    uvicorn.run(app, host=arguments.host, port=arguments.port)
+    args = parse_arguments()
+    app.state.args = args
+    uvicorn.run(app, host=args.host, port=args.port)
 
 
 if __name__ == '__main__':
@@ -4,22 +4,16 @@
 # See LICENSE file in the project root for full license information.
 
 import argparse
+import functools
+import json
 import logging
-import sys
+import os
+import time
 
 import client
 import config
 import utils
 
-try:
-    import llama_index
-    import transformers
-except ModuleNotFoundError as e:
-    print('\nError importing Python module(s)')
-    print('If installed using setup.sh it may be necessary to run:\n')
-    print('pyenv activate urcuchillay-env\n')
-    sys.exit(1)
-
 
 class Index(client.Client):
     def __init__(self, args):
@@ -30,43 +24,236 @@ class Index(client.Client):
 
         utils.set_index_cache(args)
 
-        if args.pretrained_model_name is not None:
-            llama_index.set_global_tokenizer(
-                transformers.AutoTokenizer.from_pretrained(
-                    args.pretrained_model_provider + '/' + args.pretrained_model_name
-                ).encode
-            )
-
-        llm = self.get_llm(args)
-        service_context = self.get_service_context(llm, args)
-
         if args.reset:
+            # Resetting needs neither the LLM nor the embedding model, so none of LlamaIndex is loaded
             self.reset_index(args)
             logging.warning('vector store was reset')
+            self.profile.mark('reset')
             if config.Config.STORAGE_TYPE == 'json':
                 args.load = False  # Do not attempt to load from the deleted storage, generate a new vector store
         else:
-            index = self.get_index(service_context, args)
+            import embedding
+            import llama_index
+
+            self.import_modules()
+
+            if args.pretrained_model_name is not None:
+                import transformers
+
+                llama_index.set_global_tokenizer(
+                    transformers.AutoTokenizer.from_pretrained(
+                        args.pretrained_model_provider + '/' + args.pretrained_model_name
+                    ).encode
+                )
+                self.profile.mark('tokenizer')
+
+            llm = self.get_llm(args)
+            self.profile.mark('llm')
+            service_context = self.get_service_context(llm, args)
+            self.profile.mark('service context')
+
+            self.index = self.get_index(service_context, args)
+            self.profile.mark('index')
 
             if args.save:
+                # persist the index to disk, ChromaDB having already written it as part of the loading data process
                 self.save_index(args)
-                # persist the index to disk
-                if config.Config.STORAGE_TYPE == 'json':
-                    index.storage_context.persist(persist_dir=args.storage)
+                self.profile.mark('save')
+
+                if args.hybrid:
+                    # Follows the saved vector store, tokenizing only the nodes added to it since the last run
+                    self.update_lexical_index(self.index, args)
+                    self.profile.mark('lexical index')
                 else:
-                    # For ChromaDB, storage is written to disk as part
-                    # of the loading data process
-                    pass
+                    # A lexical index left from an earlier run would no longer match the vector store
+                    utils.storage_reset(storage_path=args.storage, files=[config.Config.LEXICAL_FILE])
+
+            if isinstance(service_context.embed_model, embedding.CachedEmbedding):
+                service_context.embed_model.cache.report()
+
+            if args.ann_report:
+                self.report_ann(args.ann_report, args.ann_top_k)
 
         if args.reload:
             # Request gateway to reload indexed vector store
             utils.request_gateway_load(args.host, args.port)
 
+        self.profile.report()
+
+    def report_ann(self, count, top_k):
+        """Print the recall and latency of approximate search against exact search, over queries near stored vectors."""
+        import numpy
+        import vectors
+
+        vector_store = self.index.vector_store
+        results = {}
+        if config.Config.STORAGE_TYPE == 'numpy':
+            ivf = vector_store.get_ivf()
+            codes = vector_store.codes
+            if ivf is None and codes is None:
+                print('Approximate search report: the numpy vector store has neither an IVF index nor codes, '
+                      'it is searched exactly')
+                return
+            queries = vectors.sample_queries(vector_store.get_vectors(), count)
+
+            # Each of the IVF index and the codes is measured on its own, then both as configured
+            exact = functools.partial(self.search_numpy, vector_store, nprobe=0, rescore=0)
+            settings = {}
+            if ivf is not None:
+                for nprobe in sorted({1, 2, 4, 8, 16, 32, 64, config.Config.IVF_NPROBE}):
+                    if nprobe < ivf.lists:
+                        settings[f'nprobe={nprobe}'] = {'nprobe': nprobe, 'rescore': 0}
+            if codes is not None:
+                for rescore in sorted({1, 2, 4, 8, config.Config.QUANTIZATION_RESCORE}):
+                    settings[f'{codes.kind} rescore={rescore}'] = {'nprobe': 0, 'rescore': rescore}
+            if ivf is not None and codes is not None:
+                settings['configured'] = {'nprobe': None, 'rescore': None}
+
+            for setting, kwargs in settings.items():
+                search = functools.partial(self.search_numpy, vector_store, **kwargs)
+                results[setting] = vectors.measure_recall(search, exact, queries, top_k)
+        elif config.Config.STORAGE_TYPE == 'chromadb':
+            collection = vector_store.client
+            data = collection.get(include=['embeddings'])
+            if not data['ids']:
+                print('Approximate search report: the collection is empty')
+                return
+            ids = numpy.array(data['ids'])
+            matrix = numpy.asarray(data['embeddings'], dtype=numpy.float32)
+            squared_norms = (matrix * matrix).sum(axis=1)
+            params = self.get_hnsw_params(collection)
+            space = params['hnsw:space']
+            if space == 'cosine':
+                matrix = vectors.normalize(matrix)
+            queries = vectors.sample_queries(matrix, count)
+
+            def exact(query, k):
+                scores = matrix @ query
+                if space == 'l2':
+                    scores = 2 * scores - squared_norms
+                return ids[vectors.get_top_k(scores, min(k, len(ids)))].tolist()
+
+            def search(query, k):
+                return collection.query(query_embeddings=[query.tolist()], n_results=k, include=[])['ids'][0]
+
+            setting = f'M={params["hnsw:M"]} search_ef={params["hnsw:search_ef"]}'
+            results[setting] = vectors.measure_recall(search, exact, queries, top_k)
+        else:
+            print(f'Approximate search report: not available for {config.Config.STORAGE_TYPE} storage')
+            return
+
+        print(f'Approximate search report, recall@{top_k} over {len(queries)} queries:')
+        for setting, result in results.items():
+            print(f'  {setting:<18} recall {result["recall"]:.4f}  {result["latency_ms"]:8.3f}ms  '
+                  f'(exact {result["exact_latency_ms"]:.3f}ms)')
+
+    @staticmethod
+    def search_numpy(vector_store, query, k, nprobe, rescore):
+        return vector_store.search(query, k, nprobe=nprobe, rescore=rescore)[0].tolist()
+
+
+def print_stats(storage_path, storage_type=config.Config.STORAGE_TYPE):
+    """Print the size of the vector store under storage_path, reading only its headers."""
+    if not os.path.isdir(storage_path):
+        print(f'No vector store found at {storage_path}')
+        return
+
+    # Sizes of each file, and of each directory in total, directly under the storage path
+    sizes = {}
+    for directory, _, names in os.walk(storage_path):
+        for name in names:
+            entry = os.path.relpath(os.path.join(directory, name), storage_path).split(os.sep)[0]
+            sizes[entry] = sizes.get(entry, 0) + os.path.getsize(os.path.join(directory, name))
+    total = sum(sizes.values())
+
+    nodes = None
+    header = {}
+    if storage_type == 'numpy' and os.path.exists(os.path.join(storage_path, 'vector_store.json')):
+        with open(os.path.join(storage_path, 'vector_store.json'), 'r') as f:
+            header = json.load(f)
+        nodes = header['count']
+    elif storage_type == 'chromadb' and sizes:
+        import chromadb
+
+        try:
+            nodes = chromadb.PersistentClient(path=storage_path).get_collection('quickstart').count()
+        except ValueError:
+            nodes = 0
+    elif storage_type == 'json' and os.path.exists(os.path.join(storage_path, config.Config.SNAPSHOT_FILE)):
+        import snapshot
+
+        nodes = snapshot.Snapshot(os.path.join(storage_path, config.Config.SNAPSHOT_FILE)).header['count']
+    elif storage_type == 'json' and os.path.exists(os.path.join(storage_path, 'default__vector_store.json')):
+        with open(os.path.join(storage_path, 'default__vector_store.json'), 'r') as f:
+            nodes = len(json.load(f).get('embedding_dict', {}))
+
+    print(f'Vector store at {storage_path} ({storage_type}): {nodes if nodes is not None else "unknown"} nodes')
+    if header:
+        print(f'  {header["dimensions"]} dimensions stored as {header["dtype"]}, '
+              f'quantization {header.get("quantization") or "none"}, IVF lists {header.get("ivf_lists") or "none"}')
+    for entry, size in sorted(sizes.items()):
+        print(f'  {entry:<40} {format_size(size):>10}')
+    print(f'  {"total":<40} {format_size(total):>10}' + (f'  ({format_size(total / nodes)} per node)' if nodes else ''))
+
+    if header.get('quantization') and sizes.get('vectors.npy'):
+        searched = sizes.get('codes.npy', 0)
+        print(f'Queries search {format_size(searched)} of {header["quantization"]} codes, '
+              f'{searched / sizes["vectors.npy"]:.1%} of the {format_size(sizes["vectors.npy"])} of full precision '
+              f'vectors, which are only read to re-score the shortlist')
+
+
+def convert(storage_path):
+    """Write the JSON files of a json vector store as a snapshot, which is loaded in preference to them."""
+    if not all(os.path.exists(os.path.join(storage_path, file)) for file in config.Config.STORAGE_FILES):
+        print(f'No JSON vector store found at {storage_path}')
+        return
+
+    import snapshot
+
+    start = time.perf_counter()
+    nodes = snapshot.convert(storage_path)
+    size = os.path.getsize(os.path.join(storage_path, config.Config.SNAPSHOT_FILE))
+    print(f'Converted {nodes} nodes at {storage_path} into {config.Config.SNAPSHOT_FILE} ({format_size(size)}) '
+          f'in {time.perf_counter() - start:.2f}s, the JSON files can now be removed')
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GB'
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Process command parameters')
     parser = utils.parse_arguments_common(parser)
 
+    parser.add_argument('--incremental', type=utils.str2bool, nargs='?', const=True, default=False,
+                        help='Only index files which were added, changed, or removed since the last run '
+                             '(default: %(default)s)')
+    parser.add_argument('--workers', dest='ingest_workers', type=int, default=config.Config.INGEST_WORKERS,
+                        help='Number of processes used to parse and split files, 0 to disable (default: %(default)s)')
+    parser.add_argument('--batch_size', type=int, default=config.Config.INGEST_BATCH_SIZE,
+                        help='Number of nodes embedded and inserted per batch (default: %(default)s)')
+    parser.add_argument('--hybrid', type=utils.str2bool, nargs='?', const=True,
+                        default=config.Config.HYBRID_RETRIEVAL,
+                        help='Keep a BM25 lexical index of the nodes beside the vector store for hybrid retrieval '
+                             '(default: %(default)s)')
+    parser.add_argument('--quantization', type=str, choices=['none', 'int8', 'binary'],
+                        default=config.Config.QUANTIZATION or 'none',
+                        help='Compact codes saved with the numpy vector store and searched before re-scoring '
+                             '(default: %(default)s)')
+    parser.add_argument('--stats', type=utils.str2bool, nargs='?', const=True, default=False,
+                        help='Print the size of the stored vector store and exit (default: %(default)s)')
+    parser.add_argument('--convert', type=utils.str2bool, nargs='?', const=True, default=False,
+                        help='Convert the JSON files of a json vector store saved by an earlier version into a '
+                             'snapshot and exit (default: %(default)s)')
+    parser.add_argument('--ann_report', type=int, default=0,
+                        help='Number of queries used to report the recall and latency of approximate search '
+                             'against exact search, 0 to disable (default: %(default)s)')
+    parser.add_argument('--ann_top_k', type=int, default=10,
+                        help='Number of results compared per query by --ann_report (default: %(default)s)')
     parser.add_argument('--pretrained_model_name', type=str, default=None,
                         help='The name of the pretrained model to use (default: %(default)s)')
     parser.add_argument('--pretrained_model_provider', type=str, default=None,
@@ -74,11 +261,19 @@ def parse_arguments():
 
     args = parser.parse_args()
     args = utils.update_arguments_common(args)
+    if args.quantization == 'none':
+        args.quantization = None
     return args
 
 
 def main():
     args = parse_arguments()
+    if args.stats:
+        print_stats(args.storage)
+        return
+    if args.convert:
+        convert(args.storage)
+        return
     Index(args=args)
 
 
@@ -0,0 +1,193 @@
+# ingest.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import time
+
+
+class Manifest:
+    """Record of the files which have been indexed, used to ingest only what changed since the last run.
+
+    Each entry is keyed by file path and holds the file's modification time, size, content hash,
+    and the ids of the documents it produced so their vectors can be deleted when it changes.
+    """
+
+    FILENAME = 'manifest.json'
+    VERSION = 1
+
+    def __init__(self, storage_path, files=None):
+        self.path = os.path.join(storage_path, self.FILENAME)
+        self.files = files or {}
+
+    @classmethod
+    def load(cls, storage_path):
+        path = os.path.join(storage_path, cls.FILENAME)
+        if not os.path.exists(path):
+            return cls(storage_path)
+
+        with open(path, 'r') as f:
+            data = json.load(f)
+
+        if data.get('version') != cls.VERSION:
+            # An unknown format is treated as empty, resulting in a full re-index
+            return cls(storage_path)
+
+        return cls(storage_path, files=data.get('files', {}))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+
+        # Write then rename so an interrupted run never leaves a truncated manifest behind
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'version': self.VERSION, 'files': self.files}, f)
+        os.replace(temp_path, self.path)
+
+    @classmethod
+    def remove(cls, storage_path):
+        path = os.path.join(storage_path, cls.FILENAME)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def scan(self, paths):
+        """Compare files on disk against the manifest.
+
+        Returns a tuple of (added, changed, removed) file paths. The content hash is only computed
+        when the modification time or size differ, so unchanged files cost a single stat call.
+        """
+        added = []
+        changed = []
+        seen = set()
+
+        for path in paths:
+            path = str(path)
+            seen.add(path)
+            stat = os.stat(path)
+            entry = self.files.get(path)
+
+            if entry is None:
+                added.append(path)
+            elif entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+                if entry['sha256'] == file_hash(path):
+                    # Touched but identical content, just refresh the recorded stat
+                    entry['mtime'] = stat.st_mtime
+                    entry['size'] = stat.st_size
+                else:
+                    changed.append(path)
+
+        removed = [path for path in self.files if path not in seen]
+
+        return added, changed, removed
+
+    def update(self, path, doc_ids):
+        stat = os.stat(path)
+        self.files[path] = {
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'sha256': file_hash(path),
+            'doc_ids': list(doc_ids),
+        }
+
+    def discard(self, path):
+        """Forget a file, returning the ids of the documents it had produced."""
+        entry = self.files.pop(path, None)
+        return entry['doc_ids'] if entry else []
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Pipeline:
+    """Parse and split files across a pool of processes, feeding the nodes to an index in bounded batches.
+
+    Only a few files per worker are in flight and nodes are inserted (and therefore embedded) as soon as
+    a batch fills, so memory use stays flat regardless of the size of the corpus.
+    """
+
+    def __init__(self, workers, batch_size, chunk_size, chunk_overlap):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+        self.files = 0
+        self.documents = 0
+        self.nodes = 0
+        self.elapsed = 0.0
+
+    @classmethod
+    def from_service_context(cls, service_context, workers, batch_size):
+        node_parser = service_context.node_parser
+        return cls(workers, batch_size,
+                   chunk_size=getattr(node_parser, 'chunk_size', None),
+                   chunk_overlap=getattr(node_parser, 'chunk_overlap', None))
+
+    def run(self, index, paths, manifest=None):
+        start = time.time()
+        batch = []
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for path, doc_ids, nodes in self.map(pool, paths):
+                self.files += 1
+                self.documents += len(doc_ids)
+                self.nodes += len(nodes)
+                if manifest is not None:
+                    manifest.update(path, doc_ids)
+
+                batch.extend(nodes)
+                if len(batch) >= self.batch_size:
+                    index.insert_nodes(batch)
+                    batch = []
+
+            if batch:
+                index.insert_nodes(batch)
+
+        self.elapsed = time.time() - start
+        return index
+
+    def map(self, pool, paths):
+        """Yield parsed files as they complete, keeping at most two files per worker in flight."""
+        paths = iter(paths)
+        pending = set(pool.submit(split_file, path, self.chunk_size, self.chunk_overlap)
+                      for path in itertools.islice(paths, self.workers * 2))
+
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+                path = next(paths, None)
+                if path is not None:
+                    pending.add(pool.submit(split_file, path, self.chunk_size, self.chunk_overlap))
+
+    def report(self):
+        elapsed = max(self.elapsed, 1e-9)
+        print(f'Indexed {self.files} files, {self.documents} documents and {self.nodes} nodes '
+              f'in {self.elapsed:.2f}s ({self.documents / elapsed:.1f} docs/s, {self.nodes / elapsed:.1f} nodes/s)')
+
+
+def split_file(path, chunk_size=None, chunk_overlap=None):
+    """Read a file and split it into nodes. Runs inside a worker process."""
+    import llama_index
+    import llama_index.node_parser
+
+    documents = llama_index.SimpleDirectoryReader(input_files=[path]).load_data()
+
+    kwargs = {}
+    if chunk_size is not None:
+        kwargs['chunk_size'] = chunk_size
+    if chunk_overlap is not None:
+        kwargs['chunk_overlap'] = chunk_overlap
+    node_parser = llama_index.node_parser.SentenceSplitter.from_defaults(**kwargs)
+
+    return path, [document.doc_id for document in documents], node_parser.get_nodes_from_documents(documents)
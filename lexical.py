@@ -0,0 +1,206 @@
+# lexical.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import collections
+import logging
+import math
+import os
+import re
+
+import numpy
+
+import snapshot
+import vectors
+
+# Words, along with identifiers whose parts are joined by punctuation, such as QX-1138, v2.1 or 10.0.0.1
+TOKEN = re.compile(r'\w+(?:[-./:]\w+)*')
+PART = re.compile(r'[^\W_]+')
+
+
+def tokenize(text):
+    """Lowercase terms of text.
+
+    Identifiers are kept whole, and also split into their parts and run together, so a query for QX-1138,
+    qx 1138 or QX1138 finds a node containing any of them.
+    """
+    terms = TOKEN.findall(text.lower())
+    identifiers = []
+    for term in terms:
+        if not term.isalnum():
+            parts = PART.findall(term)
+            if len(parts) > 1:
+                identifiers.extend(parts)
+                identifiers.append(''.join(parts))
+    return terms + identifiers
+
+
+class LexicalIndex:
+    """BM25 inverted index of the text of every node in the vector store, saved beside it as a snapshot.
+
+    Terms are stored in sorted order, so each term of a query is found by binary search, and the postings of
+    each term (the rows of the nodes containing it and how many times) are contiguous slices of two arrays.
+    Loading maps the file and reads only its header, and a query reads only the postings of its own terms.
+    The index is rewritten by update after nodes are added to or removed from the vector store, tokenizing
+    only the nodes which were added.
+    """
+
+    FILE = 'lexical.snapshot'
+    KIND = 'lexical'
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.count = 0
+        self.average_length = 1.0
+        self.ids = []
+        self.lengths = numpy.zeros(0, dtype=numpy.uint32)
+        self.terms = []
+        self.offsets = numpy.zeros(1, dtype=numpy.uint64)
+        self.rows = numpy.zeros(0, dtype=numpy.uint32)
+        self.frequencies = numpy.zeros(0, dtype=numpy.uint16)
+        self.norms = None
+
+    @classmethod
+    def load(cls, path, k1=1.2, b=0.75):
+        """Map the index saved under path, or return None if there is none."""
+        file = os.path.join(path, cls.FILE)
+        if not os.path.exists(file):
+            return None
+
+        data = snapshot.Snapshot(file, kind=cls.KIND)
+        index = cls(k1, b)
+        index.count = data.header['count']
+        index.average_length = data.header['length'] / index.count if index.count else 1.0
+        index.ids = data.blobs('ids')
+        index.lengths = data.array('lengths')
+        index.terms = data.blobs('terms')
+        index.offsets = data.array('offsets')
+        index.rows = data.array('rows')
+        index.frequencies = data.array('frequencies')
+        return index
+
+    @classmethod
+    def remove(cls, path):
+        file = os.path.join(path, cls.FILE)
+        if os.path.exists(file):
+            os.remove(file)
+
+    def get_ids(self):
+        return [node_id.decode('utf-8') for node_id in self.ids]
+
+    def get_terms(self):
+        return [term.decode('utf-8') for term in self.terms]
+
+    def search(self, query, top_k):
+        """Ids of the top_k nodes with the highest BM25 scores for the query, with their scores, highest first."""
+        totals = None
+        for term in set(tokenize(query)):
+            position = self.terms.find(term)
+            if position is None:
+                continue
+            start, end = int(self.offsets[position]), int(self.offsets[position + 1])
+            rows = self.rows[start:end]
+            frequencies = self.frequencies[start:end].astype(numpy.float32)
+            idf = math.log(1 + (self.count - (end - start) + 0.5) / (end - start + 0.5))
+            if totals is None:
+                totals = numpy.zeros(self.count, dtype=numpy.float32)
+                norms = self.get_norms()
+            # A node appears once in the postings of each term, so its score is summed without numpy.add.at
+            totals[rows] += numpy.float32(idf * (self.k1 + 1)) * frequencies / (frequencies + norms[rows])
+        if totals is None:
+            return []
+
+        matched = numpy.flatnonzero(totals)
+        top = matched[vectors.get_top_k(totals[matched], top_k)]
+        return [(self.ids[row].decode('utf-8'), float(totals[row])) for row in top]
+
+    def get_norms(self):
+        """The BM25 length normalization of each node, computed on the first query."""
+        if self.norms is None:
+            self.norms = (self.k1 * (1 - self.b + self.b * self.lengths / self.average_length)).astype(numpy.float32)
+        return self.norms
+
+    @classmethod
+    def update(cls, path, node_ids, get_texts, k1=1.2, b=0.75, batch_size=1024):
+        """Bring the index saved under path up to date with the nodes now in the vector store.
+
+        get_texts is called with batches of the ids of nodes which are not in the index yet, and returns pairs
+        of node id and text. Postings of the nodes which remain are kept without tokenizing them again.
+        Returns the updated index along with the number of nodes added and removed.
+        """
+        try:
+            index = cls.load(path, k1, b) or cls(k1, b)
+        except ValueError as e:
+            logging.warning(f'rebuilding lexical index: {e}')
+            index = cls(k1, b)
+
+        stored = index.get_ids()
+        current = set(node_ids)
+        keep = numpy.fromiter((node_id in current for node_id in stored), dtype=bool, count=len(stored))
+        known = set(stored)
+        added = [node_id for node_id in dict.fromkeys(node_ids) if node_id not in known]
+        removed = len(stored) - int(keep.sum())
+        if os.path.exists(os.path.join(path, cls.FILE)) and not added and not removed:
+            return index, 0, 0
+
+        # Postings of the nodes which remain, with their rows renumbered to close the gaps
+        terms = index.get_terms()
+        term_ids = numpy.repeat(numpy.arange(len(terms)), numpy.diff(index.offsets).astype(numpy.int64))
+        renumbered = numpy.cumsum(keep) - 1
+        remaining = keep[index.rows]
+        posting_terms = term_ids[remaining]
+        posting_rows = renumbered[index.rows[remaining]]
+        posting_frequencies = index.frequencies[remaining]
+        ids = [stored[row] for row in numpy.flatnonzero(keep)]
+        lengths = [int(length) for length in index.lengths[keep]]
+
+        # Postings of the nodes which were added, numbering their terms in order of appearance until the
+        # vocabulary is known
+        added_terms = {}
+        posting_added_terms, posting_added_rows, posting_added_frequencies = [], [], []
+        for start in range(0, len(added), batch_size):
+            for node_id, text in get_texts(added[start:start + batch_size]):
+                node_terms = tokenize(text)
+                counts = collections.Counter(node_terms)
+                posting_added_terms.extend(added_terms.setdefault(term, len(added_terms)) for term in counts)
+                posting_added_rows.extend([len(ids)] * len(counts))
+                posting_added_frequencies.extend(counts.values())
+                ids.append(node_id)
+                lengths.append(len(node_terms))
+
+        vocabulary = sorted({terms[term] for term in numpy.unique(posting_terms)} | set(added_terms),
+                            key=lambda term: term.encode('utf-8'))
+        positions = {term: position for position, term in enumerate(vocabulary)}
+        renamed = numpy.asarray([positions.get(term, -1) for term in terms], dtype=numpy.int64)
+        renamed_added = numpy.asarray([positions[term] for term in added_terms], dtype=numpy.int64)
+
+        all_terms = numpy.concatenate((renamed[posting_terms],
+                                       renamed_added[numpy.asarray(posting_added_terms, dtype=numpy.int64)]))
+        all_rows = numpy.concatenate((posting_rows, posting_added_rows)).astype(numpy.uint32)
+        all_frequencies = numpy.minimum(numpy.concatenate((posting_frequencies, posting_added_frequencies)),
+                                        numpy.iinfo(numpy.uint16).max).astype(numpy.uint16)
+        order = numpy.lexsort((all_rows, all_terms))
+        offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(all_terms, minlength=len(vocabulary)))))
+        lengths = numpy.asarray(lengths, dtype=numpy.uint32)
+
+        def write_sections(f):
+            return {
+                'ids': snapshot.write_blobs(f, (node_id.encode('utf-8') for node_id in ids)),
+                'lengths': snapshot.write_array(f, lengths),
+                'terms': snapshot.write_blobs(f, (term.encode('utf-8') for term in vocabulary)),
+                'offsets': snapshot.write_array(f, offsets.astype(numpy.uint64)),
+                'rows': snapshot.write_array(f, all_rows[order]),
+                'frequencies': snapshot.write_array(f, all_frequencies[order]),
+            }
+
+        os.makedirs(path, exist_ok=True)
+        snapshot.write(os.path.join(path, cls.FILE), write_sections, {
+            'kind': cls.KIND,
+            'count': len(ids),
+            'length': int(lengths.sum()),
+            'terms': len(vocabulary),
+            'postings': len(order),
+        })
+        return cls.load(path, k1, b), len(added), removed
@@ -0,0 +1,33 @@
+# llms.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import httpx
+import llama_index.llms
+
+import cancellation
+
+
+class CancellableOpenAI(llama_index.llms.OpenAI):
+    """OpenAI compatible LLM whose streaming responses stop when the current request is cancelled.
+
+    Chat engines consume the stream on a thread of their own, so the response generator handed to the
+    caller cannot simply be closed; the cancellation reaches that thread through the stream instead.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('http_client', httpx.Client(
+            follow_redirects=True, event_hooks={'response': [cancellation.track]}))
+        super().__init__(**kwargs)
+
+    def stream_complete(self, prompt, formatted=False, **kwargs):
+        return self.guard(super().stream_complete(prompt, formatted=formatted, **kwargs))
+
+    def stream_chat(self, messages, **kwargs):
+        return self.guard(super().stream_chat(messages, **kwargs))
+
+    @staticmethod
+    def guard(generator):
+        cancelled = cancellation.current.get()
+        return generator if cancelled is None else cancellation.guard(generator, cancelled)
@@ -0,0 +1,217 @@
+# metrics.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import bisect
+import math
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from a cached response through to a long generation on a CPU
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Tokens per second, from a large model on a CPU through to a small one on a GPU
+THROUGHPUT_BUCKETS = (1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0)
+
+
+class Metric:
+    TYPE = None
+    INITIAL = 0  # Value of an unlabelled metric before anything is recorded, so it is exposed from the start
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+        if not self.labels and function is None and self.INITIAL is not None:
+            self.values[()] = self.INITIAL
+
+    def key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError(f'{self.name} expects labels {self.labels}, got {labels}')
+        return tuple(str(value) for value in labels)
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        if self.function is not None:
+            # A function returns either a single value or a dictionary of values keyed by label values
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            items = [(self.key(key if isinstance(key, tuple) else (key,)), value)
+                     for key, value in values.items() if value is not None]
+        else:
+            with self.lock:
+                items = list(self.values.items())
+        return [(self.name, self.format_labels(key), value) for key, value in sorted(items)]
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.TYPE}']
+        lines.extend(f'{name}{labels} {format_value(value)}' for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Counter incremented directly, or read from a function returning a running total."""
+
+    TYPE = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Gauge set directly, or read from a function each time the metrics are collected."""
+
+    TYPE = 'gauge'
+
+    def set(self, value, *labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, *labels, amount=1):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+    INITIAL = None
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # Per bucket counts (the last for +Inf), then the sum of the observed values
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            items = [(key, list(counts)) for key, counts in self.values.items()]
+
+        samples = []
+        for key, counts in sorted(items):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', self.format_labels(key, [('le', format_value(bound))]),
+                                cumulative))
+            samples.append((self.name + '_sum', self.format_labels(key), counts[-1]))
+            samples.append((self.name + '_count', self.format_labels(key), cumulative))
+        return samples
+
+
+class Timer:
+    """Context manager observing the time spent within it in seconds."""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Registry:
+    def __init__(self, prefix='urcuchillay'):
+        self.prefix = prefix
+        self.metrics = []
+
+    def add(self, metric):
+        metric.name = f'{self.prefix}_{metric.name}'
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=(), function=None):
+        return self.add(Counter(name, documentation, labels, function))
+
+    def gauge(self, name, documentation, labels=(), function=None):
+        return self.add(Gauge(name, documentation, labels, function))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, documentation, labels, buckets))
+
+    def expose(self):
+        """Render every metric in the Prometheus text exposition format."""
+        return '\n'.join(metric.expose() for metric in self.metrics) + '\n'
+
+
+class HTTPMetrics:
+    """Request counts, latency and concurrency per route, recorded by wrapping an ASGI application."""
+
+    def __init__(self, registry):
+        self.requests = registry.counter(
+            'http_requests_total', 'HTTP requests by route, method and status code', ('route', 'method', 'status'))
+        self.latency = registry.histogram(
+            'http_request_duration_seconds', 'Time to send the complete HTTP response', ('route', 'method'))
+        self.in_progress = registry.gauge('http_requests_in_progress', 'HTTP requests currently being answered')
+
+    def middleware(self, app):
+        async def metrics_middleware(scope, receive, send):
+            if scope['type'] != 'http':
+                return await app(scope, receive, send)
+
+            start = time.perf_counter()
+            status = [500]
+
+            async def send_status(message):
+                if message['type'] == 'http.response.start':
+                    status[0] = message['status']
+                await send(message)
+
+            self.in_progress.inc()
+            try:
+                await app(scope, receive, send_status)
+            finally:
+                self.in_progress.dec()
+                # The router records the matching route in the scope, keeping one series per route template
+                route = getattr(scope.get('route'), 'path', 'unmatched')
+                self.requests.inc(route, scope['method'], status[0])
+                self.latency.observe(time.perf_counter() - start, route, scope['method'])
+
+        return metrics_middleware
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
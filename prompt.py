@@ -5,20 +5,10 @@
 
 import argparse
 import logging
-import sys
 
 import client
 import utils
 
-try:
-    import llama_index
-    import transformers
-except ModuleNotFoundError as e:
-    print('\nError importing Python module(s)')
-    print('If installed using setup.sh it may be necessary to run:\n')
-    print('pyenv activate urcuchillay-env\n')
-    sys.exit(1)
-
 
 DEFAULT_PROMPT = 'What is Urcuchillay AI?'
 
@@ -30,12 +20,17 @@ class Prompt(client.Client):
 
         logging.getLogger().name = __name__
 
+        self.import_modules()
         llm = self.get_llm(args)
+        self.profile.mark('llm')
         service_context = self.get_service_context(llm, args)
+        self.profile.mark('service context')
         index = self.get_index(service_context, args)
+        self.profile.mark('index')
 
         # set up query engine
         self.query_engine = index.as_query_engine()
+        self.profile.report()
 
     def display_exchange(self, query):
         print('Query: %s\n' % query)
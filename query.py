@@ -11,14 +11,7 @@ import sys
 import config
 import utils
 
-try:
-    import llama_index
-    import transformers
-except ModuleNotFoundError as e:
-    print('\nError importing Python module(s)')
-    print('If installed using setup.sh it may be necessary to run:\n')
-    print('pyenv activate urcuchillay-env\n')
-    sys.exit(1)
+utils.require_modules('llama_index', 'transformers')
 
 
 DEFAULT_PROMPT = 'What is Urcuchillay?'
@@ -26,6 +19,9 @@ DEFAULT_PROMPT = 'What is Urcuchillay?'
 
 class Query:
     def __init__(self, args):
+        import embedding
+        import llama_index
+        import transformers
 
         self.debug = args.debug
 
@@ -92,8 +88,11 @@ class Query:
             embed_model = args.embed_model_name
         else:
             # use Huggingface embeddings
-            embed_model = llama_index.embeddings.HuggingFaceEmbedding(
-                model_name=embed_model_provider + '/' + embed_model_name)
+            embed_model = embedding.BatchedHuggingFaceEmbedding.from_args(
+                embed_model_provider + '/' + embed_model_name, args)
+
+        if args.embed_cache:
+            embed_model = embedding.CachedEmbedding.from_args(embed_model, args)
 
         # create a service context
         service_context = llama_index.ServiceContext.from_defaults(
@@ -0,0 +1,84 @@
+# retriever.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import llama_index.retrievers
+import llama_index.schema
+
+
+class CachedRetriever(llama_index.retrievers.BaseRetriever):
+    """Retriever which remembers the ids and scores of the nodes found for earlier queries.
+
+    A query matching a cached one exactly skips both the query embedding and the vector search, and its nodes
+    are read from the vector store with get_nodes. When the cache has a semantic tier, other queries are embedded
+    once and reuse the results of a sufficiently similar cached query, otherwise the embedding is handed to the
+    wrapped retriever for its search.
+    """
+
+    def __init__(self, retriever, cache, scope, get_nodes, embed_model=None):
+        super().__init__(callback_manager=retriever.callback_manager)
+        self.retriever = retriever
+        self.cache = cache
+        self.scope = scope
+        self.get_nodes = get_nodes
+        self.embed_model = embed_model
+
+    def _retrieve(self, query_bundle):
+        scores = self.cache.get(self.scope, query_bundle.query_str)
+        if scores is not None:
+            return self.fetch(scores)
+
+        if self.cache.semantic is not None and self.embed_model is not None and query_bundle.embedding is None:
+            query_bundle.embedding = self.embed_model.get_agg_embedding_from_queries(query_bundle.embedding_strs)
+            scores = self.cache.get_similar(self.scope, query_bundle.embedding)
+            if scores is not None:
+                return self.fetch(scores)
+
+        nodes = self.retriever.retrieve(query_bundle)
+        self.cache.put(self.scope, query_bundle.query_str, [(node.node.node_id, node.score) for node in nodes],
+                       query_bundle.embedding)
+        return nodes
+
+    def fetch(self, scores):
+        nodes = {node.node_id: node for node in self.get_nodes([node_id for node_id, _ in scores])}
+        return [llama_index.schema.NodeWithScore(node=nodes[node_id], score=score)
+                for node_id, score in scores if node_id in nodes]
+
+
+class HybridRetriever(llama_index.retrievers.BaseRetriever):
+    """Retriever fusing the results of a vector search with those of a lexical BM25 search.
+
+    Each search ranks its candidates, and every node is scored by reciprocal rank fusion: the sum over the
+    rankings it appears in of 1 / (rrf_k + rank). Only ranks are compared, so the cosine similarities and BM25
+    scores need no calibration against each other. Nodes found only by the lexical search are read from the
+    vector store with get_nodes.
+    """
+
+    def __init__(self, retriever, lexical_index, get_nodes, similarity_top_k, candidates=20, rrf_k=60):
+        super().__init__(callback_manager=retriever.callback_manager)
+        self.retriever = retriever
+        self.lexical_index = lexical_index
+        self.get_nodes = get_nodes
+        self.similarity_top_k = similarity_top_k
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+
+    def _retrieve(self, query_bundle):
+        nodes = {node.node.node_id: node.node for node in self.retriever.retrieve(query_bundle)}
+        lexical = [node_id for node_id, _ in self.lexical_index.search(query_bundle.query_str, self.candidates)]
+
+        fused = fuse([list(nodes), lexical], self.rrf_k)[:self.similarity_top_k]
+        missing = [node_id for node_id, _ in fused if node_id not in nodes]
+        nodes.update((node.node_id, node) for node in self.get_nodes(missing))
+        return [llama_index.schema.NodeWithScore(node=nodes[node_id], score=score)
+                for node_id, score in fused if node_id in nodes]
+
+
+def fuse(rankings, k=60):
+    """Ids ranked by any of the rankings, ordered by their reciprocal rank fusion scores, with the scores."""
+    scores = {}
+    for ranking in rankings:
+        for rank, node_id in enumerate(ranking, start=1):
+            scores[node_id] = scores.get(node_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -19,7 +19,6 @@ class CustomStreamingResponse(fastapi.responses.StreamingResponse):
         self.headers["Connection"] = "keep-alive"
         self.headers["X-Accel-Buffering"] = "no"
         self.headers["Content-Type"] = "text/event-stream; charset=utf-8"
-        self.headers["OpenAI-Processing-ms"] = "658"  # This should ideally be dynamic
         self.headers["X-Request-ID"] = str(uuid.uuid4()).replace('-', '')  # Generate a unique ID for each request
         self.headers["Transfer-Encoding"] = "chunked"
 
@@ -7,7 +7,10 @@ import argparse
 import logging
 import sys
 
+import metrics
+
 try:
+    import fastapi
     import utils
     import llama_cpp.server.app
     import uvicorn
@@ -37,6 +40,15 @@ class Server:
         self.port = args.api_port
         self.app = llama_cpp.server.app.create_app(settings=settings)
 
+        # Request counts and latency for the model server, scraped from /metrics alongside the gateway's
+        self.registry = metrics.Registry()
+        self.http_metrics = metrics.HTTPMetrics(self.registry)
+        self.app.add_middleware(self.http_metrics.middleware)
+        self.app.add_api_route('/metrics', self.metrics_endpoint, methods=['GET'], include_in_schema=False)
+
+    async def metrics_endpoint(self):
+        return fastapi.Response(content=self.registry.expose(), media_type=metrics.CONTENT_TYPE)
+
     def run(self):
         uvicorn.run(
             self.app, host=self.host, port=int(self.port)
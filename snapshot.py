@@ -0,0 +1,403 @@
+# snapshot.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import json
+import mmap
+import os
+import struct
+
+import numpy
+
+import llama_index
+import llama_index.graph_stores
+import llama_index.storage.docstore
+import llama_index.storage.docstore.keyval_docstore
+import llama_index.storage.index_store
+import llama_index.storage.kvstore.simple_kvstore
+import llama_index.storage.kvstore.types
+import llama_index.vector_stores
+import llama_index.vector_stores.simple
+import llama_index.vector_stores.types
+
+import vectors
+
+# A snapshot holds every store of an index persisted with the json storage type in one file:
+#
+#   magic | header offset and length (two little-endian uint64) | sections ... | header (JSON)
+#
+# Each section starts on an ALIGNMENT byte boundary. Arrays are stored as raw little-endian columns, and
+# tables of byte strings as a run of blobs, each prefixed with its uint32 length, followed by an index of
+# their uint64 offsets. The header, written last, records where each section is and holds the small stores
+# which are needed as soon as the index is loaded. Node ids and docstore keys are written in sorted order so
+# a single node can be found by binary search without reading the others.
+MAGIC = b'URCSNAP\x00'
+VERSION = 1
+FILE = 'index.snapshot'
+PREFIX = struct.Struct('<QQ')
+ALIGNMENT = 64
+BLOCK_SIZE = 4096  # Rows of an array copied to the file at once, bounding the memory used to write it
+NODE_COLLECTION = f'{llama_index.storage.docstore.keyval_docstore.DEFAULT_NAMESPACE}/data'
+
+
+class Snapshot:
+    """A snapshot file mapped into memory, of which only the header is read when it is opened.
+
+    Besides the stores of an index, the same layout holds other data saved beside it, named by kind.
+    """
+
+    def __init__(self, path, kind='index'):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not an index snapshot')
+        offset, length = PREFIX.unpack_from(self.buffer, len(MAGIC))
+        if not offset or offset + length > len(self.buffer):
+            raise ValueError(f'Index snapshot {path} is incomplete, it may need to be rebuilt')
+        self.header = json.loads(self.buffer[offset:offset + length])
+        if self.header.get('version') != VERSION:
+            raise ValueError(f'Unsupported index snapshot version in {path}: {self.header.get("version")}')
+        if self.header.get('kind') != kind:
+            raise ValueError(f'{path} is a snapshot of {self.header.get("kind")}, not {kind}')
+
+    @property
+    def stores(self):
+        return self.header['stores']
+
+    def array(self, name):
+        section = self.header['sections'][name]
+        shape = tuple(section['shape'])
+        return numpy.frombuffer(self.buffer, dtype=section['dtype'], count=int(numpy.prod(shape)),
+                                offset=section['offset']).reshape(shape)
+
+    def blobs(self, name):
+        section = self.header['sections'][name]
+        return Blobs(self.buffer, section['offset'], section['index'], section['count'])
+
+
+class Blobs:
+    """A table of length-prefixed byte strings in a snapshot, located through the index of their offsets."""
+
+    def __init__(self, buffer, offset, index, count):
+        self.buffer = buffer
+        self.offset = offset
+        self.offsets = numpy.frombuffer(buffer, dtype='<u8', count=count, offset=index)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, position):
+        start = self.offset + int(self.offsets[position])
+        length = int.from_bytes(self.buffer[start:start + 4], 'little')
+        return self.buffer[start + 4:start + 4 + length]
+
+    def find(self, key):
+        """Position of key in a table written in sorted order, or None if it is not there."""
+        key = key.encode('utf-8')
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self[middle] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low if low < len(self) and self[low] == key else None
+
+
+class SnapshotVectorStore(llama_index.vector_stores.SimpleVectorStore):
+    """SimpleVectorStore whose embeddings are read from the columns of a snapshot rather than from JSON.
+
+    The ids, document ids and metadata of the nodes are loaded with the header, as SimpleVectorStore holds
+    them, while the embeddings stay in the mapped file and a query scores them all with one matrix-vector
+    product. Embeddings added since the snapshot was loaded are held in memory as SimpleVectorStore holds
+    them, and rows deleted since are masked out. Metadata filters and the other query modes are answered by
+    SimpleVectorStore, after reading every embedding into memory.
+    """
+
+    def __init__(self, data=None, snapshot=None, **kwargs):
+        super().__init__(data=data, **kwargs)
+        self.ids = snapshot.blobs('ids')
+        self.embeddings = snapshot.array('embeddings')
+        self.inverse_norms = snapshot.array('inverse_norms')
+        self.deleted = numpy.zeros(len(self.ids), dtype=bool)
+
+    def find(self, text_id):
+        """Row of the stored embedding of a node, or None if it was never stored or has been deleted."""
+        row = self.ids.find(text_id)
+        return None if row is None or self.deleted[row] else row
+
+    def get(self, text_id):
+        if text_id in self._data.embedding_dict:
+            return super().get(text_id)
+        row = self.find(text_id)
+        if row is None:
+            raise KeyError(text_id)
+        return self.embeddings[row].tolist()
+
+    def add(self, nodes, **add_kwargs):
+        # A node added again replaces its stored embedding
+        for node in nodes:
+            row = self.find(node.node_id)
+            if row is not None:
+                self.deleted[row] = True
+        return super().add(nodes, **add_kwargs)
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        text_ids = [text_id for text_id, ref in self._data.text_id_to_ref_doc_id.items() if ref == ref_doc_id]
+        for text_id in text_ids:
+            row = self.find(text_id)
+            if row is not None:
+                self.deleted[row] = True
+            self._data.embedding_dict.pop(text_id, None)
+            del self._data.text_id_to_ref_doc_id[text_id]
+            self._data.metadata_dict.pop(text_id, None)
+
+    def query(self, query, **kwargs):
+        if query.mode != llama_index.vector_stores.types.VectorStoreQueryMode.DEFAULT or \
+                query.filters is not None or query.node_ids is not None:
+            self.materialize()
+            return super().query(query, **kwargs)
+
+        embedding = vectors.normalize(numpy.asarray(query.query_embedding, dtype=numpy.float32))
+
+        ids, similarities = [], []
+        if len(self.ids):
+            scores = (self.embeddings @ embedding) * self.inverse_norms
+            scores[self.deleted] = -numpy.inf
+            rows = vectors.get_top_k(scores, query.similarity_top_k)
+            rows = rows[scores[rows] > -numpy.inf]
+            ids = [self.ids[row].decode('utf-8') for row in rows]
+            similarities = scores[rows].tolist()
+
+        # Embeddings added since loading are compared as SimpleVectorStore compares them
+        if self._data.embedding_dict:
+            added = get_matrix(self._data.embedding_dict)
+            ids += list(self._data.embedding_dict)
+            similarities += ((added @ embedding) * get_inverse_norms(added)).tolist()
+            order = vectors.get_top_k(numpy.asarray(similarities), query.similarity_top_k)
+            ids, similarities = [ids[i] for i in order], [similarities[i] for i in order]
+
+        return llama_index.vector_stores.types.VectorStoreQueryResult(similarities=similarities, ids=ids)
+
+    def materialize(self):
+        """Read every stored embedding into memory, where SimpleVectorStore keeps them."""
+        for row in numpy.flatnonzero(~self.deleted):
+            self._data.embedding_dict[self.ids[row].decode('utf-8')] = self.embeddings[row].tolist()
+        self.deleted[:] = True
+
+    def get_embeddings(self):
+        """Node ids of every embedding in sorted order, along with the matrix of their embeddings."""
+        rows = numpy.flatnonzero(~self.deleted)
+        ids = [self.ids[row].decode('utf-8') for row in rows] + list(self._data.embedding_dict)
+        parts = [part for part in (self.embeddings[rows], get_matrix(self._data.embedding_dict)) if len(part)]
+        return sort_embeddings(ids, numpy.concatenate(parts) if parts else get_matrix({}))
+
+    def to_dict(self):
+        data = self._data.to_dict()
+        for row in numpy.flatnonzero(~self.deleted):
+            data['embedding_dict'][self.ids[row].decode('utf-8')] = self.embeddings[row].tolist()
+        return data
+
+
+class SnapshotKVStore(llama_index.storage.kvstore.simple_kvstore.SimpleKVStore):
+    """SimpleKVStore whose collection of nodes is read from a snapshot, one node at a time as it is needed.
+
+    The other collections of the docstore are loaded with the header. Nodes put since the snapshot was
+    loaded are held in memory as SimpleKVStore holds them, and nodes deleted since are skipped.
+    """
+
+    def __init__(self, data=None, snapshot=None):
+        super().__init__(data)
+        self.keys = snapshot.blobs('keys')
+        self.nodes = snapshot.blobs('nodes')
+        self.deleted = numpy.zeros(len(self.keys), dtype=bool)
+
+    def find(self, key):
+        row = self.keys.find(key)
+        return None if row is None or self.deleted[row] else row
+
+    def get(self, key, collection=llama_index.storage.kvstore.types.DEFAULT_COLLECTION):
+        if collection != NODE_COLLECTION or key in self._data.get(collection, {}):
+            return super().get(key, collection)
+        row = self.find(key)
+        return None if row is None else json.loads(self.nodes[row])
+
+    def get_all(self, collection=llama_index.storage.kvstore.types.DEFAULT_COLLECTION):
+        if collection != NODE_COLLECTION:
+            return super().get_all(collection)
+        values = {self.keys[row].decode('utf-8'): json.loads(self.nodes[row])
+                  for row in numpy.flatnonzero(~self.deleted)}
+        values.update(super().get_all(collection))
+        return values
+
+    def put(self, key, val, collection=llama_index.storage.kvstore.types.DEFAULT_COLLECTION):
+        if collection == NODE_COLLECTION:
+            row = self.find(key)
+            if row is not None:
+                self.deleted[row] = True
+        super().put(key, val, collection)
+
+    def delete(self, key, collection=llama_index.storage.kvstore.types.DEFAULT_COLLECTION):
+        if collection != NODE_COLLECTION:
+            return super().delete(key, collection)
+        row = self.find(key)
+        if row is not None:
+            self.deleted[row] = True
+        return super().delete(key, collection) or row is not None
+
+    def to_dict(self):
+        return {**self._data, NODE_COLLECTION: self.get_all(NODE_COLLECTION)}
+
+
+def get_inverse_norms(embeddings):
+    """Reciprocal of the length of each embedding, zero for embeddings of zero length."""
+    norms = numpy.linalg.norm(embeddings, axis=1) if len(embeddings) else numpy.zeros(0, dtype=numpy.float32)
+    return numpy.divide(1.0, norms, out=numpy.zeros_like(norms), where=norms > 0).astype(numpy.float32)
+
+
+def get_matrix(embedding_dict):
+    """Embeddings held by a SimpleVectorStore as a float32 matrix, one row per node in the order of the dict."""
+    if not embedding_dict:
+        return numpy.zeros((0, 0), dtype=numpy.float32)
+    return numpy.asarray(list(embedding_dict.values()), dtype=numpy.float32)
+
+
+def sort_embeddings(ids, embeddings):
+    order = sorted(range(len(ids)), key=lambda i: ids[i].encode('utf-8'))
+    return [ids[i] for i in order], embeddings[order]
+
+
+def get_embeddings(vector_store):
+    """Node ids of every embedding in a SimpleVectorStore in sorted order, with the matrix of their embeddings."""
+    if isinstance(vector_store, SnapshotVectorStore):
+        return vector_store.get_embeddings()
+    # noinspection PyProtectedMember
+    embedding_dict = vector_store._data.embedding_dict
+    return sort_embeddings(list(embedding_dict), get_matrix(embedding_dict))
+
+
+def align(f):
+    f.write(b'\0' * (-f.tell() % ALIGNMENT))
+
+
+def write_array(f, array):
+    align(f)
+    array = numpy.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+    section = {'offset': f.tell(), 'shape': list(array.shape), 'dtype': array.dtype.str}
+    for start in range(0, len(array), BLOCK_SIZE):
+        f.write(array[start:start + BLOCK_SIZE].tobytes())
+    return section
+
+
+def write_blobs(f, values):
+    align(f)
+    start = f.tell()
+    offsets = []
+    for value in values:
+        offsets.append(f.tell() - start)
+        f.write(len(value).to_bytes(4, 'little'))
+        f.write(value)
+    align(f)
+    section = {'offset': start, 'index': f.tell(), 'count': len(offsets)}
+    f.write(numpy.asarray(offsets, dtype='<u8').tobytes())
+    return section
+
+
+def save(storage_context, path):
+    """Write the stores of an index persisted with the json storage type as a snapshot under path.
+
+    The snapshot is written to a temporary file which then replaces any earlier snapshot, so a process
+    loading it sees either the previous snapshot or the complete new one.
+    """
+    vector_store = storage_context.vector_store
+    ids, embeddings = get_embeddings(vector_store)
+    # noinspection PyProtectedMember
+    data = vector_store._data
+
+    doc_store = dict(storage_context.docstore.to_dict())
+    nodes = doc_store.pop(NODE_COLLECTION, {})
+    keys = sorted(nodes, key=lambda key: key.encode('utf-8'))
+
+    stores = {
+        'vector_store': {'text_id_to_ref_doc_id': data.text_id_to_ref_doc_id, 'metadata_dict': data.metadata_dict},
+        'vector_stores': {namespace: store.to_dict() for namespace, store in storage_context.vector_stores.items()
+                          if store is not vector_store},
+        'doc_store': doc_store,
+        'index_store': storage_context.index_store.to_dict(),
+        'graph_store': storage_context.graph_store.to_dict(),
+    }
+
+    def write_sections(f):
+        return {
+            'embeddings': write_array(f, embeddings),
+            'inverse_norms': write_array(f, get_inverse_norms(embeddings)),
+            'ids': write_blobs(f, (text_id.encode('utf-8') for text_id in ids)),
+            'keys': write_blobs(f, (key.encode('utf-8') for key in keys)),
+            'nodes': write_blobs(f, (json.dumps(nodes[key]).encode('utf-8') for key in keys)),
+        }
+
+    os.makedirs(path, exist_ok=True)
+    write(os.path.join(path, FILE), write_sections, {
+        'kind': 'index',
+        'count': len(ids),
+        'dimensions': embeddings.shape[1] if embeddings.ndim == 2 else 0,
+        'nodes': len(keys),
+        'stores': stores,
+    })
+    return len(ids)
+
+
+def write(target, write_sections, header):
+    """Write a snapshot file to target through a temporary file which then replaces it.
+
+    write_sections writes the sections to the file it is given and returns where each one is, which is added
+    to the header.
+    """
+    temporary = f'{target}.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(MAGIC + PREFIX.pack(0, 0))
+        sections = write_sections(f)
+        encoded = json.dumps({'version': VERSION, **header, 'sections': sections}).encode('utf-8')
+
+        # The header is only pointed to once everything it describes has been written
+        align(f)
+        offset = f.tell()
+        f.write(encoded)
+        f.seek(len(MAGIC))
+        f.write(PREFIX.pack(offset, len(encoded)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, target)
+
+
+def load(path):
+    """Storage context of the snapshot under path, reading its header and leaving nodes and embeddings mapped."""
+    snapshot = Snapshot(os.path.join(path, FILE))
+    stores = snapshot.stores
+
+    data = llama_index.vector_stores.simple.SimpleVectorStoreData(
+        text_id_to_ref_doc_id=stores['vector_store']['text_id_to_ref_doc_id'],
+        metadata_dict=stores['vector_store']['metadata_dict'])
+    vector_stores = {namespace: llama_index.vector_stores.SimpleVectorStore.from_dict(store)
+                     for namespace, store in stores['vector_stores'].items()}
+    vector_stores[llama_index.vector_stores.simple.DEFAULT_VECTOR_STORE] = SnapshotVectorStore(data, snapshot)
+
+    return llama_index.StorageContext.from_defaults(
+        docstore=llama_index.storage.docstore.SimpleDocumentStore(SnapshotKVStore(stores['doc_store'], snapshot)),
+        index_store=llama_index.storage.index_store.SimpleIndexStore.from_dict(stores['index_store']),
+        vector_stores=vector_stores,
+        graph_store=llama_index.graph_stores.SimpleGraphStore.from_dict(stores['graph_store']))
+
+
+def exists(path):
+    return os.path.exists(os.path.join(path, FILE))
+
+
+def convert(path):
+    """Write the JSON files persisted under path by earlier versions as a snapshot, returning its node count.
+
+    The JSON files are left in place, a snapshot being loaded in preference to them.
+    """
+    return save(llama_index.StorageContext.from_defaults(persist_dir=path), path)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import asyncio
+import unittest
+from admission import AdmissionController, Overloaded
+
+
+class TestAdmissionController(unittest.TestCase):
+
+    def test_queue(self):
+        controller = AdmissionController(concurrency=1, queue_size=2)
+        order = []
+
+        async def request(name, priority=0):
+            with await controller.acquire(priority):
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        async def run():
+            first = asyncio.ensure_future(request('first'))
+            await asyncio.sleep(0)
+            queued = [asyncio.ensure_future(request('low')), asyncio.ensure_future(request('high', priority=1))]
+            await asyncio.sleep(0)
+            with self.assertRaises(Overloaded) as context:
+                await controller.acquire()
+            self.assertGreaterEqual(context.exception.retry_after, 1)
+            await asyncio.gather(first, *queued)
+
+        asyncio.run(run())
+        self.assertEqual(order, ['first', 'high', 'low'])
+        stats = controller.stats()
+        self.assertEqual((stats['admitted'], stats['rejected'], stats['max_queue_depth']), (3, 1, 2))
+        self.assertEqual((stats['active'], stats['queue_depth']), (0, 0))
+
+    def test_cancelled_waiter(self):
+        controller = AdmissionController(concurrency=1, queue_size=2)
+
+        async def run():
+            ticket = await controller.acquire()
+            waiter = asyncio.ensure_future(controller.acquire())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.sleep(0)
+            self.assertEqual(controller.stats()['queue_depth'], 0)
+            ticket.release()
+            ticket.release()
+            self.assertEqual(controller.stats()['active'], 0)
+
+        asyncio.run(run())
+
+    def test_unlimited(self):
+        controller = AdmissionController(concurrency=0, queue_size=0)
+
+        async def run():
+            return [await controller.acquire() for _ in range(5)]
+
+        self.assertEqual(len(asyncio.run(run())), 5)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import httpx
+import uvicorn
+from benchmarks import corpus, load, retrieval, stub
+import gateway
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(app, port):
+    """Start serving the app on a background thread, returning the server once it accepts connections."""
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError(f'server on port {port} failed to start')
+        time.sleep(0.01)
+    return server, thread
+
+
+class TestLoad(unittest.TestCase):
+
+    def test_percentile(self):
+        self.assertIsNone(load.percentile([], 0.5))
+        self.assertEqual(load.percentile([3, 1, 2], 0.5), 2)
+        self.assertAlmostEqual(load.percentile([1, 2, 3, 4], 0.95), 3.85)
+
+    def test_get_requests(self):
+        requests = list(load.get_requests(['a', 'b'], ['completions', 'chat'], [False, True], 5, unique=True))
+        self.assertEqual(len(requests), 5)
+        self.assertEqual(requests[:2], [('completions', 'a (0)', False), ('completions', 'a (1)', True)])
+        self.assertEqual(len({prompt for _, prompt, _ in requests}), 5)
+
+    def test_run_against_stub(self):
+        app = stub.create_app(tokens=5, first_token_delay=0, token_delay=0)
+        args = argparse.Namespace(model='stub', max_tokens=16)
+
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url='http://stub') as client:
+                requests = load.get_requests(load.PROMPTS, list(load.ENDPOINTS), [False, True], 8, False)
+                return await load.run(client, requests, concurrency=2, args=args)
+
+        samples, duration = asyncio.run(run())
+        result = load.report(samples, duration)
+
+        overall = result['overall']
+        self.assertEqual((overall['requests'], overall['errors']), (8, 0))
+        self.assertEqual(overall['tokens'], 40)
+        self.assertIsNotNone(overall['ttft_ms'])
+        self.assertEqual(set(result['by_endpoint']), {'completions', 'completions-stream', 'chat', 'chat-stream'})
+        self.assertTrue(all(len(sample['itl']) == 4 for sample in samples if sample['stream']))
+
+    def test_benchmark_against_stub(self):
+        app = stub.create_app(tokens=3, first_token_delay=0, token_delay=0)
+        argv = ['load.py', '--url', 'http://stub', '--requests', '6', '--warmup', '2', '--concurrency', '3',
+                '--model', 'stub', '--max_tokens', '8']
+        with unittest.mock.patch.object(sys, 'argv', argv):
+            args = load.parse_arguments()
+
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            result = await load.benchmark(args, transport=transport)
+            async with httpx.AsyncClient(transport=transport, base_url='http://stub') as client:
+                return result, (await client.get('/stats')).json()
+
+        result, stats = asyncio.run(run())
+        # Warmup requests are sent but left out of the report
+        self.assertEqual(stats['requests'], 8)
+        self.assertEqual((result['overall']['requests'], result['overall']['errors']), (6, 0))
+        self.assertEqual(result['overall']['tokens'], 18)
+        self.assertEqual(result['settings']['concurrency'], 3)
+        self.assertEqual(len(result['by_endpoint']), 4)
+
+    def test_benchmark_against_gateway(self):
+        stub_port, gateway_port = get_free_port(), get_free_port()
+        with tempfile.TemporaryDirectory() as data, tempfile.TemporaryDirectory() as storage:
+            with open(os.path.join(data, 'llama.txt'), 'w', encoding='utf-8') as file:
+                file.write('Urcuchillay is the llama deity watching over the herds.')
+
+            # The gateway indexes the data with the stub's embeddings, and answers with its completions
+            argv = ['gateway.py', '--api_host', '127.0.0.1', '--api_port', str(stub_port), '--data', data,
+                    '--storage', storage, '--embed_model_name', 'default']
+            with unittest.mock.patch.object(sys, 'argv', argv):
+                gateway.app.state.args = gateway.parse_arguments()
+            argv = ['load.py', '--url', f'http://127.0.0.1:{gateway_port}', '--requests', '8', '--concurrency', '2',
+                    '--max_tokens', '8']
+            with unittest.mock.patch.object(sys, 'argv', argv):
+                args = load.parse_arguments()
+
+            servers = []
+            try:
+                servers.append(serve(stub.create_app(tokens=3, first_token_delay=0, token_delay=0), stub_port))
+                servers.append(serve(gateway.app, gateway_port))
+                result = asyncio.run(load.benchmark(args))
+            finally:
+                for server, thread in reversed(servers):
+                    server.should_exit = True
+                    thread.join()
+
+        self.assertEqual((result['overall']['requests'], result['overall']['errors']), (8, 0))
+        for endpoint in ('completions-stream', 'chat-stream'):
+            self.assertGreater(result['by_endpoint'][endpoint]['tokens'], 0)
+
+    def test_errors(self):
+        app = stub.create_app(tokens=1, first_token_delay=0, token_delay=0)
+        args = argparse.Namespace(model='stub', max_tokens=16)
+
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url='http://stub/missing') as client:
+                return await load.run(client, [('chat', 'hello', False)], args=args)
+
+        samples, duration = asyncio.run(run())
+        overall = load.summarize(samples, duration)
+        self.assertEqual((overall['errors'], overall['error_rate']), (1, 1.0))
+        self.assertEqual(overall['error_types'], {'HTTP 404': 1})
+
+
+class TestCorpus(unittest.TestCase):
+
+    def test_corpus(self):
+        first, second = corpus.Corpus(documents=4, topics=2, seed=1), corpus.Corpus(documents=4, topics=2, seed=1)
+        self.assertEqual(first.document(first.topics[0]), second.document(second.topics[0]))
+        self.assertEqual(len(first.document(first.topics[1]).split('\n\n')), 5)
+        self.assertEqual(len(first.queries(3)), 3)
+
+    def test_hash_embedding(self):
+        embed_model = corpus.HashEmbedding(embed_dim=64)
+        query = embed_model.get_query_embedding('llama gateway index')
+        similar = embed_model.get_text_embedding('the llama gateway index')
+        different = embed_model.get_text_embedding('unrelated words entirely')
+        self.assertEqual(len(query), 64)
+        self.assertAlmostEqual(sum(value * value for value in query), 1.0)
+        self.assertGreater(sum(a * b for a, b in zip(query, similar)), sum(a * b for a, b in zip(query, different)))
+
+
+class TestRetrieval(unittest.TestCase):
+
+    def test_flatten(self):
+        result = {'storage': {'json': {'load_seconds': 0.5, 'nodes': 10, 'query_ms': {'top_k=2': None}}}}
+        self.assertEqual(retrieval.flatten(result), {'storage.json.load_seconds': 0.5, 'storage.json.nodes': 10})
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import unittest
+import unittest.mock
+from cache import LRUCache, SemanticCache, SimilarityCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)  # 'b' is now the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['hits'], 3)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_ttl(self):
+        cache = LRUCache(max_entries=2, ttl=10)
+        with unittest.mock.patch('time.monotonic', return_value=100.0):
+            cache.put('a', 1)
+        with unittest.mock.patch('time.monotonic', return_value=105.0):
+            self.assertEqual(cache.get('a'), 1)
+        with unittest.mock.patch('time.monotonic', return_value=111.0):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+
+class TestSimilarityCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = SimilarityCache(max_entries=2)
+        cache.put('a', 'scope', [1.0, 0.0], 1)
+        cache.put('b', 'other', [0.0, 1.0], 2)
+        self.assertEqual(cache.get('scope', [1.0, 0.0], 0.9), 1)
+        cache.put('c', 'scope', [0.0, 1.0], 3)  # 'b' is now the least recently used
+        self.assertIsNone(cache.get('other', [0.0, 1.0], 0.9))
+        self.assertEqual(cache.get('scope', [0.0, 1.0], 0.9), 3)
+        self.assertEqual(cache.get('scope', [1.0, 0.0], 0.9), 1)
+        # Rows are reused in place, and scopes are forgotten along with their last row
+        self.assertEqual(cache.matrix.shape, (2, 2))
+        self.assertEqual(list(cache.scope_ids), ['scope'])
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl(self):
+        cache = SimilarityCache(max_entries=2, ttl=10)
+        with unittest.mock.patch('time.monotonic', return_value=100.0):
+            cache.put('a', 'scope', [1.0, 0.0], 1)
+        with unittest.mock.patch('time.monotonic', return_value=105.0):
+            self.assertEqual(cache.get('scope', [1.0, 0.0], 0.9), 1)
+        with unittest.mock.patch('time.monotonic', return_value=111.0):
+            self.assertIsNone(cache.get('scope', [1.0, 0.0], 0.9))
+
+
+class TestSemanticCache(unittest.TestCase):
+
+    def test_exact(self):
+        cache = SemanticCache(max_entries=10)
+        cache.put('scope', 'What is  Urcuchillay?', 'A llama deity')
+        self.assertEqual(cache.get('scope', 'what is urcuchillay?'), 'A llama deity')
+        self.assertIsNone(cache.get('other', 'what is urcuchillay?'))
+        self.assertIsNone(cache.get_similar('scope', [1.0, 0.0]))  # Semantic tier disabled
+
+    def test_semantic(self):
+        cache = SemanticCache(max_entries=10, similarity=0.9)
+        cache.put('scope', 'first', 'one', embedding=[1.0, 0.0])
+        cache.put('scope', 'second', 'two', embedding=[0.0, 1.0])
+        self.assertEqual(cache.get_similar('scope', [0.95, 0.1]), 'one')
+        self.assertIsNone(cache.get_similar('scope', [0.7, 0.7]))
+        self.assertIsNone(cache.get_similar('other', [1.0, 0.0]))
+        self.assertEqual(cache.stats()['semantic_hits'], 1)
+
+        cache.clear()
+        self.assertIsNone(cache.get('scope', 'first'))
+        self.assertIsNone(cache.get_similar('scope', [1.0, 0.0]))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import unittest
+import unittest.mock
+from cancellation import Cancellation, guard, scope, track
+from llms import CancellableOpenAI
+
+
+class TestCancellation(unittest.TestCase):
+
+    def test_guard(self):
+        cancelled = Cancellation()
+        response = unittest.mock.Mock()
+        closed = []
+
+        def tokens():
+            try:
+                for token in 'abc':
+                    track(response)  # Stands in for the API request made as the stream advances
+                    yield token
+            finally:
+                closed.append(True)
+
+        stream = guard(tokens(), cancelled)
+        self.assertEqual(next(stream), 'a')
+        cancelled.set()
+        self.assertEqual(list(stream), [])
+        self.assertEqual(closed, [True])
+        response.close.assert_called_once()
+
+    def test_guard_complete(self):
+        self.assertEqual(list(guard((token for token in 'abc'), Cancellation())), list('abc'))
+
+    def test_scope(self):
+        cancelled = Cancellation()
+        generator = iter('abc')
+        self.assertIs(CancellableOpenAI.guard(generator), generator)
+        with scope(cancelled):
+            self.assertIsNot(CancellableOpenAI.guard(generator), generator)
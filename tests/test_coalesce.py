@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import asyncio
+import unittest
+from coalesce import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_do(self):
+        flights = SingleFlight()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        async def run():
+            results = await asyncio.gather(*[flights.do('key', compute) for _ in range(3)])
+            # A request arriving after the computation finished starts a new one
+            results.append(await flights.do('key', compute))
+            return results
+
+        self.assertEqual(asyncio.run(run()), ['result'] * 4)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(flights.stats(), {'started': 2, 'joined': 2, 'in_flight': 0})
+
+    def test_stream(self):
+        flights = SingleFlight()
+        calls = []
+
+        async def tokens():
+            calls.append(1)
+            for token in 'abc':
+                await asyncio.sleep(0.01)
+                yield token
+
+        async def consume(delay):
+            await asyncio.sleep(delay)
+            return [token async for token in flights.stream('key', tokens)]
+
+        async def run():
+            # The late subscriber joins part way through and still receives every token
+            return await asyncio.gather(consume(0), consume(0.015))
+
+        self.assertEqual(asyncio.run(run()), [list('abc'), list('abc')])
+        self.assertEqual(len(calls), 1)
+
+    def test_stream_error(self):
+        flights = SingleFlight()
+
+        async def tokens():
+            yield 'a'
+            raise ValueError('failed')
+
+        async def consume():
+            received = []
+            with self.assertRaises(ValueError):
+                async for token in flights.stream('key', tokens):
+                    received.append(token)
+            return received
+
+        self.assertEqual(asyncio.run(consume()), ['a'])
+
+    def test_stream_abandoned(self):
+        flights = SingleFlight()
+        cancelled = []
+
+        async def tokens():
+            try:
+                for token in 'abc':
+                    await asyncio.sleep(0.01)
+                    yield token
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def first_token():
+            stream = flights.stream('key', tokens)
+            token = await anext(stream)
+            await stream.aclose()
+            return token
+
+        async def consume():
+            return [token async for token in flights.stream('key', tokens)]
+
+        async def run():
+            # One subscriber leaving early does not stop the stream for the others
+            results = await asyncio.gather(first_token(), consume())
+            await asyncio.sleep(0)
+            self.assertEqual(cancelled, [])
+
+            # Once every subscriber has left the source is cancelled
+            self.assertEqual(await first_token(), 'a')
+            await asyncio.sleep(0)
+            self.assertEqual(cancelled, [True])
+            return results
+
+        self.assertEqual(asyncio.run(run()), ['a', list('abc')])
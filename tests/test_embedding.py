@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import importlib.util
+import tempfile
+import types
+import unittest
+import llama_index
+from embedding import BatchedHuggingFaceEmbedding, EmbeddingCache, CachedEmbedding
+
+
+class CountingEmbedding(llama_index.MockEmbedding):
+    calls: int = 0
+
+    def _get_text_embeddings(self, texts):
+        self.calls += len(texts)
+        return [[float(len(text))] * self.embed_dim for text in texts]
+
+
+class FakeTokenizer:
+    """Tokenizes each character of a text, padding every batch to its longest text."""
+
+    name_or_path = 'fake'
+
+    def __call__(self, sentences, padding, max_length, truncation, return_tensors):
+        import torch
+
+        length = min(max(len(sentence) for sentence in sentences), max_length)
+        input_ids = torch.zeros((len(sentences), length), dtype=torch.long)
+        attention_mask = torch.zeros((len(sentences), length), dtype=torch.long)
+        for row, sentence in enumerate(sentences):
+            codes = [ord(character) % 50 + 1 for character in sentence[:length]]
+            input_ids[row, :len(codes)] = torch.tensor(codes)
+            attention_mask[row, :len(codes)] = 1
+        return {'input_ids': input_ids, 'attention_mask': attention_mask, 'token_type_ids': input_ids * 0}
+
+
+class FakeModel:
+    """Token embeddings which depend on each token and its position, so every text embeds differently."""
+
+    name_or_path = 'fake'
+    config = types.SimpleNamespace(max_position_embeddings=64)
+
+    def to(self, _device):
+        return self
+
+    def __call__(self, input_ids, attention_mask):
+        import torch
+
+        positions = torch.arange(input_ids.shape[1]).expand_as(input_ids)
+        return (torch.stack((input_ids, input_ids * input_ids, input_ids * positions, attention_mask), dim=-1).float(),)
+
+
+class TestEmbeddingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_get_put(self):
+        cache = EmbeddingCache(self.temp_dir.name + '/cache.sqlite', max_entries=10)
+        key = EmbeddingCache.get_hash('text', 'hello')
+        self.assertEqual(cache.get('model', [key]), {})
+        cache.put('model', {key: [0.5, 1.0]})
+        self.assertEqual(cache.get('model', [key]), {key: [0.5, 1.0]})
+        self.assertEqual(cache.get('other', [key]), {})
+        self.assertNotEqual(key, EmbeddingCache.get_hash('query', 'hello'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_eviction(self):
+        cache = EmbeddingCache(self.temp_dir.name + '/cache.sqlite', max_entries=2)
+        cache.put('model', {'a': [1.0]})
+        cache.put('model', {'b': [2.0]})
+        cache.get('model', ['a'])
+        cache.put('model', {'c': [3.0]})
+        self.assertEqual(set(cache.get('model', ['a', 'b', 'c'])), {'a', 'c'})
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_cached_embedding(self):
+        cache = EmbeddingCache(self.temp_dir.name + '/cache.sqlite', max_entries=10)
+        inner = CountingEmbedding(embed_dim=2)
+        embed_model = CachedEmbedding(inner, cache)
+
+        first = embed_model.get_text_embedding_batch(['a', 'bb', 'a'])
+        self.assertEqual(first, [[1.0, 1.0], [2.0, 2.0], [1.0, 1.0]])
+        self.assertEqual(inner.calls, 2)
+
+        second = embed_model.get_text_embedding_batch(['bb', 'ccc'])
+        self.assertEqual(second, [[2.0, 2.0], [3.0, 3.0]])
+        self.assertEqual(inner.calls, 3)
+
+    def test_clear(self):
+        cache = EmbeddingCache(self.temp_dir.name + '/cache.sqlite', max_entries=10)
+        cache.put('model', {'a': [1.0]})
+        cache.clear()
+        self.assertEqual(cache.get('model', ['a']), {})
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_key(self):
+        def get_key(model, api_base='http://localhost:8000/v1'):
+            embed_model = llama_index.embeddings.OpenAIEmbedding(api_base=api_base, api_key='none')
+            return CachedEmbedding.get_key(embed_model, types.SimpleNamespace(model=model))
+
+        # The API server names its embeddings the same whichever model it serves
+        self.assertNotEqual(get_key('llama-2-7b-chat'), get_key('mistral-7b-instruct'))
+        self.assertNotEqual(get_key('llama-2-7b-chat'), get_key('llama-2-7b-chat', 'http://remote:8000/v1'))
+        self.assertEqual(get_key('llama-2-7b-chat'), get_key('llama-2-7b-chat'))
+        self.assertEqual(CachedEmbedding.get_key(CountingEmbedding(embed_dim=2), types.SimpleNamespace(model='x')),
+                         CountingEmbedding(embed_dim=2).model_name)
+
+
+@unittest.skipUnless(importlib.util.find_spec('torch') and importlib.util.find_spec('transformers'),
+                     'requires torch and transformers')
+class TestBatchedHuggingFaceEmbedding(unittest.TestCase):
+
+    def test_order(self):
+        texts = ['a', 'llama gateway index', 'bb', 'quipu knots record numbers', 'ccc', 'the', 'local documents', 'x']
+        embed_model = BatchedHuggingFaceEmbedding(model=FakeModel(), tokenizer=FakeTokenizer(), pooling='mean',
+                                                  device='cpu', embed_batch_size=3)
+        # Each text embedded alone, so no batch can mix up which embedding belongs to which text
+        expected = [embed_model.get_text_embedding_batch([text])[0] for text in texts]
+
+        for sort_by_length in (False, True):
+            for pipeline in (False, True):
+                embed_model.sort_by_length = sort_by_length
+                embed_model.pipeline = pipeline
+                embeddings = embed_model.get_text_embedding_batch(texts)
+                self.assertEqual(len(embeddings), len(texts))
+                for embedding, expected_embedding in zip(embeddings, expected):
+                    for value, expected_value in zip(embedding, expected_embedding):
+                        self.assertAlmostEqual(value, expected_value, places=5)
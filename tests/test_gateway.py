@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import asyncio
+import concurrent.futures
+import threading
+import types
+import unittest
+import unittest.mock
+import llama_index
+import llama_index.llms
+import admission
+import cache
+import coalesce
+from benchmarks.corpus import HashEmbedding
+import gateway
+
+
+def get_gateway(concurrency, queue_size, response_cache=None):
+    # Only the parts of the gateway which admit and answer requests, without a model or an index
+    instance = gateway.Gateway.__new__(gateway.Gateway)
+    instance.admission = admission.AdmissionController(concurrency, queue_size)
+    instance.flights = coalesce.SingleFlight()
+    instance.response_cache = response_cache
+    return instance
+
+
+class TestGateway(unittest.TestCase):
+
+    def setUp(self):
+        self.request = types.SimpleNamespace(headers={})
+        self.generations = 0
+
+    async def generate(self):
+        self.generations += 1
+        await asyncio.sleep(0.01)
+        return 'answer'
+
+    async def generate_tokens(self, _stages):
+        self.generations += 1
+        for token in ('an', 'swer'):
+            await asyncio.sleep(0.01)
+            yield token
+
+    def test_coalesce_before_admission(self):
+        instance = get_gateway(concurrency=1, queue_size=1)
+
+        async def run():
+            return await asyncio.gather(*(instance.answer(self.request, 'scope', 'prompt', self.generate)
+                                          for _ in range(8)))
+
+        # Identical requests join the one being answered instead of queueing behind it
+        self.assertEqual([text for text, _ in asyncio.run(run())], ['answer'] * 8)
+        self.assertEqual(self.generations, 1)
+        self.assertEqual(instance.admission.stats()['admitted'], 1)
+        self.assertEqual(instance.admission.stats()['rejected'], 0)
+        self.assertEqual(instance.admission.active, 0)
+
+    def test_coalesce_stream_before_admission(self):
+        instance = get_gateway(concurrency=1, queue_size=1)
+
+        async def read():
+            tokens = await instance.answer_stream(self.request, 'scope', 'prompt', self.generate_tokens)
+            return [(token, is_last) async for token, is_last, _ in tokens]
+
+        async def run():
+            return await asyncio.gather(*(read() for _ in range(8)))
+
+        self.assertEqual(asyncio.run(run()), [[('an', False), ('swer', True)]] * 8)
+        self.assertEqual(self.generations, 1)
+        self.assertEqual(instance.admission.stats()['rejected'], 0)
+        self.assertEqual(instance.admission.active, 0)
+
+    def test_cache_hit_not_admitted(self):
+        response_cache = cache.SemanticCache(10)
+        response_cache.put('scope', 'prompt', 'cached')
+        instance = get_gateway(concurrency=1, queue_size=0, response_cache=response_cache)
+
+        async def run():
+            with await instance.admission.acquire():
+                text, _ = await instance.answer(self.request, 'scope', 'prompt', self.generate)
+                tokens = await instance.answer_stream(self.request, 'scope', 'prompt', self.generate_tokens)
+                return text, [token async for token, _, _ in tokens]
+
+        # The only slot is taken and nothing may wait, yet cached responses are still returned
+        self.assertEqual(asyncio.run(run()), ('cached', ['cached']))
+        self.assertEqual(self.generations, 0)
+
+    def test_semantic_lookup_off_event_loop(self):
+        response_cache = cache.SemanticCache(10, similarity=0.9)
+        response_cache.put('scope', 'prompt', 'cached', embedding=[1.0] * 16)
+        instance = get_gateway(concurrency=1, queue_size=1, response_cache=response_cache)
+        instance.executor = concurrent.futures.ThreadPoolExecutor(1)
+        instance.service_context = types.SimpleNamespace(embed_model=types.SimpleNamespace(
+            get_query_embedding=lambda prompt: [1.0] * 16))
+        threads = []
+        get_similar = response_cache.get_similar
+
+        def record(*args):
+            threads.append(threading.current_thread())
+            return get_similar(*args)
+
+        with unittest.mock.patch.object(response_cache, 'get_similar', record):
+            self.assertEqual(asyncio.run(instance.lookup_response('scope', 'another prompt'))[0], 'cached')
+        instance.executor.shutdown()
+        self.assertIsNot(threads[0], threading.main_thread())
+
+    def test_rejected(self):
+        instance = get_gateway(concurrency=1, queue_size=0)
+
+        async def run():
+            with await instance.admission.acquire():
+                with self.assertRaises(gateway.fastapi.HTTPException) as context:
+                    await instance.answer_stream(self.request, 'scope', 'prompt', self.generate_tokens)
+                return context.exception.status_code
+
+        self.assertEqual(asyncio.run(run()), 429)
+        self.assertEqual(self.generations, 0)
+
+    def test_chat_engine_query_engine(self):
+        instance = get_gateway(concurrency=1, queue_size=1)
+        instance.llm = llama_index.llms.MockLLM()
+        instance.service_context = llama_index.ServiceContext.from_defaults(
+            llm=instance.llm, embed_model=HashEmbedding(embed_dim=16))
+        instance.index = llama_index.VectorStoreIndex.from_documents(
+            [llama_index.Document(text='llama gateway index')], service_context=instance.service_context)
+        instance.lexical_index = None
+        instance.retrieval_cache = None
+        instance.generation = 0
+        instance.engines = {}
+        instance.engines_lock = threading.Lock()
+        instance.chat_mode = 'condense_question'
+        instance.similarity_top_k = 1
+
+        # Chatting switches streaming on its query engine, which must not be the one completions are answered by
+        shared = instance.get_query_engine()
+        first, second = instance.get_chat_engine([]), instance.get_chat_engine([])
+        self.assertIsNot(first._query_engine, shared)
+        self.assertIsNot(first._query_engine, second._query_engine)
+        self.assertIs(first._query_engine.retriever, instance.get_retriever())
+        first.stream_chat('llama')
+        self.assertFalse(shared._response_synthesizer._streaming)
+
+    def test_add_headers(self):
+        response = gateway.add_headers(gateway.fastapi.Response(content='{}'),
+                                       [('Set-Cookie', 'a=1'), ('Set-Cookie', 'b=2')])
+        self.assertEqual(response.headers.getlist('set-cookie'), ['a=1', 'b=2'])
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import argparse
+import concurrent.futures
+import hashlib
+import os
+import tempfile
+import unittest
+import llama_index
+import llama_index.llms
+import client
+from benchmarks.corpus import Corpus, HashEmbedding
+from ingest import Manifest, Pipeline, file_hash
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.data_path = os.path.join(self.temp_dir.name, 'data')
+        self.storage_path = os.path.join(self.temp_dir.name, 'storage')
+        os.makedirs(self.data_path)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, name, text, mtime=None):
+        path = os.path.join(self.data_path, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_scan(self):
+        first = self.write('first.txt', 'first')
+        second = self.write('second.txt', 'second')
+
+        manifest = Manifest(self.storage_path)
+        self.assertEqual(manifest.scan([first, second]), ([first, second], [], []))
+        manifest.update(first, ['doc-1'])
+        manifest.update(second, ['doc-2'])
+        manifest.save()
+
+        manifest = Manifest.load(self.storage_path)
+        self.assertEqual(manifest.scan([first, second]), ([], [], []))
+
+        # Same content with a new modification time is not a change
+        self.write('first.txt', 'first', mtime=1)
+        self.assertEqual(manifest.scan([first, second]), ([], [], []))
+        self.assertEqual(manifest.files[first]['mtime'], 1)
+
+        self.write('second.txt', 'changed')
+        third = self.write('third.txt', 'third')
+        self.assertEqual(manifest.scan([second, third]), ([third], [second], [first]))
+        self.assertEqual(manifest.discard(first), ['doc-1'])
+        self.assertEqual(manifest.discard(first), [])
+
+    def test_load_missing(self):
+        self.assertEqual(Manifest.load(self.storage_path).files, {})
+        Manifest.remove(self.storage_path)
+
+    def test_file_hash(self):
+        path = self.write('hash.txt', 'urcuchillay')
+        self.assertEqual(file_hash(path), hashlib.sha256(b'urcuchillay').hexdigest())
+        self.assertEqual(file_hash(path, chunk_size=3), file_hash(path))
+
+
+class RecordingPool:
+    """Pool which counts the files submitted to it."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.submitted = 0
+
+    def submit(self, *args):
+        self.submitted += 1
+        return self.pool.submit(*args)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.storage_path = os.path.join(self.temp_dir.name, 'storage')
+        self.paths = []
+        corpus = Corpus(documents=6, topics=3, seed=1)
+        for number in range(6):
+            path = os.path.join(self.temp_dir.name, f'{number}.txt')
+            with open(path, 'w') as f:
+                f.write(corpus.document(corpus.topics[number % 3]))
+            self.paths.append(path)
+        self.service_context = llama_index.ServiceContext.from_defaults(
+            llm=llama_index.llms.MockLLM(), embed_model=HashEmbedding(embed_dim=16), chunk_size=64, chunk_overlap=8)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def get_index(self):
+        return llama_index.VectorStoreIndex([], service_context=self.service_context)
+
+    def get_nodes(self, index):
+        return sorted((node.metadata['file_path'], node.get_content()) for node in index.docstore.docs.values())
+
+    def test_matches_serial(self):
+        serial_index, serial_manifest = self.get_index(), Manifest(self.storage_path)
+        client.Client.ingest_files(serial_index, self.paths, serial_manifest, argparse.Namespace(ingest_workers=None))
+
+        index, manifest = self.get_index(), Manifest(self.storage_path)
+        batches = []
+        insert_nodes = index.insert_nodes
+        index.insert_nodes = lambda nodes: batches.append(len(nodes)) or insert_nodes(nodes)
+        pipeline = Pipeline.from_service_context(self.service_context, workers=2, batch_size=8)
+        pipeline.run(index, self.paths, manifest)
+
+        self.assertEqual(self.get_nodes(index), self.get_nodes(serial_index))
+        self.assertEqual((pipeline.files, pipeline.nodes), (6, len(serial_index.docstore.docs)))
+        # Nodes are inserted as each batch fills, rather than all at once
+        self.assertGreater(len(batches), 1)
+        self.assertEqual(sum(batches), pipeline.nodes)
+
+        # Each file records the documents its nodes came from, as the serial path does
+        self.assertEqual(sorted(manifest.files), sorted(serial_manifest.files))
+        ref_doc_ids = {}
+        for node in index.docstore.docs.values():
+            ref_doc_ids.setdefault(node.metadata['file_path'], set()).add(node.ref_doc_id)
+        for path, entry in manifest.files.items():
+            self.assertEqual(set(entry['doc_ids']), ref_doc_ids[path])
+            self.assertEqual(len(entry['doc_ids']), len(serial_manifest.files[path]['doc_ids']))
+            self.assertEqual(entry['sha256'], serial_manifest.files[path]['sha256'])
+
+    def test_in_flight(self):
+        pipeline = Pipeline(workers=2, batch_size=8, chunk_size=64, chunk_overlap=8)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            pool = RecordingPool(executor)
+            paths = []
+            for path, _, _ in pipeline.map(pool, self.paths):
+                # No more than two files per worker are parsed ahead of those already consumed
+                self.assertLessEqual(pool.submitted - len(paths), 4)
+                paths.append(path)
+        self.assertEqual(sorted(paths), sorted(self.paths))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import os
+import tempfile
+import unittest
+from lexical import LexicalIndex, tokenize
+
+
+class TestLexicalIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+        self.texts = {
+            'a': 'The replacement gasket for the pump is part QX-1138.',
+            'b': 'The llama gateway answers questions about the index.',
+            'c': 'Quipu knots record numbers, and quipu cords record more numbers.',
+        }
+        self.requested = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def get_texts(self, node_ids):
+        self.requested.extend(node_ids)
+        return [(node_id, self.texts[node_id]) for node_id in node_ids]
+
+    def update(self):
+        return LexicalIndex.update(self.path, list(self.texts), self.get_texts)
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize('Part QX-1138, v2.1'), ['part', 'qx-1138', 'v2.1', 'qx', '1138', 'qx1138', 'v2', '1',
+                                                           'v21'])
+
+    def test_search(self):
+        index, added, removed = self.update()
+        self.assertEqual((added, removed, index.count), (3, 0, 3))
+        self.assertTrue(os.path.exists(os.path.join(self.path, LexicalIndex.FILE)))
+
+        loaded = LexicalIndex.load(self.path)
+        for query in ('QX-1138', 'qx1138', 'part qx 1138'):
+            self.assertEqual(loaded.search(query, 3)[0][0], 'a')
+        # Terms repeated within a node score higher, and terms in most nodes add little
+        results = loaded.search('the numbers', 3)
+        self.assertEqual(results[0][0], 'c')
+        self.assertGreater(results[0][1], 1.5 * results[1][1])
+        self.assertEqual(len(loaded.search('quipu gateway', 1)), 1)
+        self.assertEqual(loaded.search('unknown words', 3), [])
+
+    def test_update(self):
+        self.update()
+        self.requested.clear()
+        self.assertEqual(self.update()[1:], (0, 0))
+        self.assertEqual(self.requested, [])
+
+        # Only nodes which were added are tokenized, and removed nodes are never returned
+        del self.texts['a']
+        self.texts['d'] = 'Gasket QX-1139 supersedes the earlier part.'
+        index, added, removed = self.update()
+        self.assertEqual((added, removed, self.requested), (1, 1, ['d']))
+        self.assertEqual(sorted(index.get_ids()), ['b', 'c', 'd'])
+        self.assertEqual([node_id for node_id, _ in index.search('gasket part', 3)], ['d'])
+        self.assertEqual(index.search('quipu', 3)[0][0], 'c')
+
+    def test_empty(self):
+        index, added, removed = LexicalIndex.update(self.path, [], self.get_texts)
+        self.assertEqual((index.count, added, removed), (0, 0, 0))
+        self.assertEqual(index.search('gasket', 3), [])
+        self.assertIsNone(LexicalIndex.load(os.path.join(self.path, 'missing')))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import asyncio
+import unittest
+from metrics import HTTPMetrics, Registry
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter_and_gauge(self):
+        registry = Registry(prefix='test')
+        requests = registry.counter('requests_total', 'Requests', ('path',))
+        registry.gauge('depth', 'Queue depth', function=lambda: 3)
+        registry.gauge('hit_ratio', 'Hit ratio', ('cache',), function=lambda: {'retrieval': 0.5})
+        requests.inc('/a')
+        requests.inc('/a')
+        requests.inc('/"b"')
+
+        text = registry.expose()
+        self.assertIn('# TYPE test_requests_total counter', text)
+        self.assertIn('test_requests_total{path="/a"} 2\n', text)
+        self.assertIn('test_requests_total{path="/\\"b\\""} 1\n', text)
+        self.assertIn('test_depth 3\n', text)
+        self.assertIn('test_hit_ratio{cache="retrieval"} 0.5\n', text)
+        self.assertTrue(text.endswith('\n'))
+
+        with self.assertRaises(ValueError):
+            requests.inc()
+
+    def test_histogram(self):
+        registry = Registry(prefix='test')
+        latency = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+        self.assertNotIn('test_latency_seconds_count', registry.expose())
+
+        for value in (0.05, 0.1, 0.5, 2.0):
+            latency.observe(value)
+
+        text = registry.expose()
+        self.assertIn('test_latency_seconds_bucket{le="0.1"} 2\n', text)
+        self.assertIn('test_latency_seconds_bucket{le="1"} 3\n', text)
+        self.assertIn('test_latency_seconds_bucket{le="+Inf"} 4\n', text)
+        self.assertIn('test_latency_seconds_sum 2.65\n', text)
+        self.assertIn('test_latency_seconds_count 4\n', text)
+
+    def test_http_middleware(self):
+        registry = Registry(prefix='test')
+        http_metrics = HTTPMetrics(registry)
+
+        class Route:
+            path = '/v1/items/{item_id}'
+
+        async def app(scope, receive, send):
+            scope['route'] = Route()
+            await send({'type': 'http.response.start', 'status': 201})
+
+        async def send(message):
+            pass
+
+        scope = {'type': 'http', 'method': 'POST', 'path': '/v1/items/42'}
+        asyncio.run(http_metrics.middleware(app)(scope, None, send))
+
+        text = registry.expose()
+        self.assertIn('test_http_requests_total{route="/v1/items/{item_id}",method="POST",status="201"} 1\n', text)
+        self.assertIn('test_http_requests_in_progress 0\n', text)
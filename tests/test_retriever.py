@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import tempfile
+import unittest
+import llama_index
+import llama_index.llms
+from cache import SemanticCache
+from lexical import LexicalIndex
+from retriever import CachedRetriever, HybridRetriever, fuse
+
+
+class TestCachedRetriever(unittest.TestCase):
+
+    def setUp(self):
+        self.service_context = llama_index.ServiceContext.from_defaults(
+            llm=llama_index.llms.MockLLM(), embed_model=llama_index.MockEmbedding(embed_dim=8))
+        self.index = llama_index.VectorStoreIndex.from_documents(
+            [llama_index.Document(text='hello world'), llama_index.Document(text='urcuchillay llama')],
+            service_context=self.service_context)
+        self.fetched = []
+
+    def get_nodes(self, node_ids):
+        self.fetched.extend(node_ids)
+        return self.index.docstore.get_nodes(node_ids)
+
+    def test_exact(self):
+        cache = SemanticCache(max_entries=10)
+        retriever = CachedRetriever(self.index.as_retriever(similarity_top_k=1), cache, scope=(0, 1),
+                                    get_nodes=self.get_nodes)
+        first = retriever.retrieve('Hello world')
+        second = retriever.retrieve('hello  WORLD')
+        self.assertEqual([(node.node_id, node.score) for node in first],
+                         [(node.node_id, node.score) for node in second])
+        # Only the ids and scores are cached, and the nodes are read again
+        self.assertEqual(cache.get((0, 1), 'hello world'), [(first[0].node_id, first[0].score)])
+        self.assertEqual(self.fetched, [first[0].node_id])
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_semantic(self):
+        cache = SemanticCache(max_entries=10, similarity=0.99)
+        retriever = CachedRetriever(self.index.as_retriever(similarity_top_k=1), cache, scope=(0, 1),
+                                    get_nodes=self.get_nodes, embed_model=self.service_context.embed_model)
+        retriever.retrieve('first question')
+        # MockEmbedding gives every query the same embedding
+        self.assertEqual(len(retriever.retrieve('second question')), 1)
+        self.assertEqual(cache.stats()['semantic_hits'], 1)
+
+
+class TestHybridRetriever(unittest.TestCase):
+
+    def test_fuse(self):
+        fused = fuse([['a', 'b', 'c'], ['c', 'd']], k=1)
+        self.assertEqual([node_id for node_id, _ in fused], ['c', 'a', 'b', 'd'])
+        self.assertAlmostEqual(fused[0][1], 1 / 4 + 1 / 2)
+
+    def test_retrieve(self):
+        service_context = llama_index.ServiceContext.from_defaults(
+            llm=llama_index.llms.MockLLM(), embed_model=llama_index.MockEmbedding(embed_dim=8))
+        documents = [llama_index.Document(text=f'filler paragraph {number}') for number in range(5)]
+        documents.append(llama_index.Document(text='order part QX-1138 for the pump'))
+        index = llama_index.VectorStoreIndex.from_documents(documents, service_context=service_context)
+        nodes = index.docstore.docs
+
+        with tempfile.TemporaryDirectory() as path:
+            lexical_index, _, _ = LexicalIndex.update(
+                path, list(nodes), lambda node_ids: [(node_id, nodes[node_id].get_content()) for node_id in node_ids])
+            # MockEmbedding gives every text the same embedding, so only the lexical search can find the part
+            retriever = HybridRetriever(index.as_retriever(similarity_top_k=2), lexical_index,
+                                        lambda node_ids: [nodes[node_id] for node_id in node_ids], similarity_top_k=2)
+            results = retriever.retrieve('QX1138')
+        self.assertEqual(len(results), 2)
+        self.assertIn('order part QX-1138 for the pump', [node.node.get_content() for node in results])
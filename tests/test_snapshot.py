@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import os
+import tempfile
+import unittest
+import llama_index
+import llama_index.llms
+import llama_index.vector_stores.types
+import snapshot
+from benchmarks.corpus import HashEmbedding
+
+
+def retrieve(index, text, top_k=3):
+    return [(node.node.node_id, node.node.get_content(), round(node.score, 5))
+            for node in index.as_retriever(similarity_top_k=top_k).retrieve(text)]
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+        self.service_context = llama_index.ServiceContext.from_defaults(
+            llm=llama_index.llms.MockLLM(), embed_model=HashEmbedding(embed_dim=64))
+        self.documents = [llama_index.Document(text=text) for text in
+                          ('llama gateway index', 'quipu knots record numbers', 'part number QX-1138 gasket')]
+        self.index = llama_index.VectorStoreIndex.from_documents(self.documents, service_context=self.service_context)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def load(self):
+        return llama_index.load_index_from_storage(snapshot.load(self.path), service_context=self.service_context)
+
+    def test_round_trip(self):
+        self.assertEqual(snapshot.save(self.index.storage_context, self.path), 3)
+        self.assertEqual(os.listdir(self.path), [snapshot.FILE])
+
+        loaded = self.load()
+        self.assertIsInstance(loaded.vector_store, snapshot.SnapshotVectorStore)
+        # Nodes are only read from the snapshot as they are retrieved
+        self.assertNotIn(snapshot.NODE_COLLECTION, loaded.docstore._kvstore._data)
+        for text in ('quipu knots', 'gasket part number', 'llama'):
+            self.assertEqual(retrieve(loaded, text), retrieve(self.index, text))
+        node_id = next(iter(loaded.index_struct.nodes_dict))
+        # Embeddings are stored as float32
+        for stored, original in zip(loaded.vector_store.get(node_id), self.index.vector_store.get(node_id)):
+            self.assertAlmostEqual(stored, original, places=6)
+
+    def test_filters(self):
+        snapshot.save(self.index.storage_context, self.path)
+        loaded = self.load()
+        node_id = retrieve(self.index, 'llama gateway index', 1)[0][0]
+        query = llama_index.vector_stores.types.VectorStoreQuery(
+            query_embedding=HashEmbedding(embed_dim=64).get_query_embedding('quipu'), similarity_top_k=3,
+            node_ids=[node_id])
+        self.assertEqual(loaded.vector_store.query(query).ids, [node_id])
+
+    def test_delete_and_insert(self):
+        snapshot.save(self.index.storage_context, self.path)
+        loaded = self.load()
+        loaded.delete_ref_doc(self.documents[1].doc_id, delete_from_docstore=True)
+        loaded.insert(llama_index.Document(text='quipu knots in a museum'))
+        self.assertEqual(retrieve(loaded, 'quipu knots', 1)[0][1], 'quipu knots in a museum')
+
+        # Saving over the snapshot being read from replaces it with the merged stores
+        self.assertEqual(snapshot.save(loaded.storage_context, self.path), 3)
+        reloaded = self.load()
+        self.assertEqual(sorted(node.get_content() for node in reloaded.docstore.docs.values()),
+                         ['llama gateway index', 'part number QX-1138 gasket', 'quipu knots in a museum'])
+        self.assertIsNone(reloaded.docstore.get_ref_doc_info(self.documents[1].doc_id))
+        self.assertEqual(len(reloaded.index_struct.nodes_dict), 3)
+
+    def test_empty(self):
+        index = llama_index.VectorStoreIndex([], service_context=self.service_context)
+        self.assertEqual(snapshot.save(index.storage_context, self.path), 0)
+        self.assertEqual(retrieve(self.load(), 'llama'), [])
+
+    def test_incomplete(self):
+        snapshot.save(self.index.storage_context, self.path)
+        path = os.path.join(self.path, snapshot.FILE)
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 1)
+        with self.assertRaises(ValueError):
+            snapshot.load(self.path)
+
+    def test_convert(self):
+        self.index.storage_context.persist(persist_dir=self.path)
+        self.assertEqual(snapshot.convert(self.path), 3)
+        self.assertTrue(snapshot.exists(self.path))
+        self.assertEqual(retrieve(self.load(), 'gasket'), retrieve(self.index, 'gasket'))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import tempfile
+import threading
+import unittest
+import llama_index
+import llama_index.llms
+from cache import SemanticCache
+from callbacks import TimingHandler
+from lexical import LexicalIndex
+from llama_index.callbacks import CallbackManager, CBEventType
+from metrics import Registry
+from retriever import CachedRetriever, HybridRetriever
+from timings import Timings, scope
+
+
+class TestTimings(unittest.TestCase):
+
+    def setUp(self):
+        self.histogram = Registry(prefix='test').histogram('stage_seconds', 'Stages', ('stage',))
+        self.callback_manager = CallbackManager([TimingHandler(self.histogram)])
+
+    def test_stages(self):
+        timings = Timings()
+        with scope(timings):
+            with self.callback_manager.event(CBEventType.RETRIEVE):
+                # Nested events of the same type, such as a cached retriever's, count once
+                with self.callback_manager.event(CBEventType.RETRIEVE):
+                    with self.callback_manager.event(CBEventType.EMBEDDING):
+                        pass
+            event_id = self.callback_manager.on_event_start(CBEventType.LLM)
+
+        # Streams may end on another thread, outside the scope
+        thread = threading.Thread(target=self.callback_manager.on_event_end, args=(CBEventType.LLM,),
+                                  kwargs={'event_id': event_id})
+        thread.start()
+        thread.join()
+
+        stages = timings.to_dict(total=0.5)
+        self.assertEqual(list(stages), ['embedding', 'retrieval', 'llm', 'total'])
+        self.assertEqual(stages['total'], 500.0)
+
+        counts = {labels: value for name, labels, value in self.histogram.samples() if name.endswith('_count')}
+        self.assertEqual(counts['{stage="retrieve"}'], 1)
+        self.assertEqual(counts['{stage="llm"}'], 1)
+
+        headers = timings.headers(0.5)
+        self.assertEqual(headers['OpenAI-Processing-ms'], '500')
+        self.assertTrue(headers['Server-Timing'].startswith('embedding;dur='))
+
+    def test_outside_request(self):
+        with self.callback_manager.event(CBEventType.EMBEDDING):
+            pass
+        counts = [value for name, labels, value in self.histogram.samples() if name.endswith('_count')]
+        self.assertEqual(counts, [1])
+
+    def get_counts(self):
+        return {labels: value for name, labels, value in self.histogram.samples() if name.endswith('_count')}
+
+    def test_nested_retrievers(self):
+        service_context = llama_index.ServiceContext.from_defaults(
+            llm=llama_index.llms.MockLLM(), embed_model=llama_index.MockEmbedding(embed_dim=8),
+            callback_manager=self.callback_manager)
+        index = llama_index.VectorStoreIndex.from_documents(
+            [llama_index.Document(text='llama gateway index'), llama_index.Document(text='quipu knots')],
+            service_context=service_context)
+        nodes = index.docstore.docs
+
+        with tempfile.TemporaryDirectory() as path:
+            lexical_index, _, _ = LexicalIndex.update(
+                path, list(nodes), lambda node_ids: [(node_id, nodes[node_id].get_content()) for node_id in node_ids])
+            # As the gateway builds it, each retriever retrieving with the one it wraps
+            get_nodes = index.docstore.get_nodes
+            retriever = CachedRetriever(HybridRetriever(
+                index.as_retriever(similarity_top_k=1), lexical_index, get_nodes, similarity_top_k=1),
+                SemanticCache(max_entries=10), scope=(0, 1), get_nodes=get_nodes)
+
+            timings = Timings()
+            with scope(timings):
+                retriever.retrieve('quipu knots')
+            self.assertEqual(self.get_counts()['{stage="retrieve"}'], 1)
+            retriever.retrieve('llama')
+            self.assertEqual(self.get_counts()['{stage="retrieve"}'], 2)
+        self.assertEqual(list(timings.to_dict()), ['embedding', 'retrieval'])
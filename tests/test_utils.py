@@ -4,12 +4,15 @@
 # See LICENSE file in the project root for full license information.
 
 import argparse
+import asyncio
 import os
 import sys
 import typing
 import unittest.mock
+import httpx
 from utils import parse_arguments, update_arguments_common, str2bool, get_base_type, contains_list_type, \
-    is_argument_defined, generate_message_id, create_temporary_empty_file, get_valid_filename
+    is_argument_defined, lookahead, alookahead, remove_hop_by_hop_headers, generate_message_id, \
+    create_temporary_empty_file, get_valid_filename
 
 
 class TestUtils(unittest.TestCase):
@@ -68,6 +71,32 @@ class TestUtils(unittest.TestCase):
         self.assertIsInstance(message_id, str)
         self.assertTrue('cmpl-' in message_id)
 
+    def test_lookahead(self):
+        self.assertEqual(list(lookahead([])), [])
+        self.assertEqual(list(lookahead(['a'])), [('a', True)])
+        self.assertEqual(list(lookahead(iter('abc'))), [('a', False), ('b', False), ('c', True)])
+
+    def test_alookahead(self):
+        async def items(values):
+            for value in values:
+                yield value
+
+        async def collect(values):
+            return [pair async for pair in alookahead(items(values))]
+
+        self.assertEqual(asyncio.run(collect([])), [])
+        self.assertEqual(asyncio.run(collect('ab')), [('a', False), ('b', True)])
+
+    def test_remove_hop_by_hop_headers(self):
+        headers = {'Connection': 'keep-alive, X-Trace', 'Keep-Alive': 'timeout=5', 'X-Trace': '1',
+                   'Transfer-Encoding': 'chunked', 'Host': 'localhost', 'Content-Type': 'application/json'}
+        self.assertEqual(remove_hop_by_hop_headers(headers, excluded=['host']),
+                         [('Content-Type', 'application/json')])
+
+        # Repeated headers are kept apart rather than joined into a single value
+        headers = httpx.Headers([('Set-Cookie', 'a=1'), ('Set-Cookie', 'b=2'), ('Connection', 'close')])
+        self.assertEqual(remove_hop_by_hop_headers(headers), [('set-cookie', 'a=1'), ('set-cookie', 'b=2')])
+
     def test_create_temporary_empty_file(self):
         temp_file_path = create_temporary_empty_file()
         self.assertIsInstance(temp_file_path, str)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import argparse
+import os
+import tempfile
+import unittest
+import unittest.mock
+import numpy
+import llama_index
+import llama_index.llms
+import llama_index.schema
+import llama_index.vector_stores.types
+import client
+import config
+from benchmarks.corpus import HashEmbedding
+from vectors import Codes, IVFIndex, NumpyVectorStore, get_top_k, measure_recall, sample_queries
+
+
+def get_node(text, embedding, ref_doc_id):
+    node = llama_index.schema.TextNode(text=text, embedding=embedding, metadata={'file_name': f'{ref_doc_id}.txt'})
+    node.relationships[llama_index.schema.NodeRelationship.SOURCE] = llama_index.schema.RelatedNodeInfo(
+        node_id=ref_doc_id)
+    return node
+
+
+def query(store, embedding, top_k):
+    return store.query(llama_index.vector_stores.types.VectorStoreQuery(
+        query_embedding=embedding, similarity_top_k=top_k))
+
+
+class TestNumpyVectorStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+        self.nodes = [get_node('north', [1.0, 0.0, 0.0], 'a'), get_node('east', [0.0, 2.0, 0.0], 'a'),
+                      get_node('up', [0.0, 0.0, 1.0], 'b'), get_node('north east', [1.0, 1.0, 0.0], 'c')]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_query(self):
+        store = NumpyVectorStore()
+        self.assertEqual(store.add(self.nodes), [node.node_id for node in self.nodes])
+        result = query(store, [3.0, 0.1, 0.0], 2)
+        self.assertEqual([node.get_content() for node in result.nodes], ['north', 'north east'])
+        self.assertAlmostEqual(result.similarities[0], 0.99944, places=4)
+        self.assertEqual(result.ids, [self.nodes[0].node_id, self.nodes[3].node_id])
+        self.assertEqual(len(query(store, [1.0, 0.0, 0.0], 10).nodes), 4)
+
+    def test_persist(self):
+        store = NumpyVectorStore(dtype='float16')
+        store.add(self.nodes)
+        store.persist(self.path)
+        self.assertIsInstance(store.vectors, numpy.memmap)
+
+        loaded = NumpyVectorStore.from_persist_dir(self.path)
+        self.assertIsInstance(loaded.vectors, numpy.memmap)
+        self.assertEqual(loaded.vectors.dtype, numpy.float16)
+        result = query(loaded, [0.0, 0.0, 1.0], 1)
+        self.assertEqual(result.nodes[0].get_content(), 'up')
+        self.assertEqual(result.nodes[0].ref_doc_id, 'b')
+        self.assertEqual(result.nodes[0].metadata, {'file_name': 'b.txt'})
+        # Node ids are not needed to query
+        self.assertIsNone(loaded.ids)
+
+    def test_delete_and_add(self):
+        store = NumpyVectorStore()
+        store.add(self.nodes)
+        store.persist(self.path)
+
+        loaded = NumpyVectorStore.from_persist_dir(self.path)
+        loaded.delete('a')
+        loaded.add([get_node('west', [-1.0, 0.0, 0.0], 'd')])
+        self.assertEqual(loaded.count(), 3)
+        self.assertEqual([node.get_content() for node in query(loaded, [1.0, 0.0, 0.0], 4).nodes],
+                         ['north east', 'up', 'west'])
+
+        loaded.persist(self.path)
+        reloaded = NumpyVectorStore.from_persist_dir(self.path)
+        self.assertEqual(reloaded.count(), 3)
+        self.assertEqual(reloaded.get_ids()[1], ['b', 'c', 'd'])
+        self.assertEqual(query(reloaded, [-1.0, 0.0, 0.0], 1).nodes[0].get_content(), 'west')
+
+    def test_empty(self):
+        self.assertEqual(NumpyVectorStore.from_persist_dir(self.path).count(), 0)
+        store = NumpyVectorStore()
+        self.assertEqual(query(store, [1.0, 0.0, 0.0], 2).nodes, [])
+        store.persist(self.path)
+        self.assertEqual(query(NumpyVectorStore.from_persist_dir(self.path), [1.0, 0.0, 0.0], 2).nodes, [])
+
+    def test_incomplete(self):
+        store = NumpyVectorStore()
+        store.add(self.nodes)
+        store.persist(self.path)
+        numpy.save(os.path.join(self.path, NumpyVectorStore.VECTORS), numpy.zeros((2, 3), dtype=numpy.float32))
+        with self.assertRaises(ValueError):
+            NumpyVectorStore.from_persist_dir(self.path)
+
+    def test_dimensions(self):
+        store = NumpyVectorStore()
+        store.add(self.nodes)
+        with self.assertRaises(ValueError):
+            store.add([get_node('flat', [1.0, 0.0], 'e')])
+
+    def test_top_k(self):
+        scores = numpy.array([0.1, 0.9, 0.5, 0.7], dtype=numpy.float32)
+        self.assertEqual(get_top_k(scores, 2).tolist(), [1, 3])
+        self.assertEqual(get_top_k(scores, 4).tolist(), [1, 3, 2, 0])
+
+    def test_ivf(self):
+        random = numpy.random.default_rng(0)
+        centers = numpy.eye(8, dtype=numpy.float32)
+        nodes = [get_node(f'node {number}', (centers[number % 8] + 0.1 * random.standard_normal(8)).tolist(),
+                          f'doc {number % 50}') for number in range(400)]
+        store = NumpyVectorStore(ann_index='ivf', ivf_lists=8, ivf_nprobe=1, ivf_min_nodes=100)
+        store.add(nodes)
+        store.persist(self.path)
+        self.assertTrue(os.path.exists(os.path.join(self.path, IVFIndex.CENTROIDS)))
+
+        loaded = NumpyVectorStore.from_persist_dir(self.path, ivf_nprobe=1)
+        self.assertIsNone(loaded.ivf)
+        rows, _ = loaded.search(centers[3], 5)
+        self.assertEqual(loaded.get_ivf().lists, 8)
+        self.assertEqual({int(node.get_content().split()[1]) % 8 for node in map(loaded.get_node, rows)}, {3})
+
+        queries = sample_queries(loaded.get_vectors(), 20, distance=0.1)
+        result = measure_recall(lambda query, k: loaded.search(query, k)[0].tolist(),
+                                lambda query, k: loaded.search(query, k, nprobe=0)[0].tolist(), queries, 5)
+        self.assertGreater(result['recall'], 0.9)
+
+        # Rows added since the index was built are searched exhaustively, and deleted rows are never returned
+        loaded.delete('doc 3')
+        loaded.add([get_node('new', centers[3].tolist(), 'doc new')])
+        found = [loaded.get_node(row).get_content() for row in loaded.search(centers[3], 50)[0]]
+        self.assertEqual(found[0], 'new')
+        self.assertNotIn('node 3', found)
+
+        # Below ivf_min_nodes the store is searched exactly and the index files are removed
+        small = NumpyVectorStore(ann_index='ivf', ivf_min_nodes=1000)
+        small.add(self.nodes)
+        small.persist(self.path)
+        self.assertIsNone(small.get_ivf())
+        self.assertFalse(os.path.exists(os.path.join(self.path, IVFIndex.CENTROIDS)))
+
+    def test_quantization(self):
+        random = numpy.random.default_rng(0)
+        nodes = [get_node(f'node {number}', random.standard_normal(64).tolist(), f'doc {number}')
+                 for number in range(300)]
+        # Sign bits of random vectors keep far less of their similarity than bytes do
+        for kind, dtype, width, recall in (('int8', numpy.int8, 64, 0.95), ('binary', numpy.uint8, 8, 0.6)):
+            store = NumpyVectorStore(quantization=kind, rescore=8)
+            store.add(nodes)
+            store.persist(self.path)
+
+            loaded = NumpyVectorStore.from_persist_dir(self.path, rescore=8)
+            self.assertEqual(loaded.codes.kind, kind)
+            self.assertEqual((loaded.codes.codes.dtype, loaded.codes.codes.shape), (dtype, (300, width)))
+            queries = sample_queries(loaded.get_vectors(), 20)
+            result = measure_recall(lambda query, k: loaded.search(query, k)[0].tolist(),
+                                    lambda query, k: loaded.search(query, k, rescore=0)[0].tolist(), queries, 3)
+            self.assertGreater(result['recall'], recall)
+
+            # Similarities are always re-scored at full precision
+            rows, similarities = loaded.search(nodes[5].embedding, 1)
+            self.assertEqual(rows.tolist(), [5])
+            self.assertAlmostEqual(float(similarities[0]), 1.0, places=5)
+
+        store = NumpyVectorStore()
+        store.add(nodes)
+        store.persist(self.path)
+        self.assertIsNone(NumpyVectorStore.from_persist_dir(self.path).codes)
+        self.assertFalse(os.path.exists(os.path.join(self.path, Codes.CODES)))
+
+    def test_index(self):
+        service_context = llama_index.ServiceContext.from_defaults(
+            llm=llama_index.llms.MockLLM(), embed_model=HashEmbedding(embed_dim=64))
+        storage_context = llama_index.StorageContext.from_defaults(vector_store=NumpyVectorStore())
+        documents = [llama_index.Document(text='llama gateway index'), llama_index.Document(text='quipu knots')]
+        index = llama_index.VectorStoreIndex.from_documents(
+            documents, storage_context=storage_context, service_context=service_context)
+        index.vector_store.persist(self.path)
+
+        loaded = llama_index.VectorStoreIndex.from_vector_store(
+            NumpyVectorStore.from_persist_dir(self.path), service_context=service_context)
+        nodes = loaded.as_retriever(similarity_top_k=1).retrieve('quipu knots')
+        self.assertEqual(nodes[0].node.get_content(), 'quipu knots')
+
+        loaded.delete_ref_doc(documents[1].doc_id)
+        self.assertEqual(loaded.vector_store.count(), 1)
+
+
+class TestChromaCollection(unittest.TestCase):
+
+    def test_hnsw_params(self):
+        args = argparse.Namespace(debug=False, api_host=config.APIConfig.API_HOST, api_port=config.APIConfig.API_PORT)
+        with tempfile.TemporaryDirectory() as path:
+            with unittest.mock.patch.object(config.Config, 'HNSW_M', 8):
+                collection = client.Client(args).get_chroma_collection(path)
+                collection.add(ids=['a'], embeddings=[[1.0, 0.0]])
+            self.assertEqual(client.Client.get_hnsw_params(collection)['hnsw:M'], 8)
+
+            # The graph keeps the parameters it was created with, and so does the metadata describing it
+            with unittest.mock.patch.object(config.Config, 'HNSW_SEARCH_EF', 50), self.assertLogs(level='WARNING'):
+                reopened = client.Client(args).get_chroma_collection(path)
+            params = client.Client.get_hnsw_params(reopened)
+            self.assertEqual((params['hnsw:M'], params['hnsw:search_ef']), (8, config.Config.HNSW_SEARCH_EF))
+            self.assertEqual(reopened.metadata['hnsw:M'], 8)
+            self.assertEqual(reopened.query(query_embeddings=[[1.0, 0.0]], n_results=1)['ids'], [['a']])
@@ -0,0 +1,70 @@
+# timings.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import contextlib
+import contextvars
+import threading
+import time
+
+# Timings of the request which the retrieval and generation started in this context are serving
+current = contextvars.ContextVar('timings', default=None)
+
+# Stages reported per request, keyed by the type of the LlamaIndex events which measure them
+STAGES = {
+    'embedding': 'embedding',
+    'retrieve': 'retrieval',
+    'templating': 'prompt',
+    'llm': 'llm',
+}
+
+
+class Timings:
+    """Time spent by one request in each stage, in the order the stages first started.
+
+    Stages overlap: retrieval includes embedding the query, and llm_first_token is part of llm.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.starts = {}
+        self.durations = {}
+        self.lock = threading.Lock()
+
+    def begin(self, stage):
+        with self.lock:
+            self.starts.setdefault(stage, time.perf_counter())
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    def first_token(self):
+        """Record the time from the LLM being called until it produced its first token."""
+        now = time.perf_counter()
+        with self.lock:
+            self.durations['llm_first_token'] = now - self.starts.get('llm', self.start)
+
+    def to_dict(self, total=None):
+        """Durations in milliseconds, along with the total processing time if given."""
+        with self.lock:
+            durations = dict(self.durations)
+        if total is not None:
+            durations['total'] = total
+        return {stage: round(1000 * seconds, 1) for stage, seconds in durations.items()}
+
+    def headers(self, total):
+        """Response headers reporting the timings, total being the processing time in seconds."""
+        server_timing = ', '.join(f'{stage};dur={ms}' for stage, ms in self.to_dict(total).items())
+        return {'OpenAI-Processing-ms': str(round(1000 * total)), 'Server-Timing': server_timing}
+
+
+@contextlib.contextmanager
+def scope(timings):
+    """Record the stages of retrieval and generation started within this block in timings."""
+    token = current.set(timings)
+    try:
+        yield timings
+    finally:
+        current.reset(token)
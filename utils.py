@@ -4,11 +4,14 @@
 # See LICENSE file in the project root for full license information.
 
 import argparse
+import importlib.util
 import logging
 import os
 import requests
 import string
+import sys
 import tempfile
+import time
 import tqdm
 import typing
 import urllib.parse
@@ -16,6 +19,9 @@ import uuid
 
 import config
 
+# Start of the startup profile, as this module is among the first imported by every entry point
+STARTED = time.perf_counter()
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Process command parameters')
@@ -65,6 +71,24 @@ def parse_arguments_common(parser):
                         help='Request gateway to reload indexed vector store (default: %(default)s)')
     parser.add_argument('--reset', '--clear', type=str2bool, nargs='?', const=True, default=False,
                         help='Reset indexed vector store (default: %(default)s)')
+    parser.add_argument('--embed_batch_size', type=int, default=config.Config.EMBED_BATCH_SIZE,
+                        help='Number of texts embedded per batch (default: %(default)s)')
+    parser.add_argument('--embed_threads', type=int, default=config.Config.EMBED_THREADS,
+                        help='Number of torch intra-op threads for embedding, 0 for the default (default: %(default)s)')
+    parser.add_argument('--embed_max_length', type=int, default=config.Config.EMBED_MAX_LENGTH,
+                        help='Maximum number of tokens per embedded text (default: model maximum)')
+    parser.add_argument('--embed_sort_by_length', type=str2bool, nargs='?', const=True,
+                        default=config.Config.EMBED_SORT_BY_LENGTH,
+                        help='Batch texts of similar length together to reduce padding (default: %(default)s)')
+    parser.add_argument('--embed_pipeline', type=str2bool, nargs='?', const=True, default=config.Config.EMBED_PIPELINE,
+                        help='Tokenize the next batch while the model embeds the current one (default: %(default)s)')
+    parser.add_argument('--tokenizers_parallelism', type=str2bool, nargs='?', const=True,
+                        default=config.Config.TOKENIZERS_PARALLELISM,
+                        help='Allow tokenizers to use multiple threads (default: %(default)s)')
+    parser.add_argument('--embed_cache', type=str2bool, nargs='?', const=True, default=config.Config.EMBED_CACHE,
+                        help='Cache computed embeddings in the storage path (default: %(default)s)')
+    parser.add_argument('--embed_cache_size', type=int, default=config.Config.EMBED_CACHE_SIZE,
+                        help='Maximum number of cached embeddings (default: %(default)s)')
     parser.add_argument('--data', '--data_path', type=str, default=config.Config.DATA_PATH,
                         help='The path to data files to be indexed (default: %(default)s)')
     parser.add_argument('--path', '--model_path', type=str, default=config.Config.MODEL_PATH,
@@ -75,6 +99,8 @@ def parse_arguments_common(parser):
                         help='Custom URL for model (defaults to the %(default)s) model)')
     parser.add_argument('--model', '--model_name', type=str, default=config.Config.MODEL_DEFAULT,
                         help='The name of the model to use (default: extracted from model url)')
+    parser.add_argument('--profile_startup', '--profile-startup', type=str2bool, nargs='?', const=True,
+                        default=False, help='Report the time taken by each phase of startup (default: %(default)s)')
     return parser
 
 
@@ -99,6 +125,38 @@ def update_arguments_common(args):
     return args
 
 
+def require_modules(*names):
+    """Exit with installation advice if a module is missing, without the cost of importing it."""
+    if any(importlib.util.find_spec(name) is None for name in names):
+        print('\nError importing Python module(s)')
+        print('If installed using setup.sh it may be necessary to run:\n')
+        print('pyenv activate urcuchillay-env\n')
+        sys.exit(1)
+
+
+class StartupProfile:
+    """Time taken by each phase of starting up, each phase ending where the next is marked."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.last = STARTED
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        if not self.enabled:
+            return
+        total = sum(seconds for _, seconds in self.phases)
+        print('Startup profile:')
+        for phase, seconds in self.phases:
+            print(f'  {phase:<24} {seconds:8.3f}s {seconds / max(total, 1e-9):6.1%}')
+        print(f'  {"total":<24} {total:8.3f}s')
+
+
 def str2bool(arg):
     """Parse boolean arguments."""
     if isinstance(arg, bool):
@@ -162,6 +220,54 @@ def generate_message_id():
     return f"cmpl-{random_uuid}"
 
 
+def generate_job_id():
+    return f"job-{uuid.uuid4()}"
+
+
+def lookahead(iterable):
+    """Yield (item, is_last) pairs without consuming more than one item ahead."""
+    iterator = iter(iterable)
+    try:
+        previous = next(iterator)
+    except StopIteration:
+        return
+    for item in iterator:
+        yield previous, False
+        previous = item
+    yield previous, True
+
+
+async def alookahead(iterable):
+    """Asynchronous lookahead(), yielding (item, is_last) pairs from an async iterable."""
+    sentinel = object()
+    iterator = aiter(iterable)
+    previous = await anext(iterator, sentinel)
+    if previous is sentinel:
+        return
+    async for item in iterator:
+        yield previous, False
+        previous = item
+    yield previous, True
+
+
+# Source: RFC 2616, section 13.5.1
+HOP_BY_HOP_HEADERS = ['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                      'te', 'trailers', 'transfer-encoding', 'upgrade']
+
+
+def remove_hop_by_hop_headers(headers, excluded=None):
+    """Copy headers for proxying as (key, value) pairs, dropping hop-by-hop headers and any listed in Connection.
+
+    Repeated headers, such as Set-Cookie, stay separate pairs, where httpx.Headers.items() would join them.
+    """
+    items = list(headers.multi_items() if hasattr(headers, 'multi_items') else headers.items())
+    excluded = set(HOP_BY_HOP_HEADERS + [header.lower() for header in excluded or []])
+    for key, value in items:
+        if key.lower() == 'connection':
+            excluded.update(option.strip().lower() for option in value.split(','))
+    return [(key, value) for key, value in items if key.lower() not in excluded]
+
+
 def create_temporary_empty_file():
     """Create a temporary empty file and return its path."""
     temp_file = tempfile.NamedTemporaryFile(delete=False)
@@ -252,14 +358,30 @@ def get_valid_filename(url, default_extension='.download'):
     return cleaned_filename
 
 
-def request_gateway_load(host, port):
+def request_gateway_load(host, port, wait=True, interval=1.0):
     url = f'http://{host}:{port}/v0/gateway/load'
     response = requests.get(url)
 
-    if response.status_code == 200:
-        print("Index loaded successfully")
-    else:
+    if response.status_code != 200:
         print("Error loading index:", response.text)
+        return
+
+    job = response.json()['job']
+    print("Index load started:", job['id'])
+
+    # The gateway builds the new index in the background, poll until it has been swapped in
+    while wait and job['status'] in ('pending', 'running'):
+        time.sleep(interval)
+        response = requests.get(f'http://{host}:{port}/v0/gateway/jobs/{job["id"]}')
+        if response.status_code != 200:
+            print("Error checking index load:", response.text)
+            return
+        job = response.json()
+
+    if job['status'] == 'succeeded':
+        print("Index loaded successfully")
+    elif job['status'] == 'failed':
+        print("Error loading index:", job['error'])
 
 
 def request_gateway_reset(host, port):
@@ -280,8 +402,8 @@ def storage_verify(storage_path=config.Config.STORAGE_PATH):
     return verified
 
 
-def storage_reset(storage_path=config.Config.STORAGE_PATH):
-    for file in config.Config.STORAGE_FILES:
+def storage_reset(storage_path=config.Config.STORAGE_PATH, files=config.Config.STORAGE_FILES):
+    for file in files:
         filepath = os.path.join(storage_path, file)
         if os.path.exists(filepath):
             os.remove(filepath)
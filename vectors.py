@@ -0,0 +1,524 @@
+# vectors.py
+# Copyright (c) 2024 Steve Castellotti
+# This file is part of Urcuchillay and is released under the MIT License.
+# See LICENSE file in the project root for full license information.
+
+import json
+import math
+import mmap
+import os
+import threading
+import time
+
+import numpy
+
+import llama_index.vector_stores.types
+import llama_index.vector_stores.utils
+
+
+class NumpyVectorStore(llama_index.vector_stores.types.VectorStore):
+    """Vector store keeping embeddings as one contiguous matrix in a memory-mapped .npy file.
+
+    Nodes are serialized one per line into a sidecar file, located through an array of byte offsets, and
+    only read for the rows a query returns. Loading maps the files without reading them, so every process
+    serving the same storage shares one copy of it in the page cache. Node ids and the documents they came
+    from are only read when nodes are deleted.
+
+    Embeddings are normalized as they are added, so a query is scored against every row with a single
+    matrix-vector product and the top k rows found with argpartition. Large stores can instead be persisted
+    with an IVF index, so a query only scores the rows of the clusters nearest to it, and with compact codes
+    which are searched in place of the full vectors before a shortlist is re-scored at full precision.
+    """
+
+    stores_text = True
+    is_embedding_query = True
+    flat_metadata = False
+
+    VERSION = 1
+    HEADER = 'vector_store.json'
+    VECTORS = 'vectors.npy'
+    OFFSETS = 'offsets.npy'
+    NODES = 'nodes.jsonl'
+    IDS = 'ids.json'
+    BLOCK_SIZE = 4096  # Rows converted to float32 and scored at once, bounding the memory used by a query
+
+    def __init__(self, dtype='float32', ann_index=None, ivf_lists=None, ivf_nprobe=16, ivf_min_nodes=50000,
+                 quantization=None, rescore=4):
+        self.dtype = numpy.dtype(dtype)
+        self.ann_index = ann_index
+        self.ivf_lists = ivf_lists
+        self.ivf_nprobe = ivf_nprobe
+        self.ivf_min_nodes = ivf_min_nodes
+        self.quantization = quantization
+        self.rescore = rescore
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.path = None
+
+        # Rows loaded from storage are memory-mapped, rows added since are held in memory until persisted
+        self.vectors = None
+        self.added = []
+        self.offsets = numpy.zeros(1, dtype=numpy.int64)
+        self.nodes = None
+        self.records = []
+        self.ids = None
+        self.ref_doc_ids = None
+        self.rows_by_id = None
+        self.deleted = set()
+
+        # The IVF index covers the rows persisted with it and is read on the first query
+        self.ivf = None
+        self.ivf_persisted = False
+
+        # Codes cover the rows persisted with them, rows added since are only searched at full precision
+        self.codes = None
+
+    @classmethod
+    def from_persist_dir(cls, path, **kwargs):
+        """Map a store persisted under path, or return an empty store if there is none."""
+        store = cls(**kwargs)
+        if os.path.exists(os.path.join(path, cls.HEADER)):
+            store.load(path)
+        return store
+
+    def load(self, path):
+        with open(os.path.join(path, self.HEADER), 'r') as f:
+            header = json.load(f)
+        if header.get('version') != self.VERSION:
+            raise ValueError(f'Unsupported numpy vector store version in {path}: {header.get("version")}')
+
+        vectors = numpy.load(os.path.join(path, self.VECTORS), mmap_mode='r')
+        offsets = numpy.load(os.path.join(path, self.OFFSETS), mmap_mode='r')
+        codes = Codes.load(path, header['quantization']) if header.get('quantization') else None
+        if len(vectors) != header['count'] or len(offsets) != header['count'] + 1 or \
+                (codes is not None and len(codes.codes) != header['count']):
+            raise ValueError(f'Numpy vector store in {path} is incomplete, it may need to be rebuilt')
+
+        with self.lock:
+            self.clear()
+            self.path = path
+            self.offsets = offsets
+            self.ivf_persisted = header.get('ivf_lists') is not None
+            if header['count']:
+                self.vectors = vectors
+                self.dtype = vectors.dtype
+                self.codes = codes
+                with open(os.path.join(path, self.NODES), 'rb') as f:
+                    self.nodes = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def client(self):
+        return self
+
+    @property
+    def rows(self):
+        return len(self.offsets) - 1 + len(self.records)
+
+    def count(self):
+        """Number of nodes in the store."""
+        return self.rows - len(self.deleted)
+
+    def get_vectors(self):
+        """The matrix of every row, merging in the rows added since it was loaded."""
+        with self.lock:
+            if self.added:
+                self.vectors = numpy.concatenate(([] if self.vectors is None else [self.vectors]) + self.added)
+                self.added = []
+            return self.vectors
+
+    def get_ids(self):
+        """Node and document ids of every row, read from storage the first time they are needed."""
+        with self.lock:
+            if self.ids is None:
+                self.ids, self.ref_doc_ids = [], []
+                if self.path is not None:
+                    with open(os.path.join(self.path, self.IDS), 'r') as f:
+                        data = json.load(f)
+                    self.ids, self.ref_doc_ids = data['ids'], data['ref_doc_ids']
+            return self.ids, self.ref_doc_ids
+
+    def get_node_ids(self):
+        """Ids of the nodes in the store, leaving out deleted rows."""
+        ids, _ = self.get_ids()
+        return [node_id for row, node_id in enumerate(ids) if row not in self.deleted]
+
+    def get_nodes(self, node_ids):
+        """Nodes stored under the given ids, in the same order, leaving out ids which are not in the store."""
+        ids, _ = self.get_ids()
+        with self.lock:
+            if self.rows_by_id is None:
+                self.rows_by_id = {node_id: row for row, node_id in enumerate(ids)}
+            rows = [self.rows_by_id.get(node_id) for node_id in node_ids]
+        return [self.get_node(row) for row in rows if row is not None and row not in self.deleted]
+
+    def get_ivf(self):
+        with self.lock:
+            if self.ivf is None and self.ivf_persisted:
+                self.ivf = IVFIndex.load(self.path)
+            return self.ivf
+
+    def get_record(self, row):
+        disk_rows = len(self.offsets) - 1
+        if row < disk_rows:
+            return self.nodes[int(self.offsets[row]):int(self.offsets[row + 1])]
+        return self.records[row - disk_rows]
+
+    def get_node(self, row):
+        return llama_index.vector_stores.utils.metadata_dict_to_node(json.loads(self.get_record(row)))
+
+    def add(self, nodes, **add_kwargs):
+        if not nodes:
+            return []
+
+        vectors = normalize(numpy.asarray([node.get_embedding() for node in nodes], dtype=numpy.float32))
+        dimensions = next((matrix.shape[1] for matrix in [self.vectors] + self.added if matrix is not None), None)
+        if dimensions not in (None, vectors.shape[1]):
+            raise ValueError(f'Embeddings of {vectors.shape[1]} dimensions cannot be added to a numpy vector '
+                             f'store of {dimensions} dimensions')
+
+        ids, ref_doc_ids = self.get_ids()
+        with self.lock:
+            self.added.append(vectors.astype(self.dtype))
+            for node in nodes:
+                metadata = llama_index.vector_stores.utils.node_to_metadata_dict(
+                    node, remove_text=False, flat_metadata=self.flat_metadata)
+                self.records.append(json.dumps(metadata).encode('utf-8'))
+                if self.rows_by_id is not None:
+                    self.rows_by_id[node.node_id] = len(ids)
+                ids.append(node.node_id)
+                ref_doc_ids.append(node.ref_doc_id)
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        _, ref_doc_ids = self.get_ids()
+        with self.lock:
+            self.deleted.update(row for row, row_ref_doc_id in enumerate(ref_doc_ids) if row_ref_doc_id == ref_doc_id)
+
+    def query(self, query, **kwargs):
+        if query.filters is not None:
+            raise ValueError('Metadata filters are not supported by the numpy vector store')
+
+        rows, similarities = self.search(query.query_embedding, query.similarity_top_k)
+        nodes = [self.get_node(row) for row in rows]
+        return llama_index.vector_stores.types.VectorStoreQueryResult(
+            nodes=nodes, similarities=similarities.tolist(), ids=[node.node_id for node in nodes])
+
+    def search(self, embedding, top_k, nprobe=None, rescore=None):
+        """Rows nearest to the embedding and their cosine similarities, highest first.
+
+        With an IVF index only the rows of the nprobe clusters nearest to the embedding are scored, and with
+        codes the top_k * rescore rows found by the codes are re-scored with the full vectors. Rows added
+        since either was built are always scored with the full vectors. An nprobe and rescore of 0 search
+        every row exactly.
+        """
+        vectors = self.get_vectors()
+        if vectors is None or top_k <= 0:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.float32)
+
+        query = normalize(numpy.asarray(embedding, dtype=numpy.float32))
+        nprobe = self.ivf_nprobe if nprobe is None else nprobe
+        rescore = self.rescore if rescore is None else rescore
+        persisted = len(self.offsets) - 1
+        ivf = self.get_ivf()
+        if ivf is not None and nprobe and nprobe < ivf.lists:
+            ranges = ivf.probe(query, nprobe)
+        else:
+            ranges = [(0, persisted)]
+        added = numpy.arange(persisted, len(vectors))
+
+        if self.codes is not None and rescore:
+            candidates = numpy.concatenate([numpy.arange(start, end) for start, end in ranges])
+            scores = numpy.concatenate([self.codes.score(start, end, query, self.BLOCK_SIZE) for start, end in ranges])
+            self.remove_deleted(candidates, scores)
+            shortlist = get_top_k(scores, min(top_k * rescore, len(scores)))
+            candidates = numpy.concatenate((numpy.sort(candidates[shortlist[scores[shortlist] > -numpy.inf]]), added))
+            scores = self.score(vectors[candidates], query)
+        else:
+            ranges.append((persisted, len(vectors)))
+            candidates = numpy.concatenate([numpy.arange(start, end) for start, end in ranges])
+            scores = numpy.concatenate([self.score(vectors[start:end], query) for start, end in ranges])
+
+        self.remove_deleted(candidates, scores)
+        top = get_top_k(scores, min(top_k, len(scores)))
+        top = top[scores[top] > -numpy.inf]
+        return candidates[top], scores[top]
+
+    def remove_deleted(self, candidates, scores):
+        if self.deleted:
+            scores[numpy.isin(candidates, numpy.fromiter(self.deleted, dtype=numpy.int64))] = -numpy.inf
+
+    def score(self, vectors, query):
+        """Cosine similarity of the query to each row, converting only a block of rows to float32 at once."""
+        if vectors.dtype == numpy.float32:
+            return vectors @ query
+        scores = numpy.empty(len(vectors), dtype=numpy.float32)
+        for start in range(0, len(vectors), self.BLOCK_SIZE):
+            scores[start:start + self.BLOCK_SIZE] = vectors[start:start + self.BLOCK_SIZE].astype(numpy.float32) @ query
+        return scores
+
+    def persist(self, persist_path, fs=None):
+        """Write the store under the persist_path directory, leaving out deleted rows, then map it again."""
+        vectors = self.get_vectors()
+        ids, ref_doc_ids = self.get_ids()
+        rows = numpy.array([row for row in range(self.rows) if row not in self.deleted], dtype=numpy.int64)
+        if vectors is None:
+            vectors = numpy.zeros((0, 0), dtype=self.dtype)
+
+        ivf = None
+        if self.ann_index == 'ivf' and len(rows) >= max(self.ivf_min_nodes, 1):
+            ivf, order = IVFIndex.train(vectors, rows, self.ivf_lists or int(math.sqrt(len(rows))),
+                                        block_size=self.BLOCK_SIZE)
+            rows = rows[order]
+
+        os.makedirs(persist_path, exist_ok=True)
+        if self.quantization is not None and len(rows):
+            Codes.write(persist_path, self.quantization, vectors, rows, self.BLOCK_SIZE)
+        else:
+            Codes.remove(persist_path)
+        paths = {filename: os.path.join(persist_path, filename)
+                 for filename in (self.HEADER, self.VECTORS, self.OFFSETS, self.NODES, self.IDS)}
+
+        # Every file is written under a temporary name first. The header is replaced last, and records the
+        # number of rows so a store left partially replaced by an interrupted write is detected on loading
+        matrix = numpy.lib.format.open_memmap(paths[self.VECTORS] + '.tmp', mode='w+', dtype=vectors.dtype,
+                                              shape=(len(rows), vectors.shape[1]))
+        for start in range(0, len(rows), self.BLOCK_SIZE):
+            matrix[start:start + self.BLOCK_SIZE] = vectors[rows[start:start + self.BLOCK_SIZE]]
+        matrix.flush()
+        del matrix
+        offsets = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+        with open(paths[self.NODES] + '.tmp', 'wb') as f:
+            for number, row in enumerate(rows):
+                record = self.get_record(row)
+                f.write(record)
+                f.write(b'\n')
+                offsets[number + 1] = offsets[number] + len(record) + 1
+        with open(paths[self.OFFSETS] + '.tmp', 'wb') as f:
+            numpy.save(f, offsets)
+        with open(paths[self.IDS] + '.tmp', 'w') as f:
+            json.dump({'ids': [ids[row] for row in rows], 'ref_doc_ids': [ref_doc_ids[row] for row in rows]}, f)
+        if ivf is not None:
+            ivf.save(persist_path)
+        with open(paths[self.HEADER] + '.tmp', 'w') as f:
+            json.dump({'version': self.VERSION, 'count': len(rows), 'dimensions': vectors.shape[1],
+                       'dtype': vectors.dtype.name, 'ivf_lists': ivf.lists if ivf is not None else None,
+                       'quantization': self.quantization if len(rows) else None}, f)
+
+        for filename in (self.VECTORS, self.OFFSETS, self.NODES, self.IDS, self.HEADER):
+            os.replace(paths[filename] + '.tmp', paths[filename])
+        if ivf is None:
+            IVFIndex.remove(persist_path)
+
+        self.load(persist_path)
+
+
+class IVFIndex:
+    """Inverted file index, grouping rows by the nearest of a number of centroids.
+
+    The store keeps its rows ordered by cluster, so each cluster is a contiguous range of rows and a query
+    reads only the ranges of the clusters nearest to it. Centroids are trained with spherical k-means on a
+    sample of the rows.
+    """
+
+    CENTROIDS = 'ivf_centroids.npy'
+    OFFSETS = 'ivf_offsets.npy'
+    ITERATIONS = 10  # Rounds of k-means when training the centroids
+    SAMPLES_PER_LIST = 64  # Rows sampled per cluster to train the centroids
+
+    def __init__(self, centroids, offsets):
+        self.centroids = centroids
+        self.offsets = offsets
+
+    @property
+    def lists(self):
+        return len(self.centroids)
+
+    @property
+    def rows(self):
+        return int(self.offsets[-1])
+
+    @classmethod
+    def train(cls, vectors, rows, lists, block_size=4096, seed=0):
+        """Cluster the given rows of vectors, returning the index and the order to store the rows in."""
+        random = numpy.random.default_rng(seed)
+        lists = max(1, min(lists, len(rows)))
+        sample = numpy.sort(random.choice(rows, min(len(rows), lists * cls.SAMPLES_PER_LIST), replace=False))
+        sample = numpy.asarray(vectors[sample], dtype=numpy.float32)
+        centroids = sample[random.choice(len(sample), lists, replace=False)]
+
+        for _ in range(cls.ITERATIONS):
+            assignment = assign(sample, centroids)
+            counts = numpy.bincount(assignment, minlength=lists)
+            sums = numpy.zeros_like(centroids)
+            filled = counts > 0
+            starts = (numpy.cumsum(counts) - counts)[filled]
+            sums[filled] = numpy.add.reduceat(sample[numpy.argsort(assignment, kind='stable')], starts)
+            # Clusters left empty start again from a random row of the sample
+            empty = numpy.flatnonzero(~filled)
+            sums[empty] = sample[random.choice(len(sample), len(empty), replace=False)]
+            centroids = normalize(sums)
+
+        assignment = numpy.concatenate([assign(vectors[rows[start:start + block_size]], centroids)
+                                        for start in range(0, len(rows), block_size)])
+        counts = numpy.bincount(assignment, minlength=lists)
+        offsets = numpy.concatenate(([0], numpy.cumsum(counts))).astype(numpy.int64)
+        return cls(centroids, offsets), numpy.argsort(assignment, kind='stable')
+
+    @classmethod
+    def load(cls, path):
+        return cls(numpy.load(os.path.join(path, cls.CENTROIDS)), numpy.load(os.path.join(path, cls.OFFSETS)))
+
+    def save(self, path):
+        for filename, array in ((self.CENTROIDS, self.centroids), (self.OFFSETS, self.offsets)):
+            with open(os.path.join(path, filename) + '.tmp', 'wb') as f:
+                numpy.save(f, array)
+            os.replace(os.path.join(path, filename) + '.tmp', os.path.join(path, filename))
+
+    @classmethod
+    def remove(cls, path):
+        for filename in (cls.CENTROIDS, cls.OFFSETS):
+            if os.path.exists(os.path.join(path, filename)):
+                os.remove(os.path.join(path, filename))
+
+    def probe(self, query, nprobe):
+        """Ranges of rows in the nprobe clusters nearest to the query, in storage order."""
+        lists = numpy.sort(get_top_k(self.centroids @ query, nprobe))
+        return [(int(self.offsets[number]), int(self.offsets[number + 1])) for number in lists]
+
+
+def normalize(vectors):
+    """Scale vectors, or a matrix of them by row, to unit length, leaving zero vectors unchanged."""
+    norms = numpy.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / numpy.where(norms == 0, 1, norms)
+
+
+def get_top_k(scores, k):
+    """Indices of the k highest scores, highest first, without sorting every score."""
+    if k < len(scores):
+        rows = numpy.argpartition(-scores, k - 1)[:k]
+    else:
+        rows = numpy.arange(len(scores))
+    return rows[numpy.argsort(-scores[rows], kind='stable')]
+
+
+class Codes:
+    """Compact codes of the persisted rows of a store, searched before re-scoring a shortlist with the full vectors.
+
+    int8 codes scale each dimension by its largest magnitude into a signed byte, a quarter of the size of
+    float32. binary codes keep only the sign of each dimension, eight to a byte, a thirty-second of the size,
+    and are compared by Hamming distance.
+    """
+
+    KINDS = ('int8', 'binary')
+    CODES = 'codes.npy'
+    SCALE = 'codes_scale.npy'
+
+    # Number of bits set in each byte value, for Hamming distances between binary codes
+    POPCOUNT = numpy.array([bin(value).count('1') for value in range(256)], dtype=numpy.uint8)
+
+    def __init__(self, kind, codes, scale=None):
+        self.kind = kind
+        self.codes = codes
+        self.scale = scale
+
+    @classmethod
+    def write(cls, path, kind, vectors, rows, block_size=4096):
+        """Write the codes of the given rows of vectors, in that order."""
+        if kind not in cls.KINDS:
+            raise ValueError(f'Unknown quantization {kind!r}, expected one of {", ".join(cls.KINDS)}')
+
+        scale = None
+        if kind == 'int8':
+            scale = numpy.zeros(vectors.shape[1], dtype=numpy.float32)
+            for start in range(0, len(rows), block_size):
+                block = numpy.abs(numpy.asarray(vectors[rows[start:start + block_size]], dtype=numpy.float32))
+                scale = numpy.maximum(scale, block.max(axis=0))
+            scale = numpy.where(scale == 0, 1, scale) / 127
+            with open(os.path.join(path, cls.SCALE) + '.tmp', 'wb') as f:
+                numpy.save(f, scale)
+            os.replace(os.path.join(path, cls.SCALE) + '.tmp', os.path.join(path, cls.SCALE))
+            shape, dtype = (len(rows), vectors.shape[1]), numpy.int8
+        else:
+            shape, dtype = (len(rows), (vectors.shape[1] + 7) // 8), numpy.uint8
+
+        codes = numpy.lib.format.open_memmap(os.path.join(path, cls.CODES) + '.tmp', mode='w+', dtype=dtype,
+                                             shape=shape)
+        for start in range(0, len(rows), block_size):
+            codes[start:start + block_size] = cls.encode(
+                kind, numpy.asarray(vectors[rows[start:start + block_size]], dtype=numpy.float32), scale)
+        codes.flush()
+        del codes
+        os.replace(os.path.join(path, cls.CODES) + '.tmp', os.path.join(path, cls.CODES))
+
+    @staticmethod
+    def encode(kind, vectors, scale=None):
+        if kind == 'int8':
+            return numpy.clip(numpy.rint(vectors / scale), -127, 127).astype(numpy.int8)
+        return numpy.packbits(vectors > 0, axis=-1)
+
+    @classmethod
+    def load(cls, path, kind):
+        scale = numpy.load(os.path.join(path, cls.SCALE)) if kind == 'int8' else None
+        return cls(kind, numpy.load(os.path.join(path, cls.CODES), mmap_mode='r'), scale)
+
+    @classmethod
+    def remove(cls, path):
+        for filename in (cls.CODES, cls.SCALE):
+            if os.path.exists(os.path.join(path, filename)):
+                os.remove(os.path.join(path, filename))
+
+    def score(self, start, end, query, block_size=4096):
+        """Approximate similarity of the query to rows start to end, higher being more similar."""
+        scores = numpy.empty(end - start, dtype=numpy.float32)
+        if self.kind == 'int8':
+            query = query * self.scale
+        else:
+            query = self.encode(self.kind, query)
+        for offset in range(start, end, block_size):
+            block = self.codes[offset:min(offset + block_size, end)]
+            if self.kind == 'int8':
+                scores[offset - start:offset - start + len(block)] = block.astype(numpy.float32) @ query
+            else:
+                distances = self.POPCOUNT[numpy.bitwise_xor(block, query)].sum(axis=1, dtype=numpy.int32)
+                scores[offset - start:offset - start + len(block)] = -distances
+        return scores
+
+
+def assign(vectors, centroids):
+    """Number of the nearest centroid to each row of vectors."""
+    return numpy.argmax(numpy.asarray(vectors, dtype=numpy.float32) @ centroids.T, axis=1)
+
+
+def measure_recall(search, exact, queries, top_k):
+    """Recall at top_k of an approximate search against an exact one, with the latency of each per query.
+
+    Both search and exact take a query embedding and top_k, and return the ids of the results.
+    """
+    recalls, latencies, exact_latencies = [], [], []
+    for query in queries:
+        start = time.perf_counter()
+        expected = exact(query, top_k)
+        exact_latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        found = search(query, top_k)
+        latencies.append(time.perf_counter() - start)
+        recalls.append(len(set(found) & set(expected)) / max(len(expected), 1))
+    return {
+        'recall': round(float(numpy.mean(recalls)), 4),
+        'latency_ms': round(1000 * float(numpy.mean(latencies)), 3),
+        'exact_latency_ms': round(1000 * float(numpy.mean(exact_latencies)), 3),
+    }
+
+
+def sample_queries(vectors, count, distance=0.5, seed=0):
+    """Query embeddings near randomly chosen rows of vectors, each moved a random direction by distance.
+
+    Moving them keeps a query from trivially finding the row it was taken from.
+    """
+    random = numpy.random.default_rng(seed)
+    rows = numpy.sort(random.choice(len(vectors), min(count, len(vectors)), replace=False))
+    sample = normalize(numpy.asarray(vectors[rows], dtype=numpy.float32))
+    noise = normalize(random.standard_normal(sample.shape).astype(numpy.float32))
+    return normalize(sample + distance * noise)